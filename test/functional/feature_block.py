@@ -1380,6 +1380,8 @@ class FullBlockTest(BitcoinTestFramework):
     # adds transactions to the block and updates state
     def update_block(self, block_number, new_transactions, reorder=True):
         block = self.blocks[block_number]
+        # Blocks can be updated many times, only rehash what changed
+        block.enable_cache()
         self.add_transactions_to_block(block, new_transactions)
         old_sha256 = block.sha256
         if reorder:
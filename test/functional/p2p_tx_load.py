@@ -0,0 +1,109 @@
+#!/usr/bin/env python3
+# Copyright (c) 2019 The Bitcoin developers
+# Distributed under the MIT software license, see the accompanying
+# file COPYING or http://www.opensource.org/licenses/mit-license.php.
+"""Test transaction acceptance under load from several P2P peers.
+
+Streams independent transactions to the node through the TxLoadGenerator,
+once as tx messages with latency measured through the inv relay, and once
+as inv announcements with latency measured by polling the mempool, and
+checks that every transaction is accepted.
+"""
+
+from test_framework.blocktools import (
+    create_block,
+    create_coinbase,
+)
+from test_framework.loadgen import TxLoadGenerator
+from test_framework.messages import (
+    COutPoint,
+    CTransaction,
+    CTxIn,
+    CTxOut,
+)
+from test_framework.mininode import (
+    network_thread_join,
+    network_thread_start,
+    P2PDataStore,
+)
+from test_framework.script import CScript, OP_TRUE
+from test_framework.test_framework import BitcoinTestFramework
+from test_framework.txtools import pad_tx
+from test_framework.util import assert_equal
+
+# Number of transactions sent in each round
+NUM_TXS = 200
+FEE = 1000
+
+
+class TxLoadTest(BitcoinTestFramework):
+
+    def set_test_params(self):
+        self.num_nodes = 1
+        self.setup_clean_chain = True
+        # Relay invs to the observer peer without the trickle delay
+        self.extra_args = [["-whitelist=127.0.0.1"]]
+
+    def make_txs(self):
+        """Mine an anyone-can-spend coinbase and split it into independent
+        transactions spending one output each."""
+        node = self.nodes[0]
+        node.add_p2p_connection(P2PDataStore())
+        network_thread_start()
+        node.p2p.wait_for_verack()
+
+        tip = node.getbestblockhash()
+        block_time = node.getblock(tip)['time'] + 1
+        block = create_block(int(tip, 16), create_coinbase(1), block_time)
+        block.solve()
+        node.p2p.send_blocks_and_test([block], node, success=True)
+        node.generate(100)
+
+        coinbase = block.vtx[0]
+        value = (coinbase.vout[0].nValue - FEE) // (2 * NUM_TXS)
+        fanout = CTransaction()
+        fanout.vin.append(CTxIn(COutPoint(coinbase.sha256, 0), b""))
+        fanout.vout = [CTxOut(value, CScript([OP_TRUE]))
+                       for _ in range(2 * NUM_TXS)]
+        fanout.rehash()
+        node.p2p.send_txs_and_test([fanout], node, success=True)
+        node.generate(1)
+
+        txs = []
+        for i in range(2 * NUM_TXS):
+            tx = CTransaction()
+            tx.vin.append(CTxIn(COutPoint(fanout.sha256, i), b""))
+            tx.vout.append(CTxOut(value - FEE, CScript([OP_TRUE])))
+            pad_tx(tx)
+            tx.rehash()
+            txs.append(tx)
+
+        node.disconnect_p2ps()
+        network_thread_join()
+        return txs
+
+    def send_load(self, txs, **kwargs):
+        node = self.nodes[0]
+        load = TxLoadGenerator(node, txs, **kwargs)
+        network_thread_start()
+        report = load.run(timeout=60)
+        self.log.info(load.report_json())
+        assert_equal(report["sent"], len(txs))
+        assert_equal(report["accepted"], len(txs))
+        assert set(tx.hash for tx in txs) <= set(node.getrawmempool())
+
+        node.disconnect_p2ps()
+        network_thread_join()
+
+    def run_test(self):
+        txs = self.make_txs()
+
+        self.log.info("Send txs from 4 peers, latency through inv relay")
+        self.send_load(txs[:NUM_TXS], peers=4, rate=50)
+
+        self.log.info("Announce txs from 8 peers, latency through the mempool")
+        self.send_load(txs[NUM_TXS:], peers=8, mode="inv", latency="mempool")
+
+
+if __name__ == '__main__':
+    TxLoadTest().main()
@@ -2,18 +2,19 @@
 # Copyright (c) 2015-2016 The Bitcoin Core developers
 # Distributed under the MIT software license, see the accompanying
 # file COPYING or http://www.opensource.org/licenses/mit-license.php.
-"""BlockStore and TxStore helper classes."""
+"""BlockStore, TxStore and HeaderIndex helper classes."""
 
 import dbm.dumb as dbmd
-from io import BytesIO
 import logging
 
 from .messages import (
-    CBlock,
     CBlockHeader,
     CBlockLocator,
+    LazyBlock,
     msg_headers,
     msg_generic,
+    ser_compact_size,
+    uint256_from_compact,
 )
 
 logger = logging.getLogger("TestFramework.blockstore")
@@ -47,14 +48,14 @@ class BlockStore():
             return None
         return value
 
-    # lookup an entry and return it as a CBlock
+    # lookup an entry and return it as a CBlock (transactions are decoded on
+    # demand, see LazyBlock)
     def get_block(self, blockhash):
         ret = None
         serialized_block = self.get(blockhash)
         if serialized_block is not None:
-            f = BytesIO(serialized_block)
-            ret = CBlock()
-            ret.deserialize(f)
+            ret = LazyBlock()
+            ret.deserialize_from(memoryview(serialized_block))
             ret.calc_sha256()
         return ret
 
@@ -137,6 +138,235 @@ class BlockStore():
         return locator
 
 
+def invert_lowest_one(n):
+    """Turn the lowest '1' bit in the binary representation of a number into
+    a '0'."""
+    return n & (n - 1)
+
+
+def get_skip_height(height):
+    """Height of the skip pointer of a block, as GetSkipHeight() in C++."""
+    if height < 2:
+        return 0
+    # Determine which height to jump back to. Any number strictly lower than
+    # height is acceptable, but the following expression seems to perform
+    # well in simulations (max 110 steps to go back up to 2**18 blocks).
+    if height & 1:
+        return invert_lowest_one(invert_lowest_one(height - 1)) + 1
+    return invert_lowest_one(height)
+
+
+class HeaderIndexEntry():
+    """A header in a HeaderIndex, the equivalent of a CBlockIndex."""
+    __slots__ = ("chainwork", "hash", "header", "height", "prev", "raw",
+                 "skip")
+
+    def __init__(self, header, prev):
+        self.header = header
+        self.hash = header.sha256
+        # Serialized as in a headers message, with an empty tx count
+        self.raw = header.serialize() + b"\x00"
+        self.set_prev(prev)
+
+    def set_prev(self, prev):
+        """Connect the entry to its parent, or make it a root if prev is
+        None, and compute its height, chain work and skip pointer. The
+        parent must be up to date."""
+        self.prev = prev
+        work = (1 << 256) // (uint256_from_compact(self.header.nBits) + 1)
+        if prev is None:
+            self.height = 0
+            self.chainwork = work
+            self.skip = None
+        else:
+            self.height = prev.height + 1
+            self.chainwork = prev.chainwork + work
+            self.skip = prev.get_ancestor(get_skip_height(self.height))
+
+    def get_ancestor(self, height):
+        """Return the ancestor at the given height in O(log n) steps."""
+        if height > self.height or height < 0:
+            return None
+        walk = self
+        while walk.height > height:
+            height_skip = get_skip_height(walk.height)
+            height_skip_prev = get_skip_height(walk.height - 1)
+            if walk.skip is not None and (
+                    height_skip == height or (
+                        height_skip > height and not (
+                            height_skip_prev < height_skip - 2 and
+                            height_skip_prev >= height))):
+                # Only follow skip if prev.skip isn't better than skip.prev
+                walk = walk.skip
+            else:
+                walk = walk.prev
+        return walk
+
+    def __repr__(self):
+        return "HeaderIndexEntry(hash={:064x} height={})".format(
+            self.hash, self.height)
+
+
+def last_common_ancestor(a, b):
+    """Return the last common ancestor of two HeaderIndexEntry, or None if
+    they are in disjoint trees."""
+    if a.height > b.height:
+        a = a.get_ancestor(b.height)
+    elif b.height > a.height:
+        b = b.get_ancestor(a.height)
+    while a is not b and a is not None:
+        a = a.prev
+        b = b.prev
+    return a
+
+
+class HeaderIndex():
+    """Index of block headers for answering getheaders requests.
+
+    Like the C++ block index, it keeps the height, chain work and a skip
+    pointer for every header, and the active chain as a list indexed by
+    height, so finding the fork point of a locator costs a lookup per
+    locator entry and a response is a slice of the active chain.
+
+    A header whose parent is not in the index starts a new tree, at height
+    0, until the parent is added: the tree is then connected to it and the
+    heights, chain work and skip pointers of its headers are recomputed.
+    Any header can be made the tip of the active chain with set_tip(); tips
+    lists the headers that have no children."""
+
+    def __init__(self):
+        self.entries = {}
+        self.tips = set()
+        # Roots of the trees whose parent is missing, keyed by the hash of
+        # the parent
+        self.orphans = {}
+        self.chain = []
+        # Serialized headers responses, keyed by (start, end) height on the
+        # active chain
+        self.responses = {}
+        self.max_cached_responses = 16
+
+    def __contains__(self, blockhash):
+        return blockhash in self.entries
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, blockhash):
+        return self.entries.get(blockhash)
+
+    def add(self, header):
+        """Add a header (a CBlockHeader or CBlock with sha256 set) and return
+        its entry. Adding a known header returns the existing entry."""
+        entry = self.entries.get(header.sha256)
+        if entry is not None:
+            return entry
+        prev = self.entries.get(header.hashPrevBlock)
+        entry = HeaderIndexEntry(CBlockHeader(header), prev)
+        self.entries[entry.hash] = entry
+        self.tips.discard(prev)
+        if prev is None:
+            self.orphans.setdefault(header.hashPrevBlock, []).append(entry)
+        children = self.orphans.pop(entry.hash, None)
+        if children is None:
+            self.tips.add(entry)
+        else:
+            self._connect_orphans(entry, children)
+        return entry
+
+    def _connect_orphans(self, parent, roots):
+        """Connect the trees starting at roots to their parent."""
+        roots = set(roots)
+        # Find the entries of these trees by walking back from the tips
+        moved = set()
+        for tip in self.tips:
+            path = [tip]
+            while path[-1].prev is not None:
+                path.append(path[-1].prev)
+            if path[-1] in roots:
+                moved.update(path)
+        # Parents have a lower height than their children in the old trees
+        # as well, so they are updated first
+        for entry in sorted(moved, key=lambda entry: entry.height):
+            entry.set_prev(parent if entry in roots else entry.prev)
+        tip = self.get_tip()
+        if tip is not None and tip in moved:
+            # The heights of the active chain changed
+            self.chain = []
+            self.responses.clear()
+            self.set_tip(tip.hash)
+
+    def best_tip(self):
+        """Return the tip with the most chain work."""
+        return max(self.tips, key=lambda entry: entry.chainwork, default=None)
+
+    def get_tip(self):
+        return self.chain[-1] if self.chain else None
+
+    def set_tip(self, blockhash):
+        """Make the active chain end at the header with the given hash."""
+        entry = self.entries[blockhash]
+        tip = self.get_tip()
+        if tip is entry:
+            return
+        fork = last_common_ancestor(tip, entry) if tip is not None else None
+        fork_height = fork.height if fork is not None else -1
+        if fork_height + 1 < len(self.chain):
+            # Reorg: cached responses may include disconnected headers
+            self.responses.clear()
+        del self.chain[fork_height + 1:]
+        self.chain.extend([None] * (entry.height - fork_height))
+        while entry is not fork:
+            self.chain[entry.height] = entry
+            entry = entry.prev
+
+    def contains(self, entry):
+        """Whether an entry is on the active chain."""
+        return entry.height < len(self.chain) and \
+            self.chain[entry.height] is entry
+
+    def find_fork(self, locator):
+        """Return the first locator entry on the active chain, or the start
+        of the active chain if there is none."""
+        for blockhash in locator.vHave:
+            entry = self.entries.get(blockhash)
+            if entry is not None and self.contains(entry):
+                return entry
+        return self.chain[0] if self.chain else None
+
+    def _range_for(self, locator, hash_stop, max_headers):
+        fork = self.find_fork(locator)
+        if fork is None:
+            return 0, 0
+        start = fork.height
+        end = min(start + max_headers, len(self.chain))
+        stop = self.entries.get(hash_stop)
+        if stop is not None and self.contains(stop) and \
+                start <= stop.height < end:
+            end = stop.height + 1
+        return start, end
+
+    def headers_for(self, locator, hash_stop, max_headers=2000):
+        """Return the headers of the active chain from the fork point with
+        the locator (included) up to hash_stop (included) or max_headers."""
+        start, end = self._range_for(locator, hash_stop, max_headers)
+        return [entry.header for entry in self.chain[start:end]]
+
+    def serialized_headers_for(self, locator, hash_stop, max_headers=2000):
+        """Same as headers_for(), but return the payload of the headers
+        message. Payloads are cached until the active chain is reorged."""
+        key = self._range_for(locator, hash_stop, max_headers)
+        payload = self.responses.get(key)
+        if payload is None:
+            start, end = key
+            payload = ser_compact_size(end - start) + \
+                b"".join(entry.raw for entry in self.chain[start:end])
+            if len(self.responses) >= self.max_cached_responses:
+                del self.responses[next(iter(self.responses))]
+            self.responses[key] = payload
+        return payload
+
+
 class TxStore():
     def __init__(self, datadir):
         self.txDB = dbmd.open(datadir + "/transactions", 'c')
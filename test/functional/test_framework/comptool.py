@@ -33,7 +33,7 @@ from .messages import (
     msg_mempool,
     msg_ping,
 )
-from .mininode import mininode_lock, P2PInterface
+from .mininode import FramedMessage, mininode_lock, P2PInterface
 from .util import p2p_port, wait_until
 
 
@@ -212,6 +212,13 @@ class TestManager():
     def wait_for_verack(self):
         return all(node.wait_for_verack() for node in self.p2p_connections)
 
+    def send_to_all(self, message):
+        """Send a message to every connection, framing it only once."""
+        if not isinstance(message, FramedMessage):
+            message = FramedMessage(message)
+        for c in self.p2p_connections:
+            c.send_message(message)
+
     def wait_for_pings(self, counter):
         def received_pongs():
             return all(node.received_ping_response(counter) for node in self.p2p_connections)
@@ -357,6 +364,7 @@ class TestManager():
                     first_block_with_hash = True
                     if self.block_store.get(block.sha256) is not None:
                         first_block_with_hash = False
+                    framed_block = FramedMessage(msg_block(block))
                     with mininode_lock:
                         self.block_store.add_block(block)
                         for c in self.p2p_connections:
@@ -364,7 +372,7 @@ class TestManager():
                                 # There was a previous request for this block hash
                                 # Most likely, we delivered a header for this block
                                 # but never had the block to respond to the getdata
-                                c.send_message(msg_block(block))
+                                c.send_message(framed_block)
                             else:
                                 c.block_request_map[block.sha256] = False
                     # Either send inv's to each node and sync, or add
@@ -373,11 +381,11 @@ class TestManager():
                         # if we expect success, send inv and sync every block
                         # if we expect failure, just push the block and see what happens.
                         if outcome == True:
-                            [c.send_inv(block) for c in self.p2p_connections]
+                            self.send_to_all(
+                                msg_inv([CInv(2, block.sha256)]))
                             self.sync_blocks(block.sha256, 1)
                         else:
-                            [c.send_message(msg_block(block))
-                             for c in self.p2p_connections]
+                            self.send_to_all(framed_block)
                             [c.send_ping(self.ping_counter)
                              for c in self.p2p_connections]
                             self.wait_for_pings(self.ping_counter)
@@ -390,7 +398,7 @@ class TestManager():
                 elif isinstance(b_or_t, CBlockHeader):
                     block_header = b_or_t
                     self.block_store.add_header(block_header)
-                    [c.send_header(block_header) for c in self.p2p_connections]
+                    self.send_to_all(msg_headers([block_header]))
 
                 else:  # Tx test runner
                     assert(isinstance(b_or_t, CTransaction))
@@ -403,7 +411,7 @@ class TestManager():
                             c.tx_request_map[tx.sha256] = False
                     # Again, either inv to all nodes or save for later
                     if (test_instance.sync_every_tx):
-                        [c.send_inv(tx) for c in self.p2p_connections]
+                        self.send_to_all(msg_inv([CInv(1, tx.sha256)]))
                         self.sync_transaction(tx.sha256, 1)
                         if (not self.check_mempool(tx.sha256, outcome)):
                             raise AssertionError(
@@ -412,15 +420,13 @@ class TestManager():
                         invqueue.append(CInv(1, tx.sha256))
                 # Ensure we're not overflowing the inv queue
                 if len(invqueue) == MAX_INV_SZ:
-                    [c.send_message(msg_inv(invqueue))
-                     for c in self.p2p_connections]
+                    self.send_to_all(msg_inv(invqueue))
                     invqueue = []
 
             # Do final sync if we weren't syncing on every block or every tx.
             if (not test_instance.sync_every_block and block is not None):
                 if len(invqueue) > 0:
-                    [c.send_message(msg_inv(invqueue))
-                     for c in self.p2p_connections]
+                    self.send_to_all(msg_inv(invqueue))
                     invqueue = []
                 self.sync_blocks(block.sha256, len(
                     test_instance.blocks_and_transactions))
@@ -429,8 +435,7 @@ class TestManager():
                         "Block test failed at test {}".format(test_number))
             if (not test_instance.sync_every_tx and tx is not None):
                 if len(invqueue) > 0:
-                    [c.send_message(msg_inv(invqueue))
-                     for c in self.p2p_connections]
+                    self.send_to_all(msg_inv(invqueue))
                     invqueue = []
                 self.sync_transaction(tx.sha256, len(
                     test_instance.blocks_and_transactions))
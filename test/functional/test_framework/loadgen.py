@@ -0,0 +1,320 @@
+#!/usr/bin/env python3
+# Copyright (c) 2019 The Bitcoin developers
+# Distributed under the MIT software license, see the accompanying
+# file COPYING or http://www.opensource.org/licenses/mit-license.php.
+"""Multi-peer P2P transaction load generator and capture replayer.
+
+TxLoadGenerator opens several P2P connections to a node and streams
+pre-built transactions through them at a fixed rate per peer, either as tx
+messages or as inv announcements that the peers answer from their tx store.
+It records how long every transaction takes to be accepted, as seen by an
+observer peer that receives the node's inv relay, or by polling
+getrawmempool, and reports throughput and latency percentiles as JSON.
+
+Note that the node delays inv relay to peers that are not whitelisted by
+several seconds, so run it with -whitelist=127.0.0.1 when measuring latency
+through the observer peer.
+
+CaptureReplayer sends the messages of a P2P capture file (see p2pcapture)
+to a node, either as fast as possible or at the pace they were recorded
+at, and reports the ingestion rate."""
+
+import heapq
+import json
+import time
+
+from test_framework.messages import (
+    CInv,
+    msg_inv,
+    msg_tx,
+    MSG_TX,
+    MSG_TYPE_MASK,
+)
+from test_framework.mininode import (
+    MAGIC_BYTES,
+    mininode_lock,
+    P2PDataStore,
+    P2PInterface,
+)
+from test_framework.p2pcapture import (
+    CAPTURE_SEND,
+    CAPTURE_SESSION,
+    read_capture,
+)
+
+# How often getrawmempool is polled when measuring latency from the mempool
+MEMPOOL_POLL_INTERVAL = 0.05
+
+# Commands that are not replayed from a capture: the replaying peer does its
+# own version handshake and pings
+REPLAY_SKIP_COMMANDS = (b"version", b"verack", b"ping", b"pong")
+
+
+def percentile(values, p):
+    """Return the p-th percentile of sorted values, using nearest rank."""
+    if not values:
+        return None
+    rank = max(0, -(-len(values) * p // 100) - 1)
+    return values[int(rank)]
+
+
+class LoadPeer(P2PDataStore):
+    """A load generating peer.
+
+    Answers getdata for the transactions it announces, and ignores the invs
+    the node relays back so it doesn't add any traffic of its own."""
+
+    def on_inv(self, message):
+        pass
+
+
+class ObserverPeer(P2PInterface):
+    """A peer that records when each transaction is first announced to it."""
+
+    def __init__(self):
+        super().__init__()
+        # txid -> time.monotonic() of the first inv for it
+        self.first_seen = {}
+        # (txid, time) in the order the txids were first seen
+        self.announcements = []
+
+    def on_inv(self, message):
+        now = time.monotonic()
+        for inv in message.inv:
+            if (inv.type & MSG_TYPE_MASK) == MSG_TX and inv.hash not in self.first_seen:
+                self.first_seen[inv.hash] = now
+                self.announcements.append((inv.hash, now))
+
+
+class TxLoadGenerator():
+    """Stream transactions to a node through several P2P connections.
+
+    The transactions are spread over the peers round-robin and each peer
+    sends its share in order, so transactions spending each other should
+    be passed in order, and are best kept independent: a child that arrives
+    on a different peer before its parent is only accepted once the parent
+    is.
+
+    mode is "tx" to send the transactions directly, or "inv" to announce them
+    and serve them on getdata. rate is the number of messages per second per
+    peer, or None to send as fast as possible. latency is measured until the
+    transaction comes back to an observer peer ("inv") or shows up in
+    getrawmempool ("mempool").
+
+    The connections are added when the generator is created, so it must be
+    created before the network thread is started."""
+
+    def __init__(self, node, txs, *, peers=4, rate=None, mode="tx", latency="inv"):
+        if mode not in ("tx", "inv"):
+            raise ValueError("Unknown load generator mode {}".format(mode))
+        if latency not in ("inv", "mempool"):
+            raise ValueError("Unknown latency source {}".format(latency))
+        self.node = node
+        self.txs = txs
+        self.rate = rate
+        self.mode = mode
+        self.latency = latency
+
+        self.peers = [node.add_p2p_connection(LoadPeer())
+                      for _ in range(peers)]
+        self.observer = node.add_p2p_connection(ObserverPeer())
+
+        # Frame every message up front, so only the sending is timed
+        self.queues = [[] for _ in self.peers]
+        for i, tx in enumerate(txs):
+            peer = self.peers[i % len(self.peers)]
+            if mode == "tx":
+                message = msg_tx(tx)
+            else:
+                peer.tx_store[tx.sha256] = tx
+                message = msg_inv([CInv(MSG_TX, tx.sha256)])
+            self.queues[i % len(self.peers)].append(
+                (tx.sha256, peer.format_message(message)))
+
+        # txid -> time.monotonic() when it was sent and accepted
+        self.sent = {}
+        self.accepted = {}
+        self.start_time = None
+        self.send_time = 0
+        self.txids = {tx.hash: tx.sha256 for tx in txs}
+        self.next_poll = 0
+        # Number of the observer's announcements already looked at
+        self.collected = 0
+
+    def wait_for_verack(self, timeout=60):
+        for peer in self.peers + [self.observer]:
+            peer.wait_for_verack(timeout=timeout)
+
+    def run(self, timeout=60):
+        """Send all transactions, wait for them to be accepted and return the
+        report.
+
+        Transactions that are not accepted within timeout seconds of the last
+        one being sent are reported as missing."""
+        self.wait_for_verack()
+        interval = 1 / self.rate if self.rate else 0
+
+        self.start_time = time.monotonic()
+        schedule = [(self.start_time, i)
+                    for i, queue in enumerate(self.queues) if queue]
+        heapq.heapify(schedule)
+        positions = [0] * len(self.queues)
+        while schedule:
+            due, i = schedule[0]
+            now = time.monotonic()
+            if due > now:
+                self._wait(due - now)
+                continue
+            txid, frame = self.queues[i][positions[i]]
+            self.sent[txid] = time.monotonic()
+            self.peers[i].send_raw_message(frame)
+            positions[i] += 1
+            if positions[i] < len(self.queues[i]):
+                # Keep to the schedule even if a send ran late
+                heapq.heapreplace(schedule, (due + interval, i))
+            else:
+                heapq.heappop(schedule)
+        self.send_time = time.monotonic() - self.start_time
+
+        deadline = time.monotonic() + timeout
+        while len(self.accepted) < len(self.sent) and time.monotonic() < deadline:
+            self._wait(MEMPOOL_POLL_INTERVAL)
+        self._collect()
+        return self.report()
+
+    def _wait(self, duration):
+        """Sleep for up to duration seconds, collecting accepted transactions
+        in the meantime."""
+        if self.latency == "mempool":
+            now = time.monotonic()
+            if now >= self.next_poll:
+                self._collect()
+                self.next_poll = now + MEMPOOL_POLL_INTERVAL
+            duration = max(0, min(duration, self.next_poll - time.monotonic()))
+            time.sleep(duration)
+            return
+        with mininode_lock:
+            mininode_lock.wait(duration)
+        self._collect()
+
+    def _collect(self):
+        if self.latency == "mempool":
+            now = time.monotonic()
+            for txid in self.node.getrawmempool():
+                sha256 = self.txids.get(txid)
+                if sha256 in self.sent and sha256 not in self.accepted:
+                    self.accepted[sha256] = now
+            return
+        with mininode_lock:
+            announcements = self.observer.announcements[self.collected:]
+        self.collected += len(announcements)
+        for sha256, seen in announcements:
+            if sha256 in self.sent:
+                self.accepted[sha256] = seen
+
+    def report(self):
+        """Return throughput and latency statistics as a dict."""
+        latencies = sorted(1000 * (self.accepted[txid] - self.sent[txid])
+                           for txid in self.accepted)
+        duration = 0
+        if self.accepted:
+            duration = max(self.accepted.values()) - self.start_time
+        return {
+            "peers": len(self.peers),
+            "mode": self.mode,
+            "latency_source": self.latency,
+            "rate_per_peer": self.rate,
+            "sent": len(self.sent),
+            "accepted": len(self.accepted),
+            "missing": len(self.sent) - len(self.accepted),
+            "send_duration": self.send_time,
+            "duration": duration,
+            "send_rate": len(self.sent) / self.send_time if self.send_time else None,
+            "throughput": len(self.accepted) / duration if duration else None,
+            "latency_ms": {
+                "p50": percentile(latencies, 50),
+                "p99": percentile(latencies, 99),
+                "max": latencies[-1] if latencies else None,
+                "mean": sum(latencies) / len(latencies) if latencies else None,
+            },
+        }
+
+    def report_json(self):
+        return json.dumps(self.report(), indent=1, sort_keys=True)
+
+
+class CaptureReplayer():
+    """Replay the messages a captured connection sent to a node.
+
+    The messages are sent from a single peer in the order they were
+    captured, either as fast as possible or, if paced is set, with the same
+    spacing they were captured with. The capture sessions of a file are
+    replayed back to back. Commands in skip are left out.
+
+    Blocks are replayed unrequested, so the node should whitelist the
+    replaying peer to process them. As with TxLoadGenerator, the replayer
+    must be created before the network thread is started."""
+
+    def __init__(self, node, path, *, paced=False, skip=REPLAY_SKIP_COMMANDS):
+        self.node = node
+        self.paced = paced
+        self.peer = node.add_p2p_connection(LoadPeer())
+
+        magic = MAGIC_BYTES[self.peer.network]
+        # (session number, timestamp, message)
+        self.records = []
+        session = 0
+        for timestamp, direction, message in read_capture(path):
+            if direction == CAPTURE_SESSION:
+                session += 1
+                continue
+            if direction != CAPTURE_SEND:
+                continue
+            if message[:4] != magic:
+                raise ValueError("{} was not captured on {}".format(
+                    path, self.peer.network))
+            if message[4:16].split(b"\x00", 1)[0] not in skip:
+                self.records.append((session, timestamp, message))
+
+        self.send_time = 0
+        self.duration = 0
+
+    def run(self, timeout=60):
+        """Send the captured messages, wait for the node to process them
+        and return the report."""
+        self.peer.wait_for_verack(timeout=timeout)
+
+        start = time.monotonic()
+        session = None
+        for record_session, timestamp, message in self.records:
+            if self.paced:
+                if record_session != session:
+                    # Start the session's first message right away
+                    session = record_session
+                    offset = time.monotonic() - timestamp / 1e9
+                delay = offset + timestamp / 1e9 - time.monotonic()
+                if delay > 0:
+                    time.sleep(delay)
+            self.peer.send_raw_message(message)
+        self.send_time = time.monotonic() - start
+
+        self.peer.sync_with_ping(timeout=timeout)
+        self.duration = time.monotonic() - start
+        return self.report()
+
+    def report(self):
+        """Return the replay statistics as a dict."""
+        size = sum(len(message) for _, _, message in self.records)
+        duration = self.duration
+        return {
+            "paced": self.paced,
+            "messages": len(self.records),
+            "bytes": size,
+            "send_duration": self.send_time,
+            "duration": duration,
+            "messages_per_second": len(self.records) / duration if duration else None,
+            "mb_per_second": size / duration / 1000000 if duration else None,
+        }
+
+    def report_json(self):
+        return json.dumps(self.report(), indent=1, sort_keys=True)
@@ -15,10 +15,18 @@ msg_block, msg_tx, msg_headers, etc.:
 
 ser_*, deser_*: functions that handle serialization/deserialization.
 
+deserialize_from(buf, offset): alternate decode path implemented by the hot
+    types (blocks, transactions, headers and compact blocks). It walks a
+    memoryview with an integer offset instead of reading from a BytesIO, and
+    returns the offset just past the decoded object. It produces exactly the
+    same objects as deserialize().
+
 Classes use __slots__ to ensure extraneous attributes aren't accidentally added
 by tests, compromising their intended effect.
 """
 from codecs import encode
+from collections import deque
+from collections.abc import MutableSequence
 import copy
 import hashlib
 from io import BytesIO
@@ -27,7 +35,7 @@ import socket
 import struct
 import time
 
-from test_framework.siphash import siphash256
+from test_framework.siphash import siphash256, siphash256_batch
 from test_framework.util import bytes_to_hex_str, hex_str_to_bytes
 
 MIN_VERSION_SUPPORTED = 60001
@@ -58,6 +66,8 @@ MSG_TYPE_MASK = 0xffffffff >> 2
 # Howmuch data will be read from the network at once
 READ_BUFFER_SIZE = 8192
 
+UINT256_MASK = (1 << 256) - 1
+
 # Serialization/deserialization tools
 
 
@@ -86,6 +96,19 @@ def ser_compact_size(l):
     return r
 
 
+# Precompiled structs for the memoryview decode path (deserialize_from). Each
+# *_from helper takes a buffer and an offset and returns the decoded value
+# together with the offset just past it, so no intermediate bytes objects are
+# created for fixed-width fields.
+_unpack_int32 = struct.Struct("<i").unpack_from
+_unpack_uint16 = struct.Struct("<H").unpack_from
+_unpack_uint32 = struct.Struct("<I").unpack_from
+_unpack_int64 = struct.Struct("<q").unpack_from
+_unpack_uint64 = struct.Struct("<Q").unpack_from
+_unpack_header_tail = struct.Struct("<III").unpack_from
+_iter_unpack_shortids = struct.Struct("<IH").iter_unpack
+
+
 def deser_compact_size(f):
     nit = struct.unpack("<B", f.read(1))[0]
     if nit == 253:
@@ -97,11 +120,36 @@ def deser_compact_size(f):
     return nit
 
 
+def deser_compact_size_from(buf, offset):
+    nit = buf[offset]
+    offset += 1
+    if nit == 253:
+        nit = _unpack_uint16(buf, offset)[0]
+        offset += 2
+    elif nit == 254:
+        nit = _unpack_uint32(buf, offset)[0]
+        offset += 4
+    elif nit == 255:
+        nit = _unpack_uint64(buf, offset)[0]
+        offset += 8
+    return nit, offset
+
+
 def deser_string(f):
     nit = deser_compact_size(f)
     return f.read(nit)
 
 
+def deser_string_from(buf, offset):
+    nit = buf[offset]
+    if nit < 253:
+        offset += 1
+    else:
+        nit, offset = deser_compact_size_from(buf, offset)
+    end = offset + nit
+    return bytes(buf[offset:end]), end
+
+
 def ser_string(s):
     return ser_compact_size(len(s)) + s
 
@@ -114,12 +162,12 @@ def deser_uint256(f):
     return r
 
 
+def deser_uint256_from(buf, offset):
+    return int.from_bytes(buf[offset:offset + 32], 'little'), offset + 32
+
+
 def ser_uint256(u):
-    rs = b""
-    for i in range(8):
-        rs += struct.pack("<I", u & 0xFFFFFFFF)
-        u >>= 32
-    return rs
+    return (u & UINT256_MASK).to_bytes(32, 'little')
 
 
 def uint256_from_str(s):
@@ -146,16 +194,28 @@ def deser_vector(f, c):
     return r
 
 
+def deser_vector_from(buf, offset, c):
+    nit, offset = deser_compact_size_from(buf, offset)
+    r = []
+    for i in range(nit):
+        # deserialize_from() assigns every slot, so skip running __init__
+        # only to overwrite its defaults.
+        t = c.__new__(c)
+        offset = t.deserialize_from(buf, offset)
+        r.append(t)
+    return r, offset
+
+
 # ser_function_name: Allow for an alternate serialization function on the
 # entries in the vector.
 def ser_vector(l, ser_function_name=None):
-    r = ser_compact_size(len(l))
+    r = [ser_compact_size(len(l))]
     for i in l:
         if ser_function_name:
-            r += getattr(i, ser_function_name)()
+            r.append(getattr(i, ser_function_name)())
         else:
-            r += i.serialize()
-    return r
+            r.append(i.serialize())
+    return b"".join(r)
 
 
 def deser_uint256_vector(f):
@@ -291,7 +351,7 @@ class CBlockLocator:
 
 
 class COutPoint:
-    __slots__ = ("hash", "n")
+    __slots__ = ("_owners", "hash", "n")
 
     def __init__(self, hash=0, n=0):
         self.hash = hash
@@ -301,6 +361,11 @@ class COutPoint:
         self.hash = deser_uint256(f)
         self.n = struct.unpack("<I", f.read(4))[0]
 
+    def deserialize_from(self, buf, offset=0):
+        self.hash = int.from_bytes(buf[offset:offset + 32], 'little')
+        self.n = _unpack_uint32(buf, offset + 32)[0]
+        return offset + 36
+
     def serialize(self):
         r = b""
         r += ser_uint256(self.hash)
@@ -312,7 +377,7 @@ class COutPoint:
 
 
 class CTxIn:
-    __slots__ = ("nSequence", "prevout", "scriptSig")
+    __slots__ = ("_owners", "nSequence", "prevout", "scriptSig")
 
     def __init__(self, outpoint=None, scriptSig=b"", nSequence=0):
         if outpoint is None:
@@ -328,6 +393,13 @@ class CTxIn:
         self.scriptSig = deser_string(f)
         self.nSequence = struct.unpack("<I", f.read(4))[0]
 
+    def deserialize_from(self, buf, offset=0):
+        self.prevout = COutPoint()
+        offset = self.prevout.deserialize_from(buf, offset)
+        self.scriptSig, offset = deser_string_from(buf, offset)
+        self.nSequence = _unpack_uint32(buf, offset)[0]
+        return offset + 4
+
     def serialize(self):
         r = b""
         r += self.prevout.serialize()
@@ -341,7 +413,7 @@ class CTxIn:
 
 
 class CTxOut:
-    __slots__ = ("nValue", "scriptPubKey")
+    __slots__ = ("_owners", "nValue", "scriptPubKey")
 
     def __init__(self, nValue=0, scriptPubKey=b""):
         self.nValue = nValue
@@ -351,6 +423,11 @@ class CTxOut:
         self.nValue = struct.unpack("<q", f.read(8))[0]
         self.scriptPubKey = deser_string(f)
 
+    def deserialize_from(self, buf, offset=0):
+        self.nValue = _unpack_int64(buf, offset)[0]
+        self.scriptPubKey, offset = deser_string_from(buf, offset + 8)
+        return offset
+
     def serialize(self):
         r = b""
         r += struct.pack("<q", self.nValue)
@@ -364,7 +441,8 @@ class CTxOut:
 
 
 class CTransaction:
-    __slots__ = ("hash", "nLockTime", "nVersion", "sha256", "vin", "vout")
+    __slots__ = ("_cache", "hash", "nLockTime", "nVersion", "sha256", "vin",
+                 "vout")
 
     def __init__(self, tx=None):
         if tx is None:
@@ -390,6 +468,15 @@ class CTransaction:
         self.sha256 = None
         self.hash = None
 
+    def deserialize_from(self, buf, offset=0):
+        self.nVersion = _unpack_int32(buf, offset)[0]
+        self.vin, offset = deser_vector_from(buf, offset + 4, CTxIn)
+        self.vout, offset = deser_vector_from(buf, offset, CTxOut)
+        self.nLockTime = _unpack_uint32(buf, offset)[0]
+        self.sha256 = None
+        self.hash = None
+        return offset + 4
+
     def billable_size(self):
         """
         Returns the size used for billing the against the transaction
@@ -412,10 +499,24 @@ class CTransaction:
 
     # self.sha256 and self.hash -- those are expected to be the txid.
     def calc_sha256(self):
+        h = hash256(self.serialize())
         if self.sha256 is None:
-            self.sha256 = uint256_from_str(hash256(self.serialize()))
-        self.hash = encode(
-            hash256(self.serialize())[::-1], 'hex_codec').decode('ascii')
+            self.sha256 = uint256_from_str(h)
+        self.hash = encode(h[::-1], 'hex_codec').decode('ascii')
+
+    def enable_cache(self):
+        """Opt in to caching the serialization and txid of this transaction.
+
+        The cache is dropped whenever nVersion, vin, vout, nLockTime or any
+        CTxIn, COutPoint or CTxOut they contain is modified, so serialize()
+        and rehash() only do work after an actual change. vin and vout are
+        replaced by tracking lists: call this before keeping references to
+        them. Returns self."""
+        if not isinstance(self, _CachedTransaction):
+            self.__class__ = _CachedTransaction
+            self.vin = self.vin
+            self.vout = self.vout
+        return self
 
     def get_id(self):
         # For now, just forward the hash.
@@ -434,6 +535,449 @@ class CTransaction:
             self.nVersion, repr(self.vin), repr(self.vout), self.nLockTime)
 
 
+# Dirty tracking for CTransaction.enable_cache(). A cached transaction swaps
+# the class of itself and of every CTxIn, COutPoint and CTxOut it contains for
+# a subclass that reports attribute writes to its owners (the objects
+# containing it), and holds vin/vout in a list that reports structural
+# changes.
+
+
+def _track(obj, owner):
+    """Record that owner contains obj, so that changes to obj invalidate it."""
+    tracked_class = _TRACKED_CLASSES.get(type(obj))
+    if tracked_class is None:
+        if type(obj) not in _TRACKED_CLASSES.values():
+            return
+    else:
+        obj.__class__ = tracked_class
+    try:
+        owners = obj._owners
+    except AttributeError:
+        owners = []
+        object.__setattr__(obj, "_owners", owners)
+    if not any(o is owner for o in owners):
+        owners.append(owner)
+    if isinstance(obj, CTxIn):
+        _track(obj.prevout, obj)
+
+
+def _tracked_setattr(self, name, value):
+    object.__setattr__(self, name, value)
+    if name == "_owners":
+        return
+    if name == "prevout":
+        _track(value, self)
+    self._invalidate()
+
+
+def _untracked_copy(obj, cls, memo):
+    """Deep copy obj as a plain cls instance, without tracking state."""
+    result = cls.__new__(cls)
+    memo[id(obj)] = result
+    for name in cls.__slots__:
+        if name in ("_owners", "_cache") or not hasattr(obj, name):
+            continue
+        setattr(result, name, copy.deepcopy(getattr(obj, name), memo))
+    return result
+
+
+class _TrackedChild:
+    """Mixin for the tracking subclasses of COutPoint, CTxIn and CTxOut."""
+    __slots__ = ()
+
+    __setattr__ = _tracked_setattr
+
+    def _invalidate(self):
+        for owner in getattr(self, "_owners", ()):
+            owner._invalidate()
+
+    def __deepcopy__(self, memo):
+        return _untracked_copy(self, type(self).__bases__[1], memo)
+
+
+class _TrackedOutPoint(_TrackedChild, COutPoint):
+    __slots__ = ()
+
+
+class _TrackedTxIn(_TrackedChild, CTxIn):
+    __slots__ = ()
+
+
+class _TrackedTxOut(_TrackedChild, CTxOut):
+    __slots__ = ()
+
+
+_TRACKED_CLASSES = {
+    COutPoint: _TrackedOutPoint,
+    CTxIn: _TrackedTxIn,
+    CTxOut: _TrackedTxOut,
+}
+
+
+class _TrackedList(list):
+    """vin/vout of a cached transaction: invalidates it on any change."""
+    __slots__ = ("_owner",)
+
+    def __init__(self, owner, items=()):
+        super().__init__(items)
+        self._owner = owner
+        for item in self:
+            _track(item, owner)
+
+    def _changed(self, added=()):
+        for item in added:
+            _track(item, self._owner)
+        self._owner._invalidate()
+
+    def append(self, item):
+        super().append(item)
+        self._changed((item,))
+
+    def extend(self, items):
+        items = list(items)
+        super().extend(items)
+        self._changed(items)
+
+    def __iadd__(self, items):
+        self.extend(items)
+        return self
+
+    def insert(self, i, item):
+        super().insert(i, item)
+        self._changed((item,))
+
+    def __setitem__(self, i, value):
+        if isinstance(i, slice):
+            value = list(value)
+            super().__setitem__(i, value)
+            self._changed(value)
+        else:
+            super().__setitem__(i, value)
+            self._changed((value,))
+
+    def __delitem__(self, i):
+        super().__delitem__(i)
+        self._changed()
+
+    def __imul__(self, n):
+        super().__imul__(n)
+        self._changed()
+        return self
+
+    def pop(self, i=-1):
+        item = super().pop(i)
+        self._changed()
+        return item
+
+    def remove(self, item):
+        super().remove(item)
+        self._changed()
+
+    def clear(self):
+        super().clear()
+        self._changed()
+
+    def sort(self, *args, **kwargs):
+        super().sort(*args, **kwargs)
+        self._changed()
+
+    def reverse(self):
+        super().reverse()
+        self._changed()
+
+    def __deepcopy__(self, memo):
+        return copy.deepcopy(list(self), memo)
+
+
+class _CachedTransaction(CTransaction):
+    """A CTransaction that caches its serialization and txid."""
+    __slots__ = ()
+
+    _CACHED_FIELDS = ("nVersion", "vin", "vout", "nLockTime")
+
+    def __setattr__(self, name, value):
+        if name == "vin" or name == "vout":
+            value = _TrackedList(self, value)
+        object.__setattr__(self, name, value)
+        if name in self._CACHED_FIELDS:
+            self._invalidate()
+
+    def _invalidate(self):
+        object.__setattr__(self, "_cache", None)
+
+    def _get_cache(self):
+        cache = getattr(self, "_cache", None)
+        if cache is None:
+            # [serialization, hash256 of it, hex txid]
+            cache = [super().serialize(), None, None]
+            object.__setattr__(self, "_cache", cache)
+        return cache
+
+    def serialize(self):
+        return self._get_cache()[0]
+
+    def calc_sha256(self):
+        cache = self._get_cache()
+        if cache[1] is None:
+            cache[1] = hash256(cache[0])
+            cache[2] = encode(cache[1][::-1], 'hex_codec').decode('ascii')
+        if self.sha256 is None:
+            self.sha256 = uint256_from_str(cache[1])
+        self.hash = cache[2]
+
+    def __deepcopy__(self, memo):
+        return _untracked_copy(self, CTransaction, memo)
+
+
+def tx_end_from(buf, offset):
+    """Return the offset just past the serialized transaction at `offset`,
+    without decoding it."""
+    nin, offset = deser_compact_size_from(buf, offset + 4)
+    for i in range(nin):
+        nit, offset = deser_compact_size_from(buf, offset + 36)
+        offset += nit + 4
+    nout, offset = deser_compact_size_from(buf, offset)
+    for i in range(nout):
+        nit, offset = deser_compact_size_from(buf, offset + 8)
+        offset += nit
+    return offset + 4
+
+
+class LazyTxList(MutableSequence):
+    """List of transactions backed by a raw serialized buffer.
+
+    Only the start and end offset of each transaction are recorded up front.
+    A CTransaction is built the first time an index is accessed, and entries
+    that were never accessed or assigned serialize straight from the buffer.
+    It supports the list operations tests use on block.vtx."""
+    __slots__ = ("_raw", "_spans", "_txs")
+
+    def __init__(self, raw=b"", spans=()):
+        self._raw = raw
+        self._spans = list(spans)
+        self._txs = [None] * len(self._spans)
+
+    def __len__(self):
+        return len(self._txs)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self._txs)))]
+        tx = self._txs[i]
+        if tx is None:
+            tx = CTransaction()
+            tx.deserialize_from(memoryview(self._raw), self._spans[i][0])
+            self._txs[i] = tx
+        return tx
+
+    def __setitem__(self, i, value):
+        if isinstance(i, slice):
+            value = list(value)
+            self._txs[i] = value
+            self._spans[i] = [None] * len(value)
+        else:
+            self._txs[i] = value
+            self._spans[i] = None
+
+    def __delitem__(self, i):
+        del self._txs[i]
+        del self._spans[i]
+
+    def insert(self, i, value):
+        self._txs.insert(i, value)
+        self._spans.insert(i, None)
+
+    def sort(self, *, key=None, reverse=False):
+        self[:] = sorted(self, key=key, reverse=reverse)
+
+    def __add__(self, other):
+        return list(self) + list(other)
+
+    def __radd__(self, other):
+        return list(other) + list(self)
+
+    def __eq__(self, other):
+        if isinstance(other, (list, LazyTxList)):
+            return list(self) == list(other)
+        return NotImplemented
+
+    def is_decoded(self, i):
+        """Return whether the transaction at index i has been built."""
+        return self._txs[i] is not None
+
+    def raw_tx(self, i):
+        """Return the serialized transaction at index i.
+
+        Transactions that were accessed or assigned are re-serialized since
+        they may have been modified."""
+        span = self._spans[i]
+        if span is None or self._txs[i] is not None:
+            return self[i].serialize()
+        return self._raw[span[0]:span[1]]
+
+    def tx_hashes(self):
+        """Return the serialized txids, in order, as used by the merkle root.
+
+        Transactions that were never accessed are hashed from the buffer
+        without being decoded."""
+        hashes = []
+        for tx, span in zip(self._txs, self._spans):
+            if tx is None:
+                hashes.append(hash256(self._raw[span[0]:span[1]]))
+            else:
+                tx.calc_sha256()
+                hashes.append(ser_uint256(tx.sha256))
+        return hashes
+
+    def serialize(self):
+        view = memoryview(self._raw)
+        r = [ser_compact_size(len(self._txs))]
+        for tx, span in zip(self._txs, self._spans):
+            if tx is None:
+                r.append(view[span[0]:span[1]])
+            else:
+                r.append(tx.serialize())
+        return b"".join(r)
+
+    def __repr__(self):
+        # Received blocks are logged with repr(msg)[:500]: decode only as many
+        # transactions as needed to fill that.
+        r = "["
+        for i in range(len(self._txs)):
+            if len(r) > 500:
+                return r + "...]"
+            if i:
+                r += ", "
+            r += repr(self[i])
+        return r + "]"
+
+
+class MerkleTree:
+    """Bitcoin merkle tree over a list of serialized txids that keeps every
+    level around, so changing a leaf only rehashes its path to the root.
+
+    Leaves are 32 byte hashes as produced by ser_uint256(tx.sha256). As in
+    the C++ code, the last node of a level with an odd number of nodes is
+    paired with itself."""
+    __slots__ = ("levels",)
+
+    def __init__(self, hashes=()):
+        self.levels = [[]]
+        self.extend(hashes)
+
+    def __len__(self):
+        return len(self.levels[0])
+
+    def __getitem__(self, i):
+        return self.levels[0][i]
+
+    def __setitem__(self, i, h):
+        leaves = self.levels[0]
+        if i < 0:
+            i += len(leaves)
+        if leaves[i] != h:
+            leaves[i] = h
+            self._update({i}, len(leaves))
+
+    def append(self, h):
+        self.extend([h])
+
+    def extend(self, hashes):
+        leaves = self.levels[0]
+        old_len = len(leaves)
+        leaves.extend(hashes)
+        self._update(set(range(old_len, len(leaves))), old_len)
+
+    def update(self, hashes):
+        """Replace all the leaves, only rehashing the paths of the leaves that
+        differ. This handles reordering, appending and truncating at once."""
+        leaves = self.levels[0]
+        old_len = len(leaves)
+        dirty = set()
+        for i, h in enumerate(hashes):
+            if i >= old_len:
+                leaves.append(h)
+                dirty.add(i)
+            elif leaves[i] != h:
+                leaves[i] = h
+                dirty.add(i)
+        del leaves[len(hashes):]
+        self._update(dirty, old_len)
+
+    def _update(self, dirty, old_len):
+        levels = self.levels
+        height = 0
+        while len(levels[height]) > 1:
+            below = levels[height]
+            size = (len(below) + 1) >> 1
+            if height + 1 == len(levels):
+                levels.append([])
+            above = levels[height + 1]
+            old_size = len(above)
+            if size < old_size:
+                del above[size:]
+            else:
+                above.extend([None] * (size - old_size))
+            parents = {i >> 1 for i in dirty if i < len(below)}
+            if len(below) != old_len:
+                # The last node may now be paired with itself, or not anymore
+                parents.add(size - 1)
+            for i in parents:
+                left = below[2 * i]
+                right = below[2 * i + 1] if 2 * i + 1 < len(below) else left
+                above[i] = hash256(left + right)
+            dirty = parents
+            old_len = old_size
+            height += 1
+        del levels[height + 1:]
+
+    def root(self):
+        """Return the merkle root as an integer, like calc_merkle_root()."""
+        if not self.levels[0]:
+            return 0
+        return uint256_from_str(self.levels[-1][0])
+
+    def get_branch(self, index):
+        """Return the sibling hashes from the leaf at index up to the root."""
+        branch = []
+        for level in self.levels[:-1]:
+            sibling = index ^ 1
+            branch.append(level[sibling if sibling < len(level) else index])
+            index >>= 1
+        return branch
+
+    @staticmethod
+    def root_from_branch(leaf, branch, index):
+        """Compute the merkle root (as an integer) of a leaf at the given index
+        from its merkle branch."""
+        h = leaf
+        for sibling in branch:
+            h = hash256(sibling + h if index & 1 else h + sibling)
+            index >>= 1
+        return uint256_from_str(h)
+
+    def partial_merkle_tree(self, matches):
+        """Build the CPartialMerkleTree proving the leaves whose entry in
+        matches is true, as CPartialMerkleTree's constructor does in C++."""
+        pmt = CPartialMerkleTree()
+        pmt.nTransactions = len(self)
+        height = len(self.levels) - 1
+
+        def traverse_and_build(height, pos):
+            first = pos << height
+            parent_of_match = any(matches[first:first + (1 << height)])
+            pmt.vBits.append(parent_of_match)
+            if height == 0 or not parent_of_match:
+                pmt.vHash.append(uint256_from_str(self.levels[height][pos]))
+            else:
+                traverse_and_build(height - 1, pos * 2)
+                if pos * 2 + 1 < len(self.levels[height - 1]):
+                    traverse_and_build(height - 1, pos * 2 + 1)
+
+        traverse_and_build(height, 0)
+        return pmt
+
+
 class CBlockHeader:
     __slots__ = ("hash", "hashMerkleRoot", "hashPrevBlock", "nBits", "nNonce",
                  "nTime", "nVersion", "sha256")
@@ -472,6 +1016,18 @@ class CBlockHeader:
         self.sha256 = None
         self.hash = None
 
+    def deserialize_from(self, buf, offset=0):
+        self.nVersion = _unpack_int32(buf, offset)[0]
+        self.hashPrevBlock = int.from_bytes(
+            buf[offset + 4:offset + 36], 'little')
+        self.hashMerkleRoot = int.from_bytes(
+            buf[offset + 36:offset + 68], 'little')
+        self.nTime, self.nBits, self.nNonce = _unpack_header_tail(
+            buf, offset + 68)
+        self.sha256 = None
+        self.hash = None
+        return offset + 80
+
     def serialize(self):
         r = b""
         r += struct.pack("<i", self.nVersion)
@@ -505,16 +1061,74 @@ class CBlockHeader:
             time.ctime(self.nTime), self.nBits, self.nNonce)
 
 
+def _solve_nonce_range(prefix, target, start, stop):
+    """Return the first nonce in [start, stop) for which the header starting
+    with the 76 byte prefix hashes at or below target, or None."""
+    midstate = hashlib.sha256(prefix)
+    pack_nonce = struct.Struct("<I").pack
+    for nonce in range(start, stop):
+        h = midstate.copy()
+        h.update(pack_nonce(nonce))
+        block_hash = hashlib.sha256(h.digest()).digest()
+        if int.from_bytes(block_hash, 'little') <= target:
+            return nonce
+    return None
+
+
+# Number of nonces handed to a worker at a time by CBlock.solve(jobs)
+SOLVE_CHUNK_SIZE = 1 << 16
+
+
+def _solve_parallel(header, target, jobs):
+    """Search nonces from a pool of processes, see CBlock.solve().
+
+    Returns (nTime, nNonce) of the first solution in nonce order."""
+    import multiprocessing
+
+    def chunks():
+        nTime, nBits, start = _unpack_header_tail(header, 68)
+        while True:
+            prefix = header[:68] + struct.pack("<II", nTime, nBits)
+            for chunk_start in range(start, 0x100000000, SOLVE_CHUNK_SIZE):
+                chunk_stop = min(chunk_start + SOLVE_CHUNK_SIZE, 0x100000000)
+                yield nTime, prefix, chunk_start, chunk_stop
+            nTime += 1
+            start = 0
+
+    with multiprocessing.Pool(jobs) as pool:
+        pending = deque()
+        for nTime, prefix, start, stop in chunks():
+            pending.append((nTime, pool.apply_async(
+                _solve_nonce_range, (prefix, target, start, stop))))
+            # Keep a couple of chunks queued per worker, and check the oldest
+            # one so the first solution in nonce order wins.
+            if len(pending) < 2 * jobs:
+                continue
+            nTime, result = pending.popleft()
+            nonce = result.get()
+            if nonce is not None:
+                # Leaving the with block terminates the other workers
+                return nTime, nonce
+
+
 class CBlock(CBlockHeader):
-    __slots__ = ("vtx",)
+    __slots__ = ("merkle_tree", "vtx")
 
     def __init__(self, header=None):
         super(CBlock, self).__init__(header)
         self.vtx = []
+        self.merkle_tree = None
 
     def deserialize(self, f):
         super(CBlock, self).deserialize(f)
         self.vtx = deser_vector(f, CTransaction)
+        self.merkle_tree = None
+
+    def deserialize_from(self, buf, offset=0):
+        offset = super(CBlock, self).deserialize_from(buf, offset)
+        self.vtx, offset = deser_vector_from(buf, offset, CTransaction)
+        self.merkle_tree = None
+        return offset
 
     def serialize(self):
         r = b""
@@ -522,6 +1136,18 @@ class CBlock(CBlockHeader):
         r += ser_vector(self.vtx)
         return r
 
+    def enable_cache(self):
+        """Opt in to cached serialization and txids for every transaction
+        in the block, see CTransaction.enable_cache(), and keep a MerkleTree
+        so calc_merkle_root() only rehashes the paths of changed txids.
+
+        Transactions added to the block later get their cache enabled the
+        next time the merkle root is computed."""
+        for tx in self.vtx:
+            tx.enable_cache()
+        if self.merkle_tree is None:
+            self.merkle_tree = MerkleTree()
+
     # Calculate the merkle root given a vector of transaction hashes
     def get_merkle_root(self, hashes):
         while len(hashes) > 1:
@@ -532,12 +1158,29 @@ class CBlock(CBlockHeader):
             hashes = newhashes
         return uint256_from_str(hashes[0])
 
-    def calc_merkle_root(self):
+    def get_tx_hashes(self):
         hashes = []
         for tx in self.vtx:
+            if self.merkle_tree is not None and \
+                    not isinstance(tx, _CachedTransaction):
+                tx.enable_cache()
             tx.calc_sha256()
             hashes.append(ser_uint256(tx.sha256))
-        return self.get_merkle_root(hashes)
+        return hashes
+
+    def calc_merkle_root(self):
+        if self.merkle_tree is None:
+            return self.get_merkle_root(self.get_tx_hashes())
+        self.merkle_tree.update(self.get_tx_hashes())
+        return self.merkle_tree.root()
+
+    def get_merkle_tree(self):
+        """Return a MerkleTree in sync with vtx, e.g. to get merkle branches
+        or a CPartialMerkleTree for some of the transactions."""
+        if self.merkle_tree is None:
+            return MerkleTree(self.get_tx_hashes())
+        self.merkle_tree.update(self.get_tx_hashes())
+        return self.merkle_tree
 
     def is_valid(self):
         self.calc_sha256()
@@ -551,12 +1194,32 @@ class CBlock(CBlockHeader):
             return False
         return True
 
-    def solve(self):
+    def solve(self, jobs=1):
+        """Find the lowest nNonce, starting from the current one, for which
+        the block hash meets nBits. When the nonce space is exhausted nTime is
+        bumped and the search restarts at nonce 0.
+
+        With jobs > 1 the nonces are checked in chunks by a pool of that many
+        processes. Chunks are consumed in order, so the result is the same as
+        with the default single process search."""
         self.rehash()
         target = uint256_from_compact(self.nBits)
-        while self.sha256 > target:
-            self.nNonce += 1
-            self.rehash()
+        if self.sha256 <= target:
+            return
+        if jobs > 1:
+            self.nTime, self.nNonce = _solve_parallel(
+                CBlockHeader.serialize(self), target, jobs)
+        else:
+            while True:
+                prefix = CBlockHeader.serialize(self)[:76]
+                nonce = _solve_nonce_range(
+                    prefix, target, self.nNonce, 0x100000000)
+                if nonce is not None:
+                    break
+                self.nTime += 1
+                self.nNonce = 0
+            self.nNonce = nonce
+        self.rehash()
 
     def __repr__(self):
         return "CBlock(nVersion={} hashPrevBlock={:064x} hashMerkleRoot={:064x} nTime={} nBits={:08x} nNonce={:08x} vtx={})".format(
@@ -564,6 +1227,167 @@ class CBlock(CBlockHeader):
             time.ctime(self.nTime), self.nBits, self.nNonce, repr(self.vtx))
 
 
+class LazyBlock(CBlock):
+    """A CBlock that decodes its transactions on demand.
+
+    Deserializing only parses the 80 byte header and records where each
+    transaction starts and ends in the payload; vtx is a LazyTxList. An
+    untouched block re-serializes straight from the original buffer, and its
+    merkle root is computed without building any CTransaction."""
+    __slots__ = ()
+
+    def deserialize(self, f):
+        data = f.read()
+        end = self.deserialize_from(memoryview(data))
+        # Leave the stream positioned right after the block
+        f.seek(end - len(data), 1)
+
+    def deserialize_from(self, buf, offset=0):
+        if isinstance(buf, memoryview) and isinstance(buf.obj, bytes) and \
+                buf.nbytes == len(buf.obj):
+            raw = buf.obj
+        else:
+            raw = bytes(buf)
+        offset = CBlockHeader.deserialize_from(self, raw, offset)
+        nit, offset = deser_compact_size_from(raw, offset)
+        spans = []
+        for i in range(nit):
+            end = tx_end_from(raw, offset)
+            spans.append((offset, end))
+            offset = end
+        self.vtx = LazyTxList(raw, spans)
+        return offset
+
+    def serialize(self):
+        if not isinstance(self.vtx, LazyTxList):
+            return super(LazyBlock, self).serialize()
+        return CBlockHeader.serialize(self) + self.vtx.serialize()
+
+    def get_tx_hashes(self):
+        if not isinstance(self.vtx, LazyTxList):
+            return super(LazyBlock, self).get_tx_hashes()
+        return self.vtx.tx_hashes()
+
+
+# Fixed width layout of an entry in a headers message: an 80 byte header and
+# a zero transaction count.
+_header_entry = struct.Struct("<i32s32sIIIB")
+_HEADER_COLUMNS = ("nVersion", "hashPrevBlock", "hashMerkleRoot", "nTime",
+                   "nBits", "nNonce")
+
+
+class HeaderBatch(MutableSequence):
+    """List of block headers decoded from a headers message into columns.
+
+    The fields of every header are unpacked in one pass into a tuple per
+    field, and block hashes are computed for the whole batch the first time
+    one is needed. A CBlockHeader is only built when an index is accessed.
+    Headers that were never accessed or assigned serialize straight from the
+    buffer. It supports the list operations tests use on
+    msg_headers.headers."""
+    __slots__ = ("_columns", "_hashes", "_headers", "_raw", "_rows")
+
+    def __init__(self, raw=b"", count=0):
+        """Decode the count consecutive 81 byte entries (see _header_entry)
+        making up raw."""
+        self._raw = raw
+        self._columns = tuple(zip(*_header_entry.iter_unpack(raw))) or \
+            ((),) * (len(_HEADER_COLUMNS) + 1)
+        self._hashes = None
+        self._rows = list(range(count))
+        self._headers = [None] * count
+
+    def __len__(self):
+        return len(self._headers)
+
+    def _get_hashes(self):
+        if self._hashes is None:
+            view = memoryview(self._raw)
+            stride = _header_entry.size
+            self._hashes = [hash256(view[i:i + 80])
+                            for i in range(0, len(view), stride)]
+        return self._hashes
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self._headers)))]
+        header = self._headers[i]
+        if header is None:
+            row = self._rows[i]
+            header = CBlockHeader.__new__(CBlockHeader)
+            (header.nVersion, prev, merkle, header.nTime, header.nBits,
+             header.nNonce) = (column[row] for column in self._columns[:6])
+            header.hashPrevBlock = int.from_bytes(prev, 'little')
+            header.hashMerkleRoot = int.from_bytes(merkle, 'little')
+            h = self._get_hashes()[row]
+            header.sha256 = uint256_from_str(h)
+            header.hash = encode(h[::-1], 'hex_codec').decode('ascii')
+            self._headers[i] = header
+        return header
+
+    def __setitem__(self, i, value):
+        if isinstance(i, slice):
+            value = list(value)
+            self._headers[i] = value
+            self._rows[i] = [None] * len(value)
+        else:
+            self._headers[i] = value
+            self._rows[i] = None
+
+    def __delitem__(self, i):
+        del self._headers[i]
+        del self._rows[i]
+
+    def insert(self, i, value):
+        self._headers.insert(i, value)
+        self._rows.insert(i, None)
+
+    def __add__(self, other):
+        return list(self) + list(other)
+
+    def __radd__(self, other):
+        return list(other) + list(self)
+
+    def get_column(self, name):
+        """Return the values of one CBlockHeader field for every header,
+        without building the headers that were not accessed yet."""
+        if name == "sha256":
+            return [uint256_from_str(self._get_hashes()[row])
+                    if header is None else header.sha256
+                    for header, row in zip(self._headers, self._rows)]
+        column = self._columns[_HEADER_COLUMNS.index(name)]
+        if name in ("hashPrevBlock", "hashMerkleRoot"):
+            return [int.from_bytes(column[row], 'little')
+                    if header is None else getattr(header, name)
+                    for header, row in zip(self._headers, self._rows)]
+        return [column[row] if header is None else getattr(header, name)
+                for header, row in zip(self._headers, self._rows)]
+
+    def serialize(self):
+        view = memoryview(self._raw)
+        stride = _header_entry.size
+        r = [ser_compact_size(len(self._headers))]
+        for header, row in zip(self._headers, self._rows):
+            if header is None:
+                r.append(view[row * stride:(row + 1) * stride])
+            else:
+                r.append(CBlockHeader.serialize(header))
+                r.append(b"\x00")
+        return b"".join(r)
+
+    def __repr__(self):
+        # Received headers are logged with repr(msg)[:500]: build only as
+        # many headers as needed to fill that.
+        r = "["
+        for i in range(len(self._headers)):
+            if len(r) > 500:
+                return r + "...]"
+            if i:
+                r += ", "
+            r += repr(self[i])
+        return r + "]"
+
+
 class PrefilledTransaction:
     __slots__ = ("index", "tx")
 
@@ -576,6 +1400,11 @@ class PrefilledTransaction:
         self.tx = CTransaction()
         self.tx.deserialize(f)
 
+    def deserialize_from(self, buf, offset=0):
+        self.index, offset = deser_compact_size_from(buf, offset)
+        self.tx = CTransaction()
+        return self.tx.deserialize_from(buf, offset)
+
     def serialize(self):
         r = b""
         r += ser_compact_size(self.index)
@@ -612,6 +1441,21 @@ class P2PHeaderAndShortIDs:
         self.prefilled_txn = deser_vector(f, PrefilledTransaction)
         self.prefilled_txn_length = len(self.prefilled_txn)
 
+    def deserialize_from(self, buf, offset=0):
+        offset = self.header.deserialize_from(buf, offset)
+        self.nonce = _unpack_uint64(buf, offset)[0]
+        self.shortids_length, offset = deser_compact_size_from(
+            buf, offset + 8)
+        # shortids are 6 bytes on the wire, see deserialize() above
+        end = offset + 6 * self.shortids_length
+        self.shortids.extend(
+            lo | hi << 32 for lo, hi in _iter_unpack_shortids(buf[offset:end]))
+        offset = end
+        self.prefilled_txn, offset = deser_vector_from(
+            buf, offset, PrefilledTransaction)
+        self.prefilled_txn_length = len(self.prefilled_txn)
+        return offset
+
     def serialize(self):
         r = b""
         r += self.header.serialize()
@@ -638,6 +1482,31 @@ def calculate_shortid(k0, k1, tx_hash):
     return expected_shortid
 
 
+def calculate_shortids(k0, k1, tx_hashes):
+    """Return the shortids of a list of tx hashes, see siphash256_batch()."""
+    return [shortid & 0x0000ffffffffffff
+            for shortid in siphash256_batch(k0, k1, tx_hashes)]
+
+
+def shortid_index(k0, k1, tx_hashes):
+    """Map the shortid of each tx hash to its index in tx_hashes, e.g. to
+    find the mempool transactions a compact block refers to.
+
+    Returns (index, collisions). Shortids shared by several hashes can't be
+    resolved: they are left out of index, and collisions maps them to the
+    list of indexes of all the hashes sharing them."""
+    index = {}
+    collisions = {}
+    for i, shortid in enumerate(calculate_shortids(k0, k1, tx_hashes)):
+        if shortid in collisions:
+            collisions[shortid].append(i)
+        elif shortid in index:
+            collisions[shortid] = [index.pop(shortid), i]
+        else:
+            index[shortid] = i
+    return index, collisions
+
+
 # This version gets rid of the array lengths, and reinterprets the differential
 # encoding into indices that can be used for lookup.
 class HeaderAndShortIDs:
@@ -688,12 +1557,19 @@ class HeaderAndShortIDs:
         self.nonce = nonce
         self.prefilled_txn = [PrefilledTransaction(i, block.vtx[i])
                               for i in prefill_list]
-        self.shortids = []
         [k0, k1] = self.get_siphash_keys()
-        for i in range(len(block.vtx)):
-            if i not in prefill_list:
-                tx_hash = block.vtx[i].sha256
-                self.shortids.append(calculate_shortid(k0, k1, tx_hash))
+        prefilled = set(prefill_list)
+        self.shortids = calculate_shortids(
+            k0, k1, [tx.sha256 for i, tx in enumerate(block.vtx)
+                     if i not in prefilled])
+
+    def get_tx_indexes(self, tx_hashes):
+        """Return, for each shortid, the index in tx_hashes of the
+        transaction it refers to, or None when there is no unambiguous match
+        and the transaction would have to be requested with getblocktxn."""
+        [k0, k1] = self.get_siphash_keys()
+        index, _ = shortid_index(k0, k1, tx_hashes)
+        return [index.get(shortid) for shortid in self.shortids]
 
     def __repr__(self):
         return "HeaderAndShortIDs(header={}, nonce={}, shortids={}, prefilledtxn={}".format(
@@ -995,6 +1871,9 @@ class msg_tx:
     def deserialize(self, f):
         self.tx.deserialize(f)
 
+    def deserialize_from(self, buf, offset=0):
+        return self.tx.deserialize_from(buf, offset)
+
     def serialize(self):
         return self.tx.serialize()
 
@@ -1015,6 +1894,9 @@ class msg_block:
     def deserialize(self, f):
         self.block.deserialize(f)
 
+    def deserialize_from(self, buf, offset=0):
+        return self.block.deserialize_from(buf, offset)
+
     def serialize(self):
         return self.block.serialize()
 
@@ -1022,6 +1904,14 @@ class msg_block:
         return "msg_block(block={})".format(repr(self.block))
 
 
+class msg_lazy_block(msg_block):
+    """A block message whose block is a LazyBlock."""
+    __slots__ = ()
+
+    def __init__(self, block=None):
+        super().__init__(LazyBlock() if block is None else block)
+
+
 # for cases where a user needs tighter control over what is sent over the wire
 # note that the user must supply the name of the command, and the data
 
@@ -1189,9 +2079,28 @@ class msg_headers:
         for x in blocks:
             self.headers.append(CBlockHeader(x))
 
+    def deserialize_from(self, buf, offset=0):
+        nit, start = deser_compact_size_from(buf, offset)
+        end = start + nit * _header_entry.size
+        raw = bytes(buf[start:end])
+        # Every entry should be a header followed by a zero tx count
+        if len(raw) == end - start and not any(raw[80::_header_entry.size]):
+            self.headers = HeaderBatch(raw, nit)
+            return end
+        # Otherwise decode them as blocks
+        blocks, offset = deser_vector_from(buf, offset, CBlock)
+        for x in blocks:
+            self.headers.append(CBlockHeader(x))
+        return offset
+
     def serialize(self):
-        blocks = [CBlock(x) for x in self.headers]
-        return ser_vector(blocks)
+        if isinstance(self.headers, HeaderBatch):
+            return self.headers.serialize()
+        r = [ser_compact_size(len(self.headers))]
+        for x in self.headers:
+            r.append(CBlockHeader.serialize(x))
+            r.append(b"\x00")
+        return b"".join(r)
 
     def __repr__(self):
         return "msg_headers(headers={})".format(repr(self.headers))
@@ -1283,6 +2192,10 @@ class msg_cmpctblock:
         self.header_and_shortids = P2PHeaderAndShortIDs()
         self.header_and_shortids.deserialize(f)
 
+    def deserialize_from(self, buf, offset=0):
+        self.header_and_shortids = P2PHeaderAndShortIDs()
+        return self.header_and_shortids.deserialize_from(buf, offset)
+
     def serialize(self):
         r = b""
         r += self.header_and_shortids.serialize()
@@ -13,21 +13,24 @@ P2PConnection: A low-level connection object to a node's P2P interface
 P2PInterface: A high-level interface object for communicating to a node over P2P
 P2PDataStore: A p2p interface class that keeps a store of transactions and blocks
               and can respond correctly to getdata and getheaders messages"""
-import asyncore
-from collections import defaultdict
+import asyncio
+from collections import defaultdict, deque, OrderedDict
 from io import BytesIO
 import logging
 import socket
 import struct
 import sys
 import threading
+import time
 
+from test_framework.blockstore import HeaderIndex
 from test_framework.messages import (
     CBlockHeader,
     MIN_VERSION_SUPPORTED,
     msg_addr,
     msg_block,
     MSG_BLOCK,
+    msg_lazy_block,
     msg_blocktxn,
     msg_cmpctblock,
     msg_feefilter,
@@ -35,6 +38,7 @@ from test_framework.messages import (
     msg_getblocks,
     msg_getblocktxn,
     msg_getdata,
+    msg_generic,
     msg_getheaders,
     msg_headers,
     msg_inv,
@@ -54,13 +58,17 @@ from test_framework.messages import (
     READ_BUFFER_SIZE,
     sha256,
 )
+from test_framework.p2pcapture import CAPTURE_RECV, CAPTURE_SEND
+from test_framework.p2pmetrics import P2PMetrics
 from test_framework.util import wait_until
 
 logger = logging.getLogger("TestFramework.mininode")
 
 MESSAGEMAP = {
     b"addr": msg_addr,
-    b"block": msg_block,
+    # Most handlers only look at the header of received blocks, so decode
+    # their transactions on demand.
+    b"block": msg_lazy_block,
     b"blocktxn": msg_blocktxn,
     b"cmpctblock": msg_cmpctblock,
     b"feefilter": msg_feefilter,
@@ -90,7 +98,171 @@ MAGIC_BYTES = {
 }
 
 
-class P2PConnection(asyncore.dispatcher):
+# Layout of a P2P message header: magic, command, payload length, checksum
+MSG_HEADER = struct.Struct("<4s12sI4s")
+
+# Maximum number of headers in a headers message
+MAX_HEADERS_RESULTS = 2000
+
+# Pings that acknowledge blocks sent by P2PDataStore.stream_blocks() have
+# this bit set in their nonce, the rest of the nonce is the block's number
+STREAM_PING_FLAG = 1 << 63
+
+# Total size of the framed blocks and transactions that P2PDataStore keeps
+# around to resend
+MAX_FRAMED_CACHE_SIZE = 64 * 1000000
+
+
+class FramedMessage():
+    """A P2P message that is serialized and checksummed only once.
+
+    It can be passed to send_message() of any number of connections instead
+    of the message itself. The message must not be modified once it has
+    been sent.
+
+    data is the serialized message, if the caller already has it."""
+    __slots__ = ("_data", "_frames", "_repr", "message")
+
+    def __init__(self, message, data=None):
+        self.message = message
+        self._data = data
+        # network -> framed message
+        self._frames = {}
+        self._repr = None
+
+    def frame(self, network):
+        """Return the message framed for the given network."""
+        frame = self._frames.get(network)
+        if frame is None:
+            if self._frames:
+                # Only the magic differs between networks
+                other = next(iter(self._frames.values()))
+                frame = MAGIC_BYTES[network] + other[4:]
+            else:
+                command = self.message.command
+                data = self._data
+                if data is None:
+                    data = self.message.serialize()
+                self._data = None
+                checksum = sha256(sha256(data))[:4]
+                frame = b"".join((MSG_HEADER.pack(
+                    MAGIC_BYTES[network], command, len(data), checksum), data))
+            self._frames[network] = frame
+        return frame
+
+    def matches(self, data):
+        """Whether the framed message is the serialized message data."""
+        frame = next(iter(self._frames.values()), None)
+        if frame is None:
+            return False
+        return memoryview(frame)[MSG_HEADER.size:] == data
+
+    def __repr__(self):
+        # Connections log the message every time it is sent, only the
+        # beginning of it is logged
+        if self._repr is None:
+            self._repr = repr(self.message)[:500]
+        return self._repr
+
+
+class FramedMessageCache():
+    """A cache of FramedMessages for blocks and transactions.
+
+    Entries are keyed by message type and hash, and only used for the same
+    block or transaction object they were created for, as long as its
+    serialization didn't change: tests often modify a block or transaction
+    without calling rehash(). This saves the checksum and the copies, and
+    the serialization too for transactions and blocks with enable_cache().
+    The least recently used entries are evicted once the framed messages
+    take up more than max_size bytes."""
+
+    def __init__(self, max_size=MAX_FRAMED_CACHE_SIZE):
+        self.max_size = max_size
+        self.size = 0
+        # (command, hash) -> (obj, FramedMessage, size)
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, message_class, obj, network):
+        """Return a FramedMessage of message_class(obj) framed for network."""
+        key = (message_class.command, obj.sha256)
+        message = message_class(obj)
+        data = message.serialize()
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None or entry[0] is not obj or \
+                    not entry[1].matches(data):
+                if entry is not None:
+                    self.size -= entry[2]
+                entry = (obj, FramedMessage(message, data), 0)
+            _, framed, old_size = entry
+            framed.frame(network)
+            size = sum(len(frame) for frame in framed._frames.values())
+            self._entries[key] = (obj, framed, size)
+            self.size += size - old_size
+            while self.size > self.max_size and len(self._entries) > 1:
+                _, (_, _, evicted_size) = self._entries.popitem(last=False)
+                self.size -= evicted_size
+            return framed
+
+
+class ByteBuffer():
+    """FIFO byte buffer with amortized O(1) append and consume.
+
+    Bytes live in a preallocated bytearray between a start and an end offset.
+    Consuming only moves the start offset. Appending writes after the end
+    offset, and when there is no room left the live bytes are either moved
+    back to the front (if at least as many bytes were consumed) or copied to
+    a bytearray twice as large."""
+    __slots__ = ("_buf", "_end", "_start")
+
+    def __init__(self, size=READ_BUFFER_SIZE):
+        self._buf = bytearray(size)
+        self._start = 0
+        self._end = 0
+
+    def __len__(self):
+        return self._end - self._start
+
+    def __bytes__(self):
+        return bytes(self._buf[self._start:self._end])
+
+    def view(self):
+        """Return a memoryview of the buffered bytes. It is invalidated by the
+        next append() or consume()."""
+        return memoryview(self._buf)[self._start:self._end]
+
+    def reserve(self, size):
+        """Make room for at least size buffered bytes in total."""
+        length = self._end - self._start
+        if len(self._buf) - self._start >= size:
+            return
+        if self._start >= length and len(self._buf) >= size:
+            # Compact: the copy costs no more than what was consumed
+            self._buf[:length] = self._buf[self._start:self._end]
+        else:
+            buf = bytearray(max(size, 2 * len(self._buf)))
+            buf[:length] = self._buf[self._start:self._end]
+            self._buf = buf
+        self._start = 0
+        self._end = length
+
+    def append(self, data):
+        n = len(data)
+        self.reserve(len(self) + n)
+        self._buf[self._end:self._end + n] = data
+        self._end += n
+
+    def consume(self, n):
+        self._start += n
+        if self._start >= self._end:
+            self._start = self._end = 0
+
+    def clear(self):
+        self._start = self._end = 0
+
+
+class P2PConnection(asyncio.Protocol):
     """A low-level connection object to a node's P2P interface.
 
     This class is responsible for:
@@ -100,6 +272,10 @@ class P2PConnection(asyncore.dispatcher):
     - deserializing and serializing the P2P message header
     - logging messages as they are sent and received
 
+    The connection is an asyncio protocol driven by the event loop of the
+    NetworkThread. Messages sent from other threads are handed over to the
+    event loop with call_soon_threadsafe().
+
     This class contains no logic for handing the P2P message payloads. It must be
     sub-classed and the on_message() callback overridden."""
 
@@ -108,15 +284,21 @@ class P2PConnection(asyncore.dispatcher):
         # assert that the network thread is not running.
         assert not network_thread_running()
 
-        super().__init__(map=mininode_socket_map)
+        self._transport = None
+        self._loop = None
 
-    def peer_connect(self, dstaddr, dstport, net="regtest"):
+    def peer_connect(self, dstaddr, dstport, net="regtest", capture=None):
         self.dstaddr = dstaddr
         self.dstport = dstport
-        self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
-        self.sendbuf = b""
-        self.recvbuf = b""
+        # A P2PCapture that every framed message sent and received is
+        # recorded to
+        self.capture = capture
+        self.metrics = P2PMetrics()
+        self.recvbuf = ByteBuffer()
+        # Messages pushed before the connection is open
+        self.sendbuf = []
+        # Protects state, sendbuf and _transport against the test logic thread
+        self._send_lock = threading.Lock()
         self.state = "connecting"
         self.network = net
         self.disconnect = False
@@ -124,10 +306,8 @@ class P2PConnection(asyncore.dispatcher):
         logger.debug('Connecting to Bitcoin Node: {}:{}'.format(
             self.dstaddr, self.dstport))
 
-        try:
-            self.connect((dstaddr, dstport))
-        except:
-            self.handle_close()
+        # The NetworkThread opens the connection when it starts
+        mininode_socket_map[id(self)] = self
 
     def peer_disconnect(self):
         # Connection could have already been closed by other end.
@@ -136,42 +316,78 @@ class P2PConnection(asyncore.dispatcher):
 
     # Connection and disconnection methods
 
-    def handle_connect(self):
-        """asyncore callback when a connection is opened."""
-        if self.state != "connected":
-            logger.debug("Connected & Listening: {}:{}".format(
-                self.dstaddr, self.dstport))
+    def start_connection(self, loop):
+        """Open the connection from the event loop of the NetworkThread."""
+        self._loop = loop
+        task = loop.create_task(loop.create_connection(
+            lambda: self, self.dstaddr, self.dstport))
+        task.add_done_callback(self._connection_done)
+
+    def _connection_done(self, task):
+        if not task.cancelled() and task.exception() is not None:
+            logger.debug("Could not connect to {}:{}: {}".format(
+                self.dstaddr, self.dstport, task.exception()))
+            self.connection_lost(task.exception())
+
+    def connection_made(self, transport):
+        """asyncio callback when a connection is opened."""
+        logger.debug("Connected & Listening: {}:{}".format(
+            self.dstaddr, self.dstport))
+        sock = transport.get_extra_info('socket')
+        if sock.family in (socket.AF_INET, socket.AF_INET6):
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        with self._send_lock:
+            self._transport = transport
             self.state = "connected"
+            pending = b"".join(self.sendbuf)
+            self.sendbuf = []
+        if pending:
+            transport.write(pending)
+            self.metrics.written(
+                len(pending), transport.get_write_buffer_size())
+        if self.disconnect:
+            transport.abort()
+            return
+        with mininode_lock:
             self.on_open()
+            mininode_lock.notify_all()
 
-    def handle_close(self):
-        """asyncore callback when a connection is closed."""
+    def connection_lost(self, exc):
+        """asyncio callback when a connection is closed."""
         logger.debug("Closing connection to: {}:{}".format(
             self.dstaddr, self.dstport))
-        self.state = "closed"
-        self.recvbuf = b""
-        self.sendbuf = b""
-        try:
-            self.close()
-        except:
-            pass
-        self.on_close()
+        with self._send_lock:
+            self.state = "closed"
+            self._transport = None
+            self.sendbuf = []
+        self.metrics.close()
+        self.recvbuf.clear()
+        with mininode_lock:
+            self.on_close()
+            mininode_lock.notify_all()
+        mininode_socket_map.pop(id(self), None)
+        if not mininode_socket_map:
+            self._loop.stop()
 
     def disconnect_node(self):
         """Disconnect the p2p connection.
 
         Called by the test logic thread. Causes the p2p connection
-        to be disconnected on the next iteration of the asyncore loop."""
-        self.disconnect = True
+        to be disconnected on the next iteration of the event loop."""
+        with self._send_lock:
+            self.disconnect = True
+            if self._transport is not None:
+                self._loop.call_soon_threadsafe(self._abort)
+
+    def _abort(self):
+        if self._transport is not None:
+            self._transport.abort()
 
     # Socket read methods
 
-    def handle_read(self):
-        """asyncore callback when data is read from the socket."""
-        with mininode_lock:
-            t = self.recv(READ_BUFFER_SIZE)
-            if len(t) > 0:
-                self.recvbuf += t
+    def data_received(self, data):
+        """asyncio callback when data is read from the socket."""
+        self.recvbuf.append(data)
 
         while True:
             msg = self._on_data()
@@ -186,32 +402,42 @@ class P2PConnection(asyncore.dispatcher):
         parses and verifies the P2P header, then passes the P2P payload to
         the on_message callback for processing."""
         try:
-            with mininode_lock:
-                if len(self.recvbuf) < 4:
-                    return None
-                if self.recvbuf[:4] != MAGIC_BYTES[self.network]:
-                    raise ValueError(
-                        "got garbage {}".format(repr(self.recvbuf)))
-                if len(self.recvbuf) < 4 + 12 + 4 + 4:
-                    return
-                command = self.recvbuf[4:4+12].split(b"\x00", 1)[0]
-                msglen = struct.unpack("<i", self.recvbuf[4+12:4+12+4])[0]
-                checksum = self.recvbuf[4+12+4:4+12+4+4]
-                if len(self.recvbuf) < 4 + 12 + 4 + 4 + msglen:
-                    return
-                msg = self.recvbuf[4+12+4+4:4+12+4+4+msglen]
-                h = sha256(sha256(msg))
-                if checksum != h[:4]:
-                    raise ValueError("got bad checksum " + repr(self.recvbuf))
-                self.recvbuf = self.recvbuf[4+12+4+4+msglen:]
-                if command not in MESSAGEMAP:
-                    raise ValueError("Received unknown command from {}:{}: '{}' {}".format(
-                        self.dstaddr, self.dstport, command, repr(msg)))
-                f = BytesIO(msg)
-                m = MESSAGEMAP[command]()
-                m.deserialize(f)
-                self._log_message("receive", m)
-                return m
+            if len(self.recvbuf) < 4:
+                return None
+            data = self.recvbuf.view()
+            if data[:4] != MAGIC_BYTES[self.network]:
+                raise ValueError(
+                    "got garbage {}".format(repr(bytes(self.recvbuf))))
+            if len(data) < MSG_HEADER.size:
+                return
+            _, command, msglen, checksum = MSG_HEADER.unpack_from(data)
+            command = command.split(b"\x00", 1)[0]
+            if len(data) < MSG_HEADER.size + msglen:
+                # Make room for the whole message at once
+                self.recvbuf.reserve(MSG_HEADER.size + msglen)
+                return
+            msg = bytes(data[MSG_HEADER.size:MSG_HEADER.size + msglen])
+            h = sha256(sha256(msg))
+            if checksum != h[:4]:
+                raise ValueError(
+                    "got bad checksum " + repr(bytes(self.recvbuf)))
+            if self.capture is not None:
+                self.capture.record(
+                    CAPTURE_RECV, data[:MSG_HEADER.size + msglen])
+            self.recvbuf.consume(MSG_HEADER.size + msglen)
+            if command not in MESSAGEMAP:
+                raise ValueError("Received unknown command from {}:{}: '{}' {}".format(
+                    self.dstaddr, self.dstport, command, repr(msg)))
+            time0 = time.perf_counter()
+            m = MESSAGEMAP[command]()
+            if hasattr(m, "deserialize_from"):
+                m.deserialize_from(memoryview(msg))
+            else:
+                m.deserialize(BytesIO(msg))
+            self.metrics.received(command.decode('ascii'), MSG_HEADER.size + msglen,
+                                  time.perf_counter() - time0, m)
+            self._log_message("receive", m)
+            return m
         except Exception as e:
             logger.exception('Error reading message:', repr(e))
             raise
@@ -222,32 +448,9 @@ class P2PConnection(asyncore.dispatcher):
 
     # Socket write methods
 
-    def writable(self):
-        """asyncore method to determine whether the handle_write() callback should be called on the next loop."""
-        with mininode_lock:
-            pre_connection = self.state == "connecting"
-            length = len(self.sendbuf)
-        return (length > 0 or pre_connection)
-
-    def handle_write(self):
-        """asyncore callback when data should be written to the socket."""
-        with mininode_lock:
-            # asyncore does not expose socket connection, only the first read/write
-            # event, thus we must check connection manually here to know when we
-            # actually connect
-            if self.state == "connecting":
-                self.handle_connect()
-            if not self.writable():
-                return
-
-            try:
-                sent = self.send(self.sendbuf)
-            except:
-                self.handle_close()
-                return
-            self.sendbuf = self.sendbuf[sent:]
-
     def format_message(self, message):
+        if isinstance(message, FramedMessage):
+            return message.frame(self.network)
         command = message.command
         data = message.serialize()
         tmsg = MAGIC_BYTES[self.network]
@@ -264,11 +467,15 @@ class P2PConnection(asyncore.dispatcher):
         """Send a P2P message over the socket.
 
         This method takes a P2P payload, builds the P2P header and adds
-        the message to the send buffer to be sent over the socket."""
+        the message to the send buffer to be sent over the socket. The
+        payload can also be a FramedMessage, which is framed only once."""
         if self.state != "connected" and not pushbuf:
             raise IOError('Not connected, no pushbuf')
         self._log_message("send", message)
         tmsg = self.format_message(message)
+        if isinstance(message, FramedMessage):
+            message = message.message
+        self.metrics.expect_response(message)
         self.send_raw_message(tmsg, pushbuf)
 
     def send_raw_message(self, tmsg, pushbuf=False):
@@ -278,15 +485,21 @@ class P2PConnection(asyncore.dispatcher):
         socket."""
         if self.state != "connected" and not pushbuf:
             raise IOError('Not connected, no pushbuf')
-        with mininode_lock:
-            if (len(self.sendbuf) == 0 and not pushbuf):
-                try:
-                    sent = self.send(tmsg)
-                    self.sendbuf = tmsg[sent:]
-                except BlockingIOError:
-                    self.sendbuf = tmsg
+        if self.capture is not None:
+            self.capture.record(CAPTURE_SEND, tmsg)
+        self.metrics.sent(tmsg[4:16].split(b"\x00", 1)[0].decode(
+            'ascii', 'backslashreplace'), len(tmsg))
+        with self._send_lock:
+            if self._transport is not None:
+                self._loop.call_soon_threadsafe(self._write, tmsg)
             else:
-                self.sendbuf += tmsg
+                self.sendbuf.append(tmsg)
+
+    def _write(self, tmsg):
+        if self._transport is not None:
+            self._transport.write(tmsg)
+            self.metrics.written(
+                len(tmsg), self._transport.get_write_buffer_size())
 
     # Class utility methods
 
@@ -357,6 +570,7 @@ class P2PInterface(P2PConnection):
                 print("ERROR delivering {} ({})".format(
                     repr(message), sys.exc_info()[0]))
                 raise
+            mininode_lock.notify_all()
 
     # Callback methods. Can be overridden by subclasses in individual test
     # cases to provide custom message handling behaviour.
@@ -489,18 +703,21 @@ class P2PInterface(P2PConnection):
         self.ping_counter += 1
 
 
-# Keep our own socket map for asyncore, so that we can track disconnects
-# ourselves (to workaround an issue with closing an asyncore socket when
-# using select)
+# The connections the NetworkThread opens and serves, keyed by id(). A
+# connection removes itself when it is closed, and the NetworkThread exits
+# once there are none left.
 mininode_socket_map = dict()
 
 # One lock for synchronizing all data access between the networking thread (see
 # NetworkThread below) and the thread running the test logic.  For simplicity,
-# P2PConnection acquires this lock whenever delivering a message to a P2PInterface,
-# and whenever adding anything to the send buffer (in send_message()).  This
-# lock should be acquired in the thread running the test logic to synchronize
-# access to any data shared with the P2PInterface or P2PConnection.
-mininode_lock = threading.RLock()
+# P2PInterface acquires this lock whenever delivering a message.  Sending only
+# takes a per-connection lock.  This lock should be acquired in the thread
+# running the test logic to synchronize access to any data shared with the
+# P2PInterface or P2PConnection.
+# It is a condition variable, notified whenever a P2PInterface receives a
+# message or a connection opens or closes, so that wait_until() can wake up
+# as soon as that happens.
+mininode_lock = threading.Condition(threading.RLock())
 
 
 class NetworkThread(threading.Thread):
@@ -508,16 +725,13 @@ class NetworkThread(threading.Thread):
         super().__init__(name="NetworkThread")
 
     def run(self):
-        while mininode_socket_map:
-            # We check for whether to disconnect outside of the asyncore
-            # loop to workaround the behavior of asyncore when using
-            # select
-            disconnected = []
-            for fd, obj in mininode_socket_map.items():
-                if obj.disconnect:
-                    disconnected.append(obj)
-            [obj.handle_close() for obj in disconnected]
-            asyncore.loop(0.1, use_poll=True, map=mininode_socket_map, count=1)
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        for conn in list(mininode_socket_map.values()):
+            conn.start_connection(loop)
+        if mininode_socket_map:
+            loop.run_forever()
+        loop.close()
         logger.debug("Network thread closing")
 
 
@@ -549,31 +763,81 @@ def network_thread_join(timeout=10):
 class P2PDataStore(P2PInterface):
     """A P2P data store class.
 
-    Keeps a block and transaction store and responds correctly to getdata and getheaders requests."""
+    Keeps a block and transaction store and responds correctly to getdata and getheaders requests.
+
+    Blocks and transactions are sent as FramedMessages from a cache shared by
+    all P2PDataStores, so that sending them again, or from another
+    connection, doesn't serialize them again."""
+
+    framed_cache = FramedMessageCache()
 
     def __init__(self):
         super().__init__()
         # store of blocks. key is block hash, value is a CBlock object
         self.block_store = {}
         self.last_block_hash = ''
+        # headers of the blocks in block_store, the active chain ends at
+        # last_block_hash
+        self.header_index = HeaderIndex()
         # store of txs. key is txid, value is a CTransaction object
         self.tx_store = {}
         self.getdata_requests = []
+        # While stream_blocks() runs: the maximum number of blocks in flight,
+        # the number of blocks sent and the number the node has processed,
+        # the hashes of the blocks sent, and the requested blocks waiting
+        # for room in the window
+        self.stream_window = None
+        self.stream_sent = 0
+        self.stream_acked = 0
+        self.stream_served = set()
+        self.stream_deferred = deque()
+
+    def on_pong(self, message):
+        if message.nonce & STREAM_PING_FLAG:
+            self.stream_acked = max(
+                self.stream_acked, message.nonce & ~STREAM_PING_FLAG)
+            self._stream_deferred_blocks()
 
     def on_getdata(self, message):
-        """Check for the tx/block in our stores and if found, reply with an inv message."""
+        """Check for the tx/block in our stores and if found, reply with an inv message.
+
+        While stream_blocks() runs, blocks are only sent as long as the window
+        of blocks in flight isn't full, the others when the node catches up."""
         for inv in message.inv:
             self.getdata_requests.append(inv.hash)
             if (inv.type & MSG_TYPE_MASK) == MSG_TX and inv.hash in self.tx_store.keys():
-                self.send_message(msg_tx(self.tx_store[inv.hash]))
+                self.send_message(self.framed_cache.get(
+                    msg_tx, self.tx_store[inv.hash], self.network))
             elif (inv.type & MSG_TYPE_MASK) == MSG_BLOCK and inv.hash in self.block_store.keys():
-                self.send_message(msg_block(self.block_store[inv.hash]))
+                if self.stream_window is None:
+                    self.send_message(self.framed_cache.get(
+                        msg_block, self.block_store[inv.hash], self.network))
+                elif inv.hash not in self.stream_served:
+                    self.stream_deferred.append(inv.hash)
             else:
                 logger.debug(
                     'getdata message type {} received.'.format(hex(inv.type)))
+        self._stream_deferred_blocks()
+
+    def _stream_block(self, blockhash):
+        """Send a block from stream_blocks(), followed by a ping that tells
+        when the node has processed it. Must be called with mininode_lock."""
+        self.send_message(self.framed_cache.get(
+            msg_block, self.block_store[blockhash], self.network))
+        self.stream_served.add(blockhash)
+        self.stream_sent += 1
+        self.send_message(msg_ping(nonce=STREAM_PING_FLAG | self.stream_sent))
+
+    def _stream_deferred_blocks(self):
+        """Send the requested blocks that fit in the stream window."""
+        while self.stream_deferred and self.stream_window is not None and \
+                self.stream_sent - self.stream_acked < self.stream_window:
+            blockhash = self.stream_deferred.popleft()
+            if blockhash not in self.stream_served:
+                self._stream_block(blockhash)
 
     def on_getheaders(self, message):
-        """Search back through our block store for the locator, and reply with a headers message if found."""
+        """Find the locator in our header index, and reply with a headers message if found."""
 
         locator, hash_stop = message.locator, message.hashstop
 
@@ -581,30 +845,27 @@ class P2PDataStore(P2PInterface):
         if not self.block_store:
             return
 
-        headers_list = [self.block_store[self.last_block_hash]]
-        maxheaders = 2000
-        while headers_list[-1].sha256 not in locator.vHave:
-            # Walk back through the block store, adding headers to headers_list
-            # as we go.
-            prev_block_hash = headers_list[-1].hashPrevBlock
-            if prev_block_hash in self.block_store:
-                prev_block_header = CBlockHeader(
-                    self.block_store[prev_block_hash])
-                headers_list.append(prev_block_header)
-                if prev_block_header.sha256 == hash_stop:
-                    # if this is the hashstop header, stop here
-                    break
-            else:
-                logger.debug('block hash {} not found in block store'.format(
-                    hex(prev_block_hash)))
-                break
-
-        # Truncate the list if there are too many headers
-        headers_list = headers_list[:-maxheaders - 1:-1]
-        response = msg_headers(headers_list)
-
-        if response is not None:
-            self.send_message(response)
+        if not self.sync_header_index():
+            return
+        self.send_message(msg_generic(
+            b"headers", self.header_index.serialized_headers_for(locator, hash_stop)))
+
+    def sync_header_index(self):
+        """Add the blocks in block_store leading to last_block_hash to the
+        header index, and make last_block_hash its tip.
+
+        Returns False if last_block_hash is not in block_store."""
+        missing = []
+        blockhash = self.last_block_hash
+        while blockhash not in self.header_index and blockhash in self.block_store:
+            missing.append(self.block_store[blockhash])
+            blockhash = missing[-1].hashPrevBlock
+        for block in reversed(missing):
+            self.header_index.add(block)
+        if self.last_block_hash not in self.header_index:
+            return False
+        self.header_index.set_tip(self.last_block_hash)
+        return True
 
     def send_blocks_and_test(self, blocks, node, *, success=True, request_block=True, reject_reason=None, expect_disconnect=False, timeout=60):
         """Send blocks to test node and test whether the tip advances.
@@ -642,6 +903,83 @@ class P2PDataStore(P2PInterface):
             else:
                 assert node.getbestblockhash() != blocks[-1].hash
 
+    def stream_blocks(self, blocks, node, *, window=16, push=True, timeout=60):
+        """Stream a chain of blocks to the node and return how fast its tip
+        advanced.
+
+         - blocks is an iterable of blocks, each building on the previous one
+         - the blocks are added to our block_store, and their headers are
+           announced in batches of MAX_HEADERS_RESULTS
+         - if push is True, the blocks of each batch are also sent without
+           waiting for getdata, unless the node requested them first
+         - every block sent, pushed or requested, is followed by a ping, and
+           at most window blocks are sent ahead of the last one the node
+           answered the ping for. The on_getdata handler holds back the
+           requests of the node that don't fit in the window.
+         - wait until the node's tip is the last block, and return the number
+           of blocks and bytes, the duration and the blocks/s and MB/s rates"""
+        start = time.monotonic()
+        count = 0
+        size = 0
+        last_block = None
+        with mininode_lock:
+            self.stream_window = window
+            self.stream_sent = 0
+            self.stream_acked = 0
+
+        try:
+            batch = []
+            blocks = iter(blocks)
+            while True:
+                block = next(blocks, None)
+                if block is not None:
+                    batch.append(block)
+                    if len(batch) < MAX_HEADERS_RESULTS:
+                        continue
+                if not batch:
+                    break
+
+                with mininode_lock:
+                    for block in batch:
+                        self.block_store[block.sha256] = block
+                        self.last_block_hash = block.sha256
+                        size += len(self.framed_cache.get(
+                            msg_block, block, self.network).frame(
+                                self.network)) - MSG_HEADER.size
+                self.send_message(
+                    msg_headers([CBlockHeader(b) for b in batch]))
+                count += len(batch)
+                for block in batch:
+                    if not push:
+                        break
+                    wait_until(lambda: self.stream_sent - self.stream_acked < window,
+                               timeout=timeout, lock=mininode_lock)
+                    with mininode_lock:
+                        if block.sha256 not in self.stream_served:
+                            self._stream_block(block.sha256)
+                last_block = batch[-1]
+                batch = []
+
+            if last_block is None:
+                return None
+            wait_until(lambda: node.getbestblockhash() == last_block.hash,
+                       timeout=timeout)
+            wait_until(lambda: self.stream_acked == self.stream_sent,
+                       timeout=timeout, lock=mininode_lock)
+        finally:
+            with mininode_lock:
+                self.stream_window = None
+                self.stream_served.clear()
+                self.stream_deferred.clear()
+        duration = time.monotonic() - start
+        return {
+            "blocks": count,
+            "bytes": size,
+            "duration": duration,
+            "blocks_per_second": count / duration,
+            "mb_per_second": size / duration / 1000000,
+        }
+
     def send_txs_and_test(self, txs, node, *, success=True, expect_disconnect=False, reject_reason=None):
         """Send txs to test node and test whether they're accepted to the mempool.
 
@@ -658,7 +996,8 @@ class P2PDataStore(P2PInterface):
         reject_reason = [reject_reason] if reject_reason else []
         with node.assert_debug_log(expected_msgs=reject_reason):
             for tx in txs:
-                self.send_message(msg_tx(tx))
+                self.send_message(
+                    self.framed_cache.get(msg_tx, tx, self.network))
 
             if expect_disconnect:
                 self.wait_for_disconnect()
@@ -0,0 +1,43 @@
+#!/usr/bin/env python3
+# Copyright (c) 2019 The Bitcoin developers
+# Distributed under the MIT software license, see the accompanying
+# file COPYING or http://www.opensource.org/licenses/mit-license.php.
+"""OpenSSL library loaded on first use.
+
+key.py and schnorr.py call into libssl through ctypes. Finding and loading
+the library, and declaring the function prototypes, is done the first time
+one of its functions is used instead of when the module is imported, so
+that tests which never sign or verify anything don't pay for it."""
+
+import threading
+
+
+class LazyLibrary():
+    """Proxy to the OpenSSL library, which is loaded, and passed to
+    declare(library) to set up the function prototypes, when the first
+    attribute is looked up."""
+
+    def __init__(self, declare):
+        self._declare = declare
+        self._library = None
+        self._lock = threading.Lock()
+
+    @property
+    def loaded(self):
+        return self._library is not None
+
+    def load(self):
+        with self._lock:
+            if self._library is None:
+                # ctypes.util is slow to import, and find_library() may run
+                # ldconfig or a compiler
+                import ctypes
+                import ctypes.util
+                library = ctypes.cdll.LoadLibrary(
+                    ctypes.util.find_library('ssl') or 'libeay32')
+                self._declare(library)
+                self._library = library
+        return self._library
+
+    def __getattr__(self, name):
+        return getattr(self._library or self.load(), name)
@@ -0,0 +1,114 @@
+#!/usr/bin/env python3
+# Copyright (c) 2019 The Bitcoin developers
+# Distributed under the MIT software license, see the accompanying
+# file COPYING or http://www.opensource.org/licenses/mit-license.php.
+"""P2P traffic capture files.
+
+A capture file starts with CAPTURE_MAGIC, followed by records made of a
+CAPTURE_RECORD header holding a timestamp in nanoseconds, a direction and a
+length, then that many bytes of data.
+
+Every P2PCapture opened on a file first writes a CAPTURE_SESSION record,
+with the wall clock time as timestamp and no data. It is followed by one
+record per framed P2P message, holding the time.monotonic() nanoseconds
+since the session record and the message itself, including its P2P header.
+Several processes can append sessions to the same file without mixing up
+their monotonic clocks.
+
+P2PCapture appends to a capture file and read_capture() iterates over one.
+Pass a P2PCapture to P2PConnection.peer_connect() to record a connection,
+and use loadgen.CaptureReplayer to feed a capture back into a node."""
+
+import os
+import struct
+import threading
+import time
+
+CAPTURE_MAGIC = b"P2PCAP\x00\x02"
+CAPTURE_RECORD = struct.Struct("<QBI")
+
+# Record directions, seen from the test framework
+CAPTURE_RECV = 0
+CAPTURE_SEND = 1
+# Start of the records written by one P2PCapture
+CAPTURE_SESSION = 2
+
+
+class P2PCapture():
+    """An append-only writer for a capture file.
+
+    Records can be written from both the network thread and the test logic
+    thread."""
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._file = open(path, "ab")
+        if self._file.tell() == 0:
+            self._file.write(CAPTURE_MAGIC)
+        elif read_magic(path) != CAPTURE_MAGIC:
+            self._file.close()
+            raise ValueError("{} is not a capture file".format(path))
+        self._start = time.monotonic()
+        self._file.write(CAPTURE_RECORD.pack(
+            int(time.time() * 1e9), CAPTURE_SESSION, 0))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def record(self, direction, data):
+        """Append one framed message to the capture."""
+        timestamp = int((time.monotonic() - self._start) * 1e9)
+        with self._lock:
+            self._file.write(CAPTURE_RECORD.pack(
+                timestamp, direction, len(data)))
+            self._file.write(data)
+
+    def flush(self):
+        with self._lock:
+            self._file.flush()
+
+    def close(self):
+        with self._lock:
+            self._file.close()
+
+
+def read_magic(path):
+    with open(path, "rb") as f:
+        return f.read(len(CAPTURE_MAGIC))
+
+
+def read_capture(path, direction=None):
+    """Iterate over the (timestamp, direction, message) records of a capture
+    file, optionally only over the ones in the given direction.
+
+    Timestamps are wall clock times in nanoseconds. The CAPTURE_SESSION
+    records are included, with an empty message, unless another direction
+    is asked for: the time between the records of two sessions says nothing
+    about the pace of the traffic.
+
+    A record cut short at the end of the file, as left by a process that was
+    killed while writing it, is ignored."""
+    with open(path, "rb") as f:
+        if f.read(len(CAPTURE_MAGIC)) != CAPTURE_MAGIC:
+            raise ValueError("{} is not a capture file".format(path))
+        size = os.fstat(f.fileno()).st_size
+        session_start = None
+        while f.tell() + CAPTURE_RECORD.size <= size:
+            timestamp, record_direction, length = CAPTURE_RECORD.unpack(
+                f.read(CAPTURE_RECORD.size))
+            data = f.read(length)
+            if len(data) < length:
+                return
+            if record_direction == CAPTURE_SESSION:
+                session_start = timestamp
+            elif session_start is None:
+                raise ValueError(
+                    "{} has a record outside of a session".format(path))
+            else:
+                timestamp += session_start
+            if direction is None or record_direction == direction:
+                yield timestamp, record_direction, data
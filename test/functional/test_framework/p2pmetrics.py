@@ -0,0 +1,223 @@
+#!/usr/bin/env python3
+# Copyright (c) 2019 The Bitcoin developers
+# Distributed under the MIT software license, see the accompanying
+# file COPYING or http://www.opensource.org/licenses/mit-license.php.
+"""Per-connection P2P metrics.
+
+Every P2PConnection keeps a P2PMetrics object that counts the messages and
+bytes sent and received per command, the time spent decoding received
+messages, the time the node takes to answer a ping with a pong and an inv
+with a getdata, and how many bytes are waiting to be written to the socket.
+
+P2PMetrics.snapshot() returns all of it as a dict, and P2PMetricsDump
+periodically writes the snapshots of the connections of a test to a JSON
+file (see the --p2pmetrics option of the test framework).
+Comparing the decode time with the time the connection was open shows
+whether a test is bound by the node or by the test framework."""
+
+from collections import defaultdict, deque, OrderedDict
+import json
+import os
+import threading
+import time
+
+# Number of sent messages waiting for a response that are remembered. The
+# node doesn't answer everything (e.g. it doesn't request an announced
+# object it already has), so the oldest ones are forgotten.
+MAX_PENDING_RESPONSES = 10000
+# Number of most recent response times kept for the percentiles
+MAX_RESPONSE_SAMPLES = 1000
+
+
+def _summarize(samples):
+    """Return count/mean/p50/p99/max in milliseconds of sorted samples."""
+    if not samples:
+        return {"count": 0}
+    return {
+        "count": len(samples),
+        "mean_ms": 1000 * sum(samples) / len(samples),
+        "p50_ms": 1000 * samples[(len(samples) - 1) // 2],
+        "p99_ms": 1000 * samples[(len(samples) - 1) * 99 // 100],
+        "max_ms": 1000 * samples[-1],
+    }
+
+
+class CommandStats():
+    __slots__ = ("bytes_in", "bytes_out", "decode_time", "msgs_in",
+                 "msgs_out")
+
+    def __init__(self):
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.decode_time = 0
+        self.msgs_in = 0
+        self.msgs_out = 0
+
+    def snapshot(self):
+        return {
+            "bytes_in": self.bytes_in,
+            "bytes_out": self.bytes_out,
+            "msgs_in": self.msgs_in,
+            "msgs_out": self.msgs_out,
+            "decode_time": self.decode_time,
+            "decode_time_avg": self.decode_time / self.msgs_in if self.msgs_in else None,
+        }
+
+
+class P2PMetrics():
+    """Metrics of a single P2P connection.
+
+    Updated from both the network thread and the test logic thread."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.start_time = time.monotonic()
+        # command (str) -> CommandStats
+        self.commands = defaultdict(CommandStats)
+        # (response command, nonce or hash) -> (kind, send time)
+        self.pending = OrderedDict()
+        # kind, e.g. "ping->pong" -> deque of response times in seconds
+        self.responses = defaultdict(
+            lambda: deque(maxlen=MAX_RESPONSE_SAMPLES))
+        # Bytes handed to send_raw_message() that the event loop has not
+        # passed to the socket transport yet, and the size of the transport
+        # write buffer when it was last written to
+        self.queued_bytes = 0
+        self.transport_bytes = 0
+        self.max_send_queue = 0
+        self.closed = False
+
+    def sent(self, command, size):
+        """Count a framed message queued for sending."""
+        with self._lock:
+            stats = self.commands[command]
+            stats.msgs_out += 1
+            stats.bytes_out += size
+            if self.closed:
+                # It is dropped without being written
+                return
+            self.queued_bytes += size
+            self.max_send_queue = max(
+                self.max_send_queue, self.queued_bytes + self.transport_bytes)
+
+    def written(self, size, transport_bytes):
+        """Count bytes passed to the transport, which now buffers
+        transport_bytes."""
+        with self._lock:
+            self.queued_bytes -= size
+            self.transport_bytes = transport_bytes
+            self.max_send_queue = max(
+                self.max_send_queue, self.queued_bytes + self.transport_bytes)
+
+    def close(self):
+        """Record that the connection was closed, dropping the bytes that
+        were still waiting to be written."""
+        with self._lock:
+            self.closed = True
+            self.queued_bytes = 0
+            self.transport_bytes = 0
+
+    def received(self, command, size, decode_time, message):
+        """Count a received message and match it to the request it answers."""
+        now = time.monotonic()
+        with self._lock:
+            stats = self.commands[command]
+            stats.msgs_in += 1
+            stats.bytes_in += size
+            stats.decode_time += decode_time
+
+            if command == "pong":
+                keys = [("pong", message.nonce)]
+            elif command == "getdata":
+                keys = [(command, inv.hash) for inv in message.inv]
+            else:
+                return
+            for key in keys:
+                request = self.pending.pop(key, None)
+                if request is not None:
+                    kind, send_time = request
+                    self.responses[kind].append(now - send_time)
+
+    def expect_response(self, message):
+        """Remember the time a message that the node answers was sent."""
+        command = message.command
+        if command == b"ping":
+            keys = [("pong", message.nonce, "ping->pong")]
+        elif command == b"inv":
+            keys = [("getdata", inv.hash, "inv->getdata")
+                    for inv in message.inv]
+        else:
+            return
+        now = time.monotonic()
+        with self._lock:
+            for response, key, kind in keys:
+                self.pending[(response, key)] = (kind, now)
+            while len(self.pending) > MAX_PENDING_RESPONSES:
+                self.pending.popitem(last=False)
+
+    def snapshot(self):
+        """Return the current metrics as a dict."""
+        with self._lock:
+            commands = {command: stats.snapshot()
+                        for command, stats in self.commands.items()}
+            responses = {kind: _summarize(sorted(samples))
+                         for kind, samples in self.responses.items()}
+            return {
+                "connected_time": time.monotonic() - self.start_time,
+                "bytes_in": sum(s["bytes_in"] for s in commands.values()),
+                "bytes_out": sum(s["bytes_out"] for s in commands.values()),
+                "decode_time": sum(s["decode_time"] for s in commands.values()),
+                "commands": commands,
+                "responses": responses,
+                "pending_responses": len(self.pending),
+                "send_queue": {
+                    "queued_bytes": self.queued_bytes,
+                    "transport_bytes": self.transport_bytes,
+                    "max_bytes": self.max_send_queue,
+                },
+            }
+
+
+class P2PMetricsDump(threading.Thread):
+    """Write the metrics snapshots of connections to a JSON file every
+    interval seconds, until stop() is called.
+
+    get_connections() is called before every dump and returns the current
+    connections. Connections it no longer returns, e.g. after they were
+    disconnected, stay in the file with their last metrics.
+
+    The file is replaced atomically, so it can be read at any time."""
+
+    def __init__(self, path, get_connections, interval=1.0):
+        super().__init__(name="P2PMetricsDump", daemon=True)
+        self.path = path
+        self.get_connections = get_connections
+        self.interval = interval
+        self.connections = []
+        self._stop_event = threading.Event()
+
+    def run(self):
+        while not self._stop_event.wait(self.interval):
+            self.dump()
+        self.dump()
+
+    def dump(self):
+        for conn in self.get_connections():
+            if not any(conn is known for known in self.connections):
+                self.connections.append(conn)
+        snapshot = {
+            "time": time.time(),
+            "connections": [
+                dict(peer="{}:{}".format(conn.dstaddr, conn.dstport),
+                     **conn.metrics.snapshot())
+                for conn in self.connections],
+        }
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w", encoding="utf8") as f:
+            json.dump(snapshot, f, indent=1, sort_keys=True)
+        os.replace(tmp_path, self.path)
+
+    def stop(self):
+        """Stop the thread once it has written a final snapshot."""
+        self._stop_event.set()
+        self.join()
@@ -2,6 +2,9 @@
 # Copyright 2019 The Bitcoin Developers
 """Schnorr secp256k1 using OpenSSL
 
+Provides signing, and verification of single signatures or of a batch of
+signatures at once.
+
 WARNING: This module does not mlock() secrets; your private keys may end up on
 disk in swap! Also, operations are not constant time. Use with caution!
 
@@ -9,62 +12,103 @@ Inspired by key.py from python-bitcoinlib.
 """
 
 import ctypes
-import ctypes.util
+import functools
 import hashlib
 import hmac
+import os
 import threading
 
-ssl = ctypes.cdll.LoadLibrary(ctypes.util.find_library('ssl') or 'libeay32')
+from .openssl import LazyLibrary
 
-ssl.BN_new.restype = ctypes.c_void_p
-ssl.BN_new.argtypes = []
+# point encodings for EC_POINT_point2oct
+POINT_CONVERSION_COMPRESSED = 2
+POINT_CONVERSION_UNCOMPRESSED = 4
 
-ssl.BN_free.restype = None
-ssl.BN_free.argtypes = [ctypes.c_void_p]
+SECP256K1_FIELDSIZE = 0xfffffffffffffffffffffffffffffffffffffffffffffffffffffffefffffc2f
+SECP256K1_ORDER = 0xfffffffffffffffffffffffffffffffebaaedce6af48a03bbfd25e8cd0364141
+SECP256K1_ORDER_HALF = SECP256K1_ORDER // 2
 
-ssl.BN_bin2bn.restype = ctypes.c_void_p
-ssl.BN_bin2bn.argtypes = [ctypes.c_char_p, ctypes.c_int, ctypes.c_void_p]
+# Number of decompressed public keys kept for verification
+PUBKEY_CACHE_SIZE = 4096
 
-ssl.BN_CTX_new.restype = ctypes.c_void_p
-ssl.BN_CTX_new.argtypes = []
+# this specifies the curve used
+NID_secp256k1 = 714  # from openssl/obj_mac.h
 
-ssl.BN_CTX_free.restype = None
-ssl.BN_CTX_free.argtypes = [ctypes.c_void_p]
 
-ssl.EC_GROUP_new_by_curve_name.restype = ctypes.c_void_p
-ssl.EC_GROUP_new_by_curve_name.argtypes = [ctypes.c_int]
+def _declare(ssl):
+    ssl.BN_new.restype = ctypes.c_void_p
+    ssl.BN_new.argtypes = []
 
-ssl.EC_POINT_new.restype = ctypes.c_void_p
-ssl.EC_POINT_new.argtypes = [ctypes.c_void_p]
+    ssl.BN_free.restype = None
+    ssl.BN_free.argtypes = [ctypes.c_void_p]
 
-ssl.EC_POINT_free.restype = None
-ssl.EC_POINT_free.argtypes = [ctypes.c_void_p]
+    ssl.BN_bin2bn.restype = ctypes.c_void_p
+    ssl.BN_bin2bn.argtypes = [ctypes.c_char_p, ctypes.c_int, ctypes.c_void_p]
 
-ssl.EC_POINT_mul.restype = ctypes.c_int
-ssl.EC_POINT_mul.argtypes = [ctypes.c_void_p, ctypes.c_void_p,
-                             ctypes.c_void_p, ctypes.c_void_p, ctypes.c_void_p, ctypes.c_void_p]
+    ssl.BN_CTX_new.restype = ctypes.c_void_p
+    ssl.BN_CTX_new.argtypes = []
 
-ssl.EC_POINT_is_at_infinity.restype = ctypes.c_int
-ssl.EC_POINT_is_at_infinity.argtypes = [ctypes.c_void_p, ctypes.c_void_p]
+    ssl.BN_CTX_free.restype = None
+    ssl.BN_CTX_free.argtypes = [ctypes.c_void_p]
 
-ssl.EC_POINT_point2oct.restype = ctypes.c_size_t
-ssl.EC_POINT_point2oct.argtypes = [ctypes.c_void_p, ctypes.c_void_p,
-                                   ctypes.c_int, ctypes.c_void_p, ctypes.c_size_t, ctypes.c_void_p]
+    ssl.EC_GROUP_new_by_curve_name.restype = ctypes.c_void_p
+    ssl.EC_GROUP_new_by_curve_name.argtypes = [ctypes.c_int]
 
-# point encodings for EC_POINT_point2oct
-POINT_CONVERSION_COMPRESSED = 2
-POINT_CONVERSION_UNCOMPRESSED = 4
+    ssl.EC_POINT_new.restype = ctypes.c_void_p
+    ssl.EC_POINT_new.argtypes = [ctypes.c_void_p]
 
-SECP256K1_FIELDSIZE = 0xfffffffffffffffffffffffffffffffffffffffffffffffffffffffefffffc2f
-SECP256K1_ORDER = 0xfffffffffffffffffffffffffffffffebaaedce6af48a03bbfd25e8cd0364141
-SECP256K1_ORDER_HALF = SECP256K1_ORDER // 2
+    ssl.EC_POINT_free.restype = None
+    ssl.EC_POINT_free.argtypes = [ctypes.c_void_p]
 
-# this specifies the curve used
-NID_secp256k1 = 714  # from openssl/obj_mac.h
+    ssl.EC_POINT_mul.restype = ctypes.c_int
+    ssl.EC_POINT_mul.argtypes = [ctypes.c_void_p, ctypes.c_void_p,
+                                 ctypes.c_void_p, ctypes.c_void_p, ctypes.c_void_p, ctypes.c_void_p]
+
+    ssl.EC_POINT_is_at_infinity.restype = ctypes.c_int
+    ssl.EC_POINT_is_at_infinity.argtypes = [ctypes.c_void_p, ctypes.c_void_p]
+
+    ssl.EC_POINT_point2oct.restype = ctypes.c_size_t
+    ssl.EC_POINT_point2oct.argtypes = [ctypes.c_void_p, ctypes.c_void_p,
+                                       ctypes.c_int, ctypes.c_void_p, ctypes.c_size_t, ctypes.c_void_p]
+
+    ssl.EC_POINT_oct2point.restype = ctypes.c_int
+    ssl.EC_POINT_oct2point.argtypes = [ctypes.c_void_p, ctypes.c_void_p,
+                                       ctypes.c_char_p, ctypes.c_size_t, ctypes.c_void_p]
 
-group = ssl.EC_GROUP_new_by_curve_name(NID_secp256k1)
-if not group:
-    raise RuntimeError("Cannot get secp256k1 group!")
+    ssl.EC_POINT_invert.restype = ctypes.c_int
+    ssl.EC_POINT_invert.argtypes = [
+        ctypes.c_void_p, ctypes.c_void_p, ctypes.c_void_p]
+
+    ssl.BN_kronecker.restype = ctypes.c_int
+    ssl.BN_kronecker.argtypes = [
+        ctypes.c_void_p, ctypes.c_void_p, ctypes.c_void_p]
+
+    ssl.EC_POINTs_mul.restype = ctypes.c_int
+    ssl.EC_POINTs_mul.argtypes = [
+        ctypes.c_void_p, ctypes.c_void_p, ctypes.c_void_p, ctypes.c_size_t,
+        ctypes.POINTER(ctypes.c_void_p), ctypes.POINTER(ctypes.c_void_p),
+        ctypes.c_void_p]
+
+
+ssl = LazyLibrary(_declare)
+
+
+@functools.lru_cache(maxsize=None)
+def get_group():
+    """The secp256k1 EC_GROUP, created on first use"""
+    group = ssl.EC_GROUP_new_by_curve_name(NID_secp256k1)
+    if not group:
+        raise RuntimeError("Cannot get secp256k1 group!")
+    return group
+
+
+@functools.lru_cache(maxsize=None)
+def get_fieldsize_bn():
+    """SECP256K1_FIELDSIZE as a BIGNUM, created on first use"""
+    fieldsize_bn = ssl.BN_bin2bn(
+        SECP256K1_FIELDSIZE.to_bytes(32, 'big'), 32, None)
+    assert fieldsize_bn
+    return fieldsize_bn
 
 
 class CTX:
@@ -165,6 +209,7 @@ def sign(privkeybytes, msg32):
         privkeybytes, msg32, algo16=b"Schnorr+SHA256  ")
 
     ctx = CTX.ptr_for_this_thread()
+    group = get_group()
 
     # calculate R point and pubkey point, and get them in
     # uncompressed/compressed formats respectively.
@@ -193,7 +238,7 @@ def sign(privkeybytes, msg32):
 
     Ry = int.from_bytes(Rbuf[33:65], 'big')  # y coord
 
-    if jacobi(Ry, SECP256K1_FIELDSIZE) == -1:
+    if not is_quadratic_residue(Ry):
         k = SECP256K1_ORDER - k
 
     rbytes = Rbuf[1:33]  # x coord big-endian
@@ -212,6 +257,7 @@ def getpubkey(privkeybytes, compressed=True):
     encoding = POINT_CONVERSION_COMPRESSED if compressed else POINT_CONVERSION_UNCOMPRESSED
 
     ctx = CTX.ptr_for_this_thread()
+    group = get_group()
 
     pubkey = ssl.EC_POINT_new(group)
     assert pubkey
@@ -229,8 +275,164 @@ def getpubkey(privkeybytes, compressed=True):
     return bytes(pubkeybuf)
 
 
+class ECPoint:
+    """Wrapper for an EC_POINT decoded from its serialization"""
+
+    def __init__(self, encoded):
+        self.ptr = ssl.EC_POINT_new(get_group())
+        assert self.ptr
+        self.valid = ssl.EC_POINT_oct2point(
+            get_group(), self.ptr, encoded, len(encoded), CTX.ptr_for_this_thread()) == 1
+
+    def __del__(self):
+        if ssl:
+            ssl.EC_POINT_free(self.ptr)
+
+    def serialize(self, encoding):
+        size = 65 if encoding == POINT_CONVERSION_UNCOMPRESSED else 33
+        buf = ctypes.create_string_buffer(size)
+        assert size == ssl.EC_POINT_point2oct(
+            get_group(), self.ptr, encoding, buf, size, CTX.ptr_for_this_thread())
+        return buf.raw
+
+
+@functools.lru_cache(maxsize=PUBKEY_CACHE_SIZE)
+def decode_pubkey(pubkey):
+    """Decompress a serialized public key, and return its point and
+    compressed serialization, or None if it isn't a valid public key."""
+    point = ECPoint(pubkey)
+    if not point.valid:
+        return None
+    return point, point.serialize(POINT_CONVERSION_COMPRESSED)
+
+
+def is_quadratic_residue(y):
+    """Return whether jacobi(y, SECP256K1_FIELDSIZE) == 1, computed by
+    libssl."""
+    ybn = ssl.BN_bin2bn(y.to_bytes(32, 'big'), 32, None)
+    assert ybn
+    result = ssl.BN_kronecker(ybn, get_fieldsize_bn(),
+                              CTX.ptr_for_this_thread())
+    ssl.BN_free(ybn)
+    return result == 1
+
+
+def lift_x(x):
+    """Return the point with the given x coordinate and a quadratic residue
+    y coordinate, or None if there is none."""
+    point = ECPoint(b'\x02' + x.to_bytes(32, 'big'))
+    if not point.valid:
+        return None
+    y = int.from_bytes(
+        point.serialize(POINT_CONVERSION_UNCOMPRESSED)[33:], 'big')
+    if not is_quadratic_residue(y):
+        assert ssl.EC_POINT_invert(
+            get_group(), point.ptr, CTX.ptr_for_this_thread())
+    return point
+
+
+def _parse(pubkey, msg32, sig):
+    """Return the pubkey point, r, s and the challenge e of a signature, or
+    None if it is malformed."""
+    assert len(msg32) == 32
+    if len(sig) != 64:
+        return None
+    decoded = decode_pubkey(bytes(pubkey))
+    if decoded is None:
+        return None
+    point, compressed = decoded
+    r = int.from_bytes(sig[:32], 'big')
+    s = int.from_bytes(sig[32:], 'big')
+    if r >= SECP256K1_FIELDSIZE or s >= SECP256K1_ORDER:
+        return None
+    e = int.from_bytes(hashlib.sha256(
+        sig[:32] + compressed + msg32).digest(), 'big') % SECP256K1_ORDER
+    return point, r, s, e
+
+
+def _points_mul(scalar, points, scalars):
+    """Return the serialization of scalar*G + sum(scalars[i]*points[i]), or
+    None if it is the point at infinity."""
+    ctx = CTX.ptr_for_this_thread()
+    group = get_group()
+    bignums = [ssl.BN_bin2bn(n.to_bytes(32, 'big'), 32, None)
+               for n in [scalar] + scalars]
+    assert all(bignums)
+    result = ssl.EC_POINT_new(group)
+    assert result
+    try:
+        count = len(points)
+        assert ssl.EC_POINTs_mul(
+            group, result, bignums[0], count,
+            (ctypes.c_void_p * count)(*[p.ptr for p in points]),
+            (ctypes.c_void_p * count)(*bignums[1:]), ctx)
+        if ssl.EC_POINT_is_at_infinity(group, result):
+            return None
+        buf = ctypes.create_string_buffer(65)
+        assert 65 == ssl.EC_POINT_point2oct(
+            group, result, POINT_CONVERSION_UNCOMPRESSED, buf, 65, ctx)
+        return buf.raw
+    finally:
+        for bignum in bignums:
+            ssl.BN_free(bignum)
+        ssl.EC_POINT_free(result)
+
+
+def verify(pubkey, msg32, sig):
+    """Verify a Schnorr signature (BIP-Schnorr convention)."""
+    parsed = _parse(pubkey, msg32, sig)
+    if parsed is None:
+        return False
+    point, r, s, e = parsed
+    # R = s*G - e*P
+    R = _points_mul(s, [point], [SECP256K1_ORDER - e])
+    if R is None:
+        return False
+    Ry = int.from_bytes(R[33:65], 'big')
+    return is_quadratic_residue(Ry) and int.from_bytes(R[1:33], 'big') == r
+
+
+def verify_batch(items):
+    """Verify a list of (pubkey, msg32, sig) Schnorr signatures at once.
+
+    Returns True only if all of them are valid. The signature equations are
+    combined with random coefficients a_i into a single multi-scalar
+    multiplication:
+        (sum a_i*s_i)*G - sum a_i*e_i*P_i - sum a_i*R_i == infinity
+    where the terms of signatures by the same public key are added up
+    first. Use verify() to find out which signature is invalid."""
+    scalar = 0
+    points = []
+    scalars = []
+    # index of each public key point in points
+    pubkey_index = {}
+    for i, (pubkey, msg32, sig) in enumerate(items):
+        parsed = _parse(pubkey, msg32, sig)
+        if parsed is None:
+            return False
+        point, r, s, e = parsed
+        R = lift_x(r)
+        if R is None:
+            return False
+        a = 1 if i == 0 else int.from_bytes(os.urandom(16), 'big')
+        scalar = (scalar + a * s) % SECP256K1_ORDER
+        index = pubkey_index.get(point)
+        if index is None:
+            pubkey_index[point] = len(points)
+            points.append(point)
+            scalars.append((-a * e) % SECP256K1_ORDER)
+        else:
+            scalars[index] = (scalars[index] - a * e) % SECP256K1_ORDER
+        points.append(R)
+        scalars.append(SECP256K1_ORDER - a)
+    if not points:
+        return True
+    return _points_mul(scalar, points, scalars) is None
+
+
 if __name__ == '__main__':
-    # Test Schnorr implementation.
+    # Test Schnorr implementation, run with:
+    #   python3 -m test_framework.schnorr
     # duplicate the deterministic sig test from src/test/key_tests.cpp
     private_key = bytes.fromhex(
         "12b004fff7f4b69ef8650e767f18f11ede158148b425660723b9f9a66e61f747")
@@ -252,4 +454,34 @@ if __name__ == '__main__':
         "47b81d0717571846de67ad3d913a8fdf9d8f3f73161a4c48ae81c"
         "b183b214765feb86e255ce")
 
+    assert verify(pubkey, msghash, sig)
+    uncompressed_pubkey = getpubkey(private_key, compressed=False)
+    assert verify(uncompressed_pubkey, msghash, sig)
+    assert not verify(pubkey, sha(msghash), sig)
+    assert not verify(pubkey, msghash, sig[:32] + bytes(32))
+    assert not verify(pubkey, msghash, bytes(32) + sig[32:])
+    assert not verify(pubkey, msghash, sig[:63])
+    assert not verify(b'\x02' + bytes(32), msghash, sig)
+
+    # batch verification of signatures from different keys
+    batch = []
+    for i in range(64):
+        key = sha(private_key + bytes([i]))
+        msghash = sha(msghash)
+        batch.append((getpubkey(key), msghash, sign(key, msghash)))
+    assert all(verify(*item) for item in batch)
+    assert verify_batch(batch)
+    assert verify_batch([])
+    for i in (0, 1, 63):
+        bad = list(batch)
+        pubkey, msghash, sig = bad[i]
+        bad[i] = (pubkey, msghash, sig[:32] + (
+            (int.from_bytes(sig[32:], 'big') + 1) % SECP256K1_ORDER).to_bytes(32, 'big'))
+        assert not verify(*bad[i])
+        assert not verify_batch(bad)
+    # swapping the signatures of two messages breaks both
+    bad = list(batch)
+    bad[0], bad[1] = batch[0][:2] + batch[1][2:], batch[1][:2] + batch[0][2:]
+    assert not verify_batch(bad)
+
     print("ok")
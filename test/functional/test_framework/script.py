@@ -13,13 +13,10 @@ import hashlib
 import struct
 
 from .messages import (
-    CTransaction,
-    CTxOut,
     hash256,
+    ser_compact_size,
     ser_string,
-    ser_uint256,
     sha256,
-    uint256_from_str,
 )
 
 
@@ -633,93 +630,118 @@ def SignatureHash(script, txTo, inIdx, hashtype):
 
     Returns (hash, err) to precisely match the consensus-critical behavior of
     the SIGHASH_SINGLE bug. (inIdx is *not* checked for validity)
+
+    The serialization of the modified transaction is streamed into the
+    hasher, without copying txTo.
     """
     HASH_ONE = b'\x01\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00'
 
     if inIdx >= len(txTo.vin):
         return (HASH_ONE, "inIdx {} out of range ({})".format(inIdx, len(txTo.vin)))
-    txtmp = CTransaction(txTo)
-
-    for txin in txtmp.vin:
-        txin.scriptSig = b''
-    txtmp.vin[inIdx].scriptSig = FindAndDelete(
-        script, CScript([OP_CODESEPARATOR]))
-
-    if (hashtype & 0x1f) == SIGHASH_NONE:
-        txtmp.vout = []
-
-        for i in range(len(txtmp.vin)):
-            if i != inIdx:
-                txtmp.vin[i].nSequence = 0
-
-    elif (hashtype & 0x1f) == SIGHASH_SINGLE:
-        outIdx = inIdx
-        if outIdx >= len(txtmp.vout):
-            return (HASH_ONE, "outIdx {} out of range ({})".format(outIdx, len(txtmp.vout)))
-
-        tmp = txtmp.vout[outIdx]
-        txtmp.vout = []
-        for i in range(outIdx):
-            txtmp.vout.append(CTxOut(-1))
-        txtmp.vout.append(tmp)
-
-        for i in range(len(txtmp.vin)):
-            if i != inIdx:
-                txtmp.vin[i].nSequence = 0
 
+    basetype = hashtype & 0x1f
+    if basetype == SIGHASH_SINGLE and inIdx >= len(txTo.vout):
+        return (HASH_ONE, "outIdx {} out of range ({})".format(inIdx, len(txTo.vout)))
+
+    # The other inputs are serialized with an empty scriptSig, and with a
+    # zero nSequence for SIGHASH_NONE and SIGHASH_SINGLE
+    zero_sequence = basetype in (SIGHASH_NONE, SIGHASH_SINGLE)
+    script_code = ser_string(FindAndDelete(
+        script, CScript([OP_CODESEPARATOR])))
+    txin = txTo.vin[inIdx]
+    signed_input = b"".join((txin.prevout.serialize(), script_code,
+                             struct.pack("<I", txin.nSequence)))
+
+    h = hashlib.sha256()
+    h.update(struct.pack("<i", txTo.nVersion))
     if hashtype & SIGHASH_ANYONECANPAY:
-        tmp = txtmp.vin[inIdx]
-        txtmp.vin = []
-        txtmp.vin.append(tmp)
-
-    s = txtmp.serialize()
-    s += struct.pack(b"<I", hashtype)
-
-    hash = hash256(s)
-
-    return (hash, None)
-
-# TODO: Allow cached hashPrevouts/hashSequence/hashOutputs to be provided.
-# Performance optimization probably not necessary for python tests, however.
-
-
-def SignatureHashForkId(script, txTo, inIdx, hashtype, amount):
-
-    hashPrevouts = 0
-    hashSequence = 0
-    hashOutputs = 0
+        h.update(ser_compact_size(1))
+        h.update(signed_input)
+    else:
+        h.update(ser_compact_size(len(txTo.vin)))
+        for i, txin in enumerate(txTo.vin):
+            if i == inIdx:
+                h.update(signed_input)
+            else:
+                h.update(txin.prevout.serialize())
+                h.update(b"\x00" + struct.pack(
+                    "<I", 0 if zero_sequence else txin.nSequence))
+
+    if basetype == SIGHASH_NONE:
+        h.update(ser_compact_size(0))
+    elif basetype == SIGHASH_SINGLE:
+        # The outputs before inIdx are serialized as CTxOut(-1)
+        h.update(ser_compact_size(inIdx + 1))
+        h.update(b"\xff\xff\xff\xff\xff\xff\xff\xff\x00" * inIdx)
+        h.update(txTo.vout[inIdx].serialize())
+    else:
+        h.update(ser_compact_size(len(txTo.vout)))
+        for txout in txTo.vout:
+            h.update(txout.serialize())
+
+    h.update(struct.pack("<I", txTo.nLockTime))
+    h.update(struct.pack(b"<I", hashtype))
+
+    return (sha256(h.digest()), None)
+
+
+class PrecomputedTransactionData():
+    """The hashes of the prevouts, sequence numbers and outputs of a
+    transaction, as used by SignatureHashForkId().
+
+    They are the same for every input, so computing them once makes signing
+    all the inputs of a transaction linear in its size, like
+    PrecomputedTransactionData in the node. The object must be recreated if
+    the inputs or outputs of the transaction change, other than their
+    scriptSigs."""
+    __slots__ = ("hashOutputs", "hashPrevouts", "hashSequence")
+
+    def __init__(self, txTo):
+        self.hashPrevouts = hash256(
+            b"".join(i.prevout.serialize() for i in txTo.vin))
+        self.hashSequence = hash256(
+            b"".join(struct.pack("<I", i.nSequence) for i in txTo.vin))
+        self.hashOutputs = hash256(
+            b"".join(o.serialize() for o in txTo.vout))
+
+
+def SignatureHashForkId(script, txTo, inIdx, hashtype, amount, txdata=None):
+    """Return the BIP143 style signature hash of input inIdx of txTo.
+
+    Pass a PrecomputedTransactionData of txTo as txdata when signing several
+    of its inputs."""
+
+    hashPrevouts = bytes(32)
+    hashSequence = bytes(32)
+    hashOutputs = bytes(32)
+
+    if not (hashtype & SIGHASH_ANYONECANPAY) or \
+            ((hashtype & 0x1f) != SIGHASH_SINGLE and (hashtype & 0x1f) != SIGHASH_NONE):
+        if txdata is None:
+            txdata = PrecomputedTransactionData(txTo)
 
     if not (hashtype & SIGHASH_ANYONECANPAY):
-        serialize_prevouts = bytes()
-        for i in txTo.vin:
-            serialize_prevouts += i.prevout.serialize()
-        hashPrevouts = uint256_from_str(hash256(serialize_prevouts))
+        hashPrevouts = txdata.hashPrevouts
 
     if (not (hashtype & SIGHASH_ANYONECANPAY) and (hashtype & 0x1f) != SIGHASH_SINGLE and (hashtype & 0x1f) != SIGHASH_NONE):
-        serialize_sequence = bytes()
-        for i in txTo.vin:
-            serialize_sequence += struct.pack("<I", i.nSequence)
-        hashSequence = uint256_from_str(hash256(serialize_sequence))
+        hashSequence = txdata.hashSequence
 
     if ((hashtype & 0x1f) != SIGHASH_SINGLE and (hashtype & 0x1f) != SIGHASH_NONE):
-        serialize_outputs = bytes()
-        for o in txTo.vout:
-            serialize_outputs += o.serialize()
-        hashOutputs = uint256_from_str(hash256(serialize_outputs))
+        hashOutputs = txdata.hashOutputs
     elif ((hashtype & 0x1f) == SIGHASH_SINGLE and inIdx < len(txTo.vout)):
-        serialize_outputs = txTo.vout[inIdx].serialize()
-        hashOutputs = uint256_from_str(hash256(serialize_outputs))
-
-    ss = bytes()
-    ss += struct.pack("<i", txTo.nVersion)
-    ss += ser_uint256(hashPrevouts)
-    ss += ser_uint256(hashSequence)
-    ss += txTo.vin[inIdx].prevout.serialize()
-    ss += ser_string(script)
-    ss += struct.pack("<q", amount)
-    ss += struct.pack("<I", txTo.vin[inIdx].nSequence)
-    ss += ser_uint256(hashOutputs)
-    ss += struct.pack("<i", txTo.nLockTime)
-    ss += struct.pack("<I", hashtype)
+        hashOutputs = hash256(txTo.vout[inIdx].serialize())
+
+    ss = b"".join((
+        struct.pack("<i", txTo.nVersion),
+        hashPrevouts,
+        hashSequence,
+        txTo.vin[inIdx].prevout.serialize(),
+        ser_string(script),
+        struct.pack("<q", amount),
+        struct.pack("<I", txTo.vin[inIdx].nSequence),
+        hashOutputs,
+        struct.pack("<i", txTo.nLockTime),
+        struct.pack("<I", hashtype),
+    ))
 
     return hash256(ss)
@@ -0,0 +1,86 @@
+#!/usr/bin/env python3
+# Copyright (c) 2019 The Bitcoin developers
+# Distributed under the MIT software license, see the accompanying
+# file COPYING or http://www.opensource.org/licenses/mit-license.php.
+"""Batch ECDSA and Schnorr signing on a thread pool.
+
+CECKey.sign() and schnorr.sign() spend most of their time in libssl, and
+ctypes releases the GIL around those calls, so a large number of hashes can
+be signed in parallel. sign_batch() signs a list of (key, sighash) pairs,
+sign_tx_inputs() signs every input of a transaction. Both return the
+signatures in order.
+
+A key is either a CECKey, to create an ECDSA signature, or the 32 bytes of a
+private key, to create a Schnorr signature. Schnorr signing uses the per
+thread BN_CTX of schnorr.CTX."""
+
+from concurrent.futures import ThreadPoolExecutor
+import os
+
+from . import schnorr
+from .key import CECKey
+from .script import (
+    PrecomputedTransactionData,
+    SIGHASH_ALL,
+    SIGHASH_FORKID,
+    SignatureHashForkId,
+)
+
+# Number of signatures each task of the thread pool creates, so that the
+# pool overhead is small compared to the signing
+SIGN_CHUNK_SIZE = 64
+
+
+def default_threads():
+    return os.cpu_count() or 1
+
+
+def sign(key, sighash):
+    """Sign sighash with an ECDSA CECKey or Schnorr private key bytes."""
+    if isinstance(key, CECKey):
+        return key.sign(sighash)
+    return schnorr.sign(key, sighash)
+
+
+def _sign_chunk(pairs):
+    return [sign(key, sighash) for key, sighash in pairs]
+
+
+def sign_batch(pairs, threads=None):
+    """Sign a list of (key, sighash) pairs on threads threads (by default
+    one per CPU) and return the list of signatures."""
+    pairs = list(pairs)
+    threads = threads or default_threads()
+    if threads == 1 or len(pairs) <= SIGN_CHUNK_SIZE:
+        return _sign_chunk(pairs)
+
+    chunks = [pairs[i:i + SIGN_CHUNK_SIZE]
+              for i in range(0, len(pairs), SIGN_CHUNK_SIZE)]
+    signatures = []
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        for chunk in executor.map(_sign_chunk, chunks):
+            signatures.extend(chunk)
+    return signatures
+
+
+def sign_tx_inputs(tx, spent_outputs, keys, hashtype=SIGHASH_ALL | SIGHASH_FORKID, threads=None):
+    """Sign every input of tx and return the signatures, with the hashtype
+    byte appended.
+
+    spent_outputs is the list of the CTxOuts spent by the inputs: their
+    scriptPubKey is signed as the script code, with their nValue as the
+    amount. keys is the list of keys signing each input, or a single key
+    signing all of them. The caller builds the scriptSigs from the
+    signatures, as their form depends on the scripts being spent."""
+    assert len(spent_outputs) == len(tx.vin)
+    if isinstance(keys, (CECKey, bytes)):
+        keys = [keys] * len(tx.vin)
+    assert len(keys) == len(tx.vin)
+
+    txdata = PrecomputedTransactionData(tx)
+    sighashes = [SignatureHashForkId(txout.scriptPubKey, tx, i, hashtype,
+                                     txout.nValue, txdata)
+                 for i, txout in enumerate(spent_outputs)]
+    hashbyte = bytes([hashtype & 0xff])
+    return [signature + hashbyte
+            for signature in sign_batch(zip(keys, sighashes), threads)]
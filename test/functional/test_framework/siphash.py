@@ -5,8 +5,20 @@
 """Specialized SipHash-2-4 implementations.
 
 This implements SipHash-2-4 for 256-bit integers.
+
+siphash256_batch() hashes many integers with the same key at once. It uses
+NumPy, when available, to run the rounds on arrays of 64 bit lanes.
 """
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# Below this many hashes, the pure Python loop is faster than setting up
+# the NumPy arrays.
+BATCH_MIN_SIZE = 32
+
 
 def rotl64(n, b):
     return n >> (64 - b) | (n & ((1 << (64 - b)) - 1)) << b
@@ -64,3 +76,55 @@ def siphash256(k0, k1, h):
     v0, v1, v2, v3 = siphash_round(v0, v1, v2, v3)
     v0, v1, v2, v3 = siphash_round(v0, v1, v2, v3)
     return v0 ^ v1 ^ v2 ^ v3
+
+
+def _np_rotl64(n, b):
+    return (n << numpy.uint64(b)) | (n >> numpy.uint64(64 - b))
+
+
+def _np_siphash_round(v0, v1, v2, v3):
+    # uint64 array arithmetic wraps around, no masking needed
+    v0 += v1
+    v1 = _np_rotl64(v1, 13)
+    v1 ^= v0
+    v0 = _np_rotl64(v0, 32)
+    v2 += v3
+    v3 = _np_rotl64(v3, 16)
+    v3 ^= v2
+    v0 += v3
+    v3 = _np_rotl64(v3, 21)
+    v3 ^= v0
+    v2 += v1
+    v1 = _np_rotl64(v1, 17)
+    v1 ^= v2
+    v2 = _np_rotl64(v2, 32)
+    return (v0, v1, v2, v3)
+
+
+def _np_siphash256_batch(k0, k1, hashes):
+    data = b"".join(h.to_bytes(32, 'little') for h in hashes)
+    words = numpy.frombuffer(data, dtype='<u8').reshape(-1, 4).astype(
+        numpy.uint64)
+    n = [words[:, i] for i in range(4)]
+    count = len(hashes)
+    v0 = numpy.full(count, 0x736f6d6570736575 ^ k0, dtype=numpy.uint64)
+    v1 = numpy.full(count, 0x646f72616e646f6d ^ k1, dtype=numpy.uint64)
+    v2 = numpy.full(count, 0x6c7967656e657261 ^ k0, dtype=numpy.uint64)
+    v3 = numpy.full(count, 0x7465646279746573 ^ k1, dtype=numpy.uint64)
+    tail = numpy.full(count, 0x2000000000000000, dtype=numpy.uint64)
+    for m in n + [tail]:
+        v3 ^= m
+        v0, v1, v2, v3 = _np_siphash_round(v0, v1, v2, v3)
+        v0, v1, v2, v3 = _np_siphash_round(v0, v1, v2, v3)
+        v0 ^= m
+    v2 ^= numpy.uint64(0xFF)
+    for _ in range(4):
+        v0, v1, v2, v3 = _np_siphash_round(v0, v1, v2, v3)
+    return (v0 ^ v1 ^ v2 ^ v3).tolist()
+
+
+def siphash256_batch(k0, k1, hashes):
+    """Return [siphash256(k0, k1, h) for h in hashes]."""
+    if numpy is None or len(hashes) < BATCH_MIN_SIZE:
+        return [siphash256(k0, k1, h) for h in hashes]
+    return _np_siphash256_batch(k0, k1, hashes)
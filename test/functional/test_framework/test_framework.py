@@ -17,6 +17,7 @@ import time
 
 from .authproxy import JSONRPCException
 from . import coverage
+from .p2pmetrics import P2PMetricsDump
 from .test_node import TestNode
 from .util import (
     assert_equal,
@@ -101,6 +102,8 @@ class BitcoinTestFramework():
                             help="use bitcoin-cli instead of RPC for all commands")
         parser.add_argument("--with-gravitonactivation", dest="gravitonactivation", default=False, action="store_true",
                             help="Activate graviton update on timestamp {}".format(TIMESTAMP_IN_THE_PAST))
+        parser.add_argument("--p2pmetrics", dest="p2pmetrics", metavar="FILE",
+                            help="Write the metrics of the test's P2P connections to FILE as JSON every second")
         self.add_options(parser)
         self.options = parser.parse_args()
 
@@ -133,6 +136,12 @@ class BitcoinTestFramework():
             self.options.tmpdir = tempfile.mkdtemp(prefix="test")
         self._start_logging()
 
+        metrics_dump = None
+        if self.options.p2pmetrics:
+            metrics_dump = P2PMetricsDump(
+                os.path.abspath(self.options.p2pmetrics), self._p2p_connections)
+            metrics_dump.start()
+
         success = TestStatus.FAILED
 
         try:
@@ -157,6 +166,11 @@ class BitcoinTestFramework():
         except KeyboardInterrupt:
             self.log.warning("Exiting after keyboard interrupt")
 
+        if metrics_dump is not None:
+            metrics_dump.stop()
+            self.log.info("P2P metrics written to {}".format(
+                metrics_dump.path))
+
         if success == TestStatus.FAILED and self.options.pdbonfailure:
             print("Testcase failed. Attaching python debugger. Enter ? for help")
             pdb.set_trace()
@@ -338,6 +352,10 @@ class BitcoinTestFramework():
 
     # Private helper methods. These should not be accessed by the subclass test scripts.
 
+    def _p2p_connections(self):
+        """Return the P2P connections of all the nodes, for --p2pmetrics."""
+        return [p2p for node in list(self.nodes) for p2p in list(node.p2ps)]
+
     def _start_logging(self):
         # Add logger and logging handlers
         self.log = logging.getLogger('TestFramework')
@@ -0,0 +1,125 @@
+#!/usr/bin/env python3
+# Copyright (c) 2019 The Bitcoin developers
+# Distributed under the MIT software license, see the accompanying
+# file COPYING or http://www.opensource.org/licenses/mit-license.php.
+"""
+Compare the BytesIO deserialize() path with the memoryview deserialize_from()
+path on full-size blocks, headers and compact blocks.
+
+Both paths must produce objects that re-serialize to the original bytes.
+The default block size is 32MB, use --size to change it (in MB).
+"""
+
+import argparse
+from io import BytesIO
+import random
+import time
+
+from test_framework.messages import (
+    CBlock,
+    CBlockHeader,
+    COutPoint,
+    CTransaction,
+    CTxIn,
+    CTxOut,
+    HeaderAndShortIDs,
+    msg_block,
+    msg_cmpctblock,
+    msg_headers,
+    ser_compact_size,
+)
+
+
+def random_tx(rng):
+    tx = CTransaction()
+    tx.nVersion = rng.choice([1, 2])
+    for _ in range(rng.randint(1, 3)):
+        # Mix in a few scripts above 252 bytes to cover multi-byte sizes
+        script_len = rng.choice([0, 72, 107, 253, 300])
+        tx.vin.append(CTxIn(COutPoint(rng.getrandbits(256), rng.getrandbits(32)),
+                            bytes(rng.getrandbits(8)
+                                  for _ in range(script_len)),
+                            rng.getrandbits(32)))
+    for _ in range(rng.randint(1, 3)):
+        tx.vout.append(CTxOut(rng.getrandbits(50),
+                              bytes(rng.getrandbits(8) for _ in range(25))))
+    tx.nLockTime = rng.getrandbits(32)
+    return tx
+
+
+def make_block(rng, size):
+    """Build a raw block of roughly `size` bytes out of a pool of random txs."""
+    pool = [random_tx(rng).serialize() for _ in range(64)]
+    header = CBlockHeader()
+    header.hashPrevBlock = rng.getrandbits(256)
+    header.hashMerkleRoot = rng.getrandbits(256)
+    header.nTime = rng.getrandbits(32)
+    header.nBits = 0x207fffff
+    header.nNonce = rng.getrandbits(32)
+    txs = []
+    total = 0
+    while total < size:
+        tx = rng.choice(pool)
+        txs.append(tx)
+        total += len(tx)
+    return header.serialize() + ser_compact_size(len(txs)) + b"".join(txs)
+
+
+def time_decode(name, cls, raw, repeat):
+    def via_stream():
+        m = cls()
+        m.deserialize(BytesIO(raw))
+        return m
+
+    def via_view():
+        m = cls()
+        m.deserialize_from(memoryview(raw))
+        return m
+
+    results = []
+    for decode in (via_stream, via_view):
+        best = float('inf')
+        for _ in range(repeat):
+            time0 = time.perf_counter()
+            m = decode()
+            best = min(best, time.perf_counter() - time0)
+        assert m.serialize() == raw, "{} did not round-trip".format(name)
+        results.append(best)
+    print("{:<12} {:>10} bytes  BytesIO {:8.3f}s  memoryview {:8.3f}s  speedup {:.2f}x".format(
+        name, len(raw), results[0], results[1], results[0] / results[1]))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--size', type=int, default=32,
+                        help='block size in MB (default: 32)')
+    parser.add_argument('--repeat', type=int, default=1,
+                        help='number of timed runs per path (best is kept)')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+
+    raw_block = make_block(rng, args.size * 1000000)
+    time_decode("block", msg_block, raw_block, args.repeat)
+
+    headers = msg_headers()
+    for _ in range(2000):
+        header = CBlockHeader()
+        header.hashPrevBlock = rng.getrandbits(256)
+        header.nTime = rng.getrandbits(32)
+        headers.headers.append(header)
+    time_decode("headers", msg_headers, headers.serialize(), args.repeat)
+
+    block = CBlock()
+    block.deserialize_from(memoryview(make_block(rng, 1000000)))
+    for tx in block.vtx:
+        tx.calc_sha256()
+    cmpct = HeaderAndShortIDs()
+    cmpct.initialize_from_block(block, prefill_list=[0, 1, 5])
+    time_decode("cmpctblock", msg_cmpctblock,
+                msg_cmpctblock(cmpct.to_p2p()).serialize(), args.repeat)
+
+
+if __name__ == '__main__':
+    main()
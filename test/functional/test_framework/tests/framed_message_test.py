@@ -0,0 +1,81 @@
+#!/usr/bin/env python3
+# Copyright (c) 2019 The Bitcoin developers
+# Distributed under the MIT software license, see the accompanying
+# file COPYING or http://www.opensource.org/licenses/mit-license.php.
+"""
+Check that FramedMessageCache reuses a framed block or transaction only while
+it still matches the object, including when the object is modified without
+calling rehash(), and that its frames match the ones P2PConnection builds.
+"""
+
+from test_framework.blocktools import create_block, create_coinbase
+from test_framework.messages import (
+    COutPoint,
+    CTransaction,
+    CTxIn,
+    CTxOut,
+    msg_block,
+    msg_tx,
+)
+from test_framework.mininode import (
+    FramedMessageCache,
+    P2PConnection,
+)
+
+
+def reference_frame(message, network):
+    conn = P2PConnection.__new__(P2PConnection)
+    conn.network = network
+    return conn.format_message(message)
+
+
+def check(cache, message_class, obj):
+    framed = cache.get(message_class, obj, "regtest")
+    assert framed.frame("regtest") == \
+        reference_frame(message_class(obj), "regtest")
+    assert framed.frame("testnet3") == \
+        reference_frame(message_class(obj), "testnet3")
+    return framed
+
+
+def main():
+    cache = FramedMessageCache()
+    tx = CTransaction()
+    tx.vin.append(CTxIn(COutPoint(1, 0), b"\x51"))
+    tx.vout.append(CTxOut(1000, b"\x51"))
+    tx.rehash()
+    txid = tx.sha256
+
+    framed = check(cache, msg_tx, tx)
+    assert check(cache, msg_tx, tx) is framed
+
+    # Modified without rehash(): same key, new frame
+    tx.vout[0].nValue = 2000
+    assert tx.sha256 == txid
+    modified = check(cache, msg_tx, tx)
+    assert modified is not framed
+    assert check(cache, msg_tx, tx) is modified
+
+    # An equal object is framed on its own
+    other = CTransaction(tx)
+    assert check(cache, msg_tx, other) is not modified
+
+    # Cached transactions in a cached block
+    block = create_block(1, create_coinbase(1), 1000)
+    block.vtx.append(tx)
+    block.enable_cache()
+    block.hashMerkleRoot = block.calc_merkle_root()
+    block.rehash()
+    framed = check(cache, msg_block, block)
+    assert check(cache, msg_block, block) is framed
+    tx.nLockTime += 1
+    assert check(cache, msg_block, block) is not framed
+    block.nNonce += 1
+    assert check(cache, msg_block, block) is not framed
+
+    assert cache.size == sum(entry[2] for entry in cache._entries.values())
+    print("FramedMessageCache self-test passed")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,196 @@
+#!/usr/bin/env python3
+# Copyright (c) 2019 The Bitcoin developers
+# Distributed under the MIT software license, see the accompanying
+# file COPYING or http://www.opensource.org/licenses/mit-license.php.
+"""
+Check the HeaderIndex used by P2PDataStore to answer getheaders.
+
+get_ancestor() is compared with walking the prev pointers, and the headers
+returned for locators on the active chain and on forks, before and after a
+reorg to a tip with more chain work, with the linear walk back from the tip
+that P2PDataStore used before. Headers added before their parent must end
+up with the same heights, chain work and skip pointers as when they are
+added in order.
+"""
+
+import argparse
+import random
+
+from test_framework.blockstore import HeaderIndex
+from test_framework.messages import (
+    CBlockHeader,
+    CBlockLocator,
+    msg_headers,
+)
+
+REGTEST_BITS = 0x207fffff
+# Much more work per header than REGTEST_BITS
+HARDER_BITS = 0x1f00ffff
+
+
+def make_chain(prev_hash, count, rng, nBits=REGTEST_BITS):
+    headers = []
+    for _ in range(count):
+        header = CBlockHeader()
+        header.hashPrevBlock = prev_hash
+        header.hashMerkleRoot = rng.getrandbits(256)
+        header.nTime = 1500000000 + len(headers)
+        header.nBits = nBits
+        header.rehash()
+        headers.append(header)
+        prev_hash = header.sha256
+    return headers
+
+
+def get_locator(index, entry):
+    """Locator as built by CChain::GetLocator()."""
+    hashes = []
+    step = 1
+    while entry is not None:
+        hashes.append(entry.hash)
+        if entry.height == 0:
+            break
+        entry = entry.get_ancestor(max(entry.height - step, 0))
+        if len(hashes) > 10:
+            step *= 2
+    locator = CBlockLocator()
+    locator.vHave = hashes
+    return locator
+
+
+def reference_headers_for(headers_map, tip_hash, locator, hash_stop):
+    """The linear walk of the former P2PDataStore.on_getheaders()."""
+    headers_list = [headers_map[tip_hash]]
+    while headers_list[0].sha256 not in locator.vHave:
+        prev = headers_map.get(headers_list[0].hashPrevBlock)
+        if prev is None:
+            break
+        headers_list.insert(0, prev)
+    headers_list = headers_list[:2000]
+    hash_list = [x.sha256 for x in headers_list]
+    index = len(headers_list)
+    if hash_stop in hash_list:
+        index = hash_list.index(hash_stop) + 1
+    return headers_list[:index]
+
+
+def check_ancestors(index, rng):
+    tip = index.get_tip()
+    for _ in range(200):
+        entry = index.chain[rng.randrange(len(index.chain))]
+        for height in (0, 1, entry.height // 2, entry.height - 1,
+                       entry.height, rng.randint(0, entry.height)):
+            walk = entry
+            while walk is not None and walk.height > height:
+                walk = walk.prev
+            assert entry.get_ancestor(height) is walk
+    assert tip.get_ancestor(tip.height + 1) is None
+    assert tip.get_ancestor(-1) is None
+
+
+def check_responses(index, headers_map, entries, rng):
+    """Compare the responses to locators built from entries, with a few
+    hash_stop values each, with the reference implementation."""
+    tip_hash = index.get_tip().hash
+    for entry in entries:
+        locator = get_locator(index, entry)
+        fork_height = index.find_fork(locator).height
+        stops = [0, entry.hash, rng.getrandbits(256),
+                 index.chain[min(fork_height + 1, len(index.chain) - 1)].hash,
+                 index.chain[min(fork_height + 1999,
+                                 len(index.chain) - 1)].hash,
+                 index.chain[min(fork_height + 2000,
+                                 len(index.chain) - 1)].hash,
+                 index.chain[rng.randrange(len(index.chain))].hash]
+        for hash_stop in stops:
+            expected = reference_headers_for(
+                headers_map, tip_hash, locator, hash_stop)
+            headers = index.headers_for(locator, hash_stop)
+            assert [h.sha256 for h in headers] == \
+                [h.sha256 for h in expected]
+            payload = index.serialized_headers_for(locator, hash_stop)
+            assert payload == msg_headers(expected).serialize()
+
+
+def check_out_of_order(headers, rng):
+    """Add headers in a random order and compare with an index built in
+    order."""
+    ordered = HeaderIndex()
+    for header in headers:
+        ordered.add(header)
+    shuffled = HeaderIndex()
+    tip = headers[-1]
+    for header in rng.sample(headers, len(headers)):
+        shuffled.add(header)
+        if header is tip:
+            # Make the active chain end at the tip before its ancestors are
+            # all known, it must be reconnected with them
+            shuffled.set_tip(tip.sha256)
+    ordered.set_tip(tip.sha256)
+    assert list(shuffled.orphans) == [0]
+    assert set(e.hash for e in shuffled.tips) == \
+        set(e.hash for e in ordered.tips)
+    assert [e.hash for e in shuffled.chain] == [e.hash for e in ordered.chain]
+    for blockhash, entry in ordered.entries.items():
+        other = shuffled.get(blockhash)
+        assert other.height == entry.height
+        assert other.chainwork == entry.chainwork
+        assert (other.prev and other.prev.hash) == \
+            (entry.prev and entry.prev.hash)
+        assert (other.skip and other.skip.hash) == \
+            (entry.skip and entry.skip.hash)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--length', type=int, default=5000,
+                        help='length of the main chain (default: 5000)')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    rng = random.Random(args.seed)
+
+    main_chain = make_chain(0, args.length, rng)
+    fork_height = args.length - 700
+    # A longer fork with the same work per header, and a shorter one with
+    # more chain work, both from the same block of the main chain
+    long_fork = make_chain(main_chain[fork_height].sha256, 1000, rng)
+    hard_fork = make_chain(main_chain[fork_height].sha256, 20, rng,
+                           HARDER_BITS)
+    headers_map = {h.sha256: h for h in main_chain + long_fork + hard_fork}
+
+    index = HeaderIndex()
+    for header in main_chain + long_fork + hard_fork:
+        index.add(header)
+    assert len(index) == len(headers_map)
+    assert set(e.hash for e in index.tips) == \
+        {main_chain[-1].sha256, long_fork[-1].sha256, hard_fork[-1].sha256}
+
+    index.set_tip(main_chain[-1].sha256)
+    check_ancestors(index, rng)
+    fork_entries = [index.get(h.sha256) for h in long_fork[::97] + hard_fork]
+    main_entries = [index.chain[h] for h in
+                    (0, 1, 10, 1999, 2000, 2001, fork_height,
+                     args.length - 1)]
+    check_responses(index, headers_map, main_entries + fork_entries, rng)
+
+    # Reorg to the longer fork, then to the one with the most work
+    index.set_tip(long_fork[-1].sha256)
+    assert len(index.chain) == fork_height + 1 + len(long_fork)
+    check_ancestors(index, rng)
+    check_responses(index, headers_map, main_entries + fork_entries, rng)
+
+    best = index.best_tip()
+    assert best.hash == hard_fork[-1].sha256
+    assert best.chainwork > index.get(long_fork[-1].sha256).chainwork
+    index.set_tip(best.hash)
+    assert [e.hash for e in index.chain[fork_height + 1:]] == \
+        [h.sha256 for h in hard_fork]
+    check_ancestors(index, rng)
+    check_responses(index, headers_map, main_entries + fork_entries, rng)
+
+    check_out_of_order(make_chain(0, 300, rng) + make_chain(0, 10, rng), rng)
+    print("HeaderIndex self-test passed")
+
+
+if __name__ == '__main__':
+    main()
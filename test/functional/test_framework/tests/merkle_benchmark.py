@@ -0,0 +1,98 @@
+#!/usr/bin/env python3
+# Copyright (c) 2019 The Bitcoin developers
+# Distributed under the MIT software license, see the accompanying
+# file COPYING or http://www.opensource.org/licenses/mit-license.php.
+"""
+Compare recomputing the merkle root from scratch with the incremental
+MerkleTree while a block is grown, reordered and modified one transaction at
+a time, the way feature_block.py's update_block() does.
+
+The transactions cache their txids in both runs, so only the merkle root
+computation differs. Every root, branch and partial merkle tree is checked
+against the reference computation. The default is 500 transactions, use
+--txs to change it: the full computation is quadratic in the block size.
+"""
+
+import argparse
+import random
+import time
+
+from test_framework.blocktools import create_block, create_coinbase
+from test_framework.messages import (
+    CBlock,
+    COutPoint,
+    CTransaction,
+    CTxIn,
+    CTxOut,
+    MerkleTree,
+    ser_uint256,
+    uint256_from_str,
+)
+
+
+def random_tx(rng):
+    tx = CTransaction()
+    tx.vin.append(CTxIn(COutPoint(rng.getrandbits(256), 0), b"\x51"))
+    tx.vout.append(CTxOut(rng.getrandbits(40), b"\x51"))
+    return tx.enable_cache()
+
+
+def check_tree(rng, block, tree):
+    hashes = [ser_uint256(tx.sha256) for tx in block.vtx]
+    assert tree.root() == block.get_merkle_root(hashes)
+    for i in rng.sample(range(len(hashes)), min(len(hashes), 8)):
+        branch = tree.get_branch(i)
+        assert MerkleTree.root_from_branch(hashes[i], branch, i) == tree.root()
+    matches = [rng.random() < 0.05 for _ in hashes]
+    pmt = tree.partial_merkle_tree(matches)
+    assert len(pmt.vHash) <= len(hashes)
+    assert all(uint256_from_str(hashes[i]) in pmt.vHash
+               for i, match in enumerate(matches) if match)
+
+
+def run(rng, ntx, incremental):
+    block = create_block(1, create_coinbase(1))
+    if incremental:
+        block.enable_cache()
+    else:
+        block.vtx[0].enable_cache()
+    time0 = time.perf_counter()
+    for _ in range(ntx):
+        block.vtx.append(random_tx(rng))
+        block.hashMerkleRoot = block.calc_merkle_root()
+    for _ in range(ntx // 10):
+        i = rng.randrange(1, len(block.vtx))
+        block.vtx[i].vout[0].nValue += 1
+        block.hashMerkleRoot = block.calc_merkle_root()
+    block.vtx[1:] = sorted(block.vtx[1:], key=lambda tx: tx.sha256)
+    block.hashMerkleRoot = block.calc_merkle_root()
+    elapsed = time.perf_counter() - time0
+    reference = CBlock(block)
+    reference.vtx = block.vtx
+    assert block.hashMerkleRoot == reference.calc_merkle_root()
+    return block, elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--txs', type=int, default=500,
+                        help='number of transactions added one by one '
+                        '(default: 500)')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    _, full = run(random.Random(args.seed), args.txs, False)
+    block, incremental = run(random.Random(args.seed), args.txs, True)
+    check_tree(random.Random(args.seed), block, block.get_merkle_tree())
+    for n in range(1, 40):
+        block.vtx = block.vtx[:n]
+        block.calc_merkle_root()
+        check_tree(random.Random(n), block, block.merkle_tree)
+        check_tree(random.Random(n), block,
+                   MerkleTree(ser_uint256(tx.sha256) for tx in block.vtx))
+    print("{} txs  full {:8.3f}s  incremental {:8.3f}s  speedup {:.2f}x".format(
+        args.txs, full, incremental, full / incremental))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,149 @@
+#!/usr/bin/env python3
+# Copyright (c) 2019 The Bitcoin developers
+# Distributed under the MIT software license, see the accompanying
+# file COPYING or http://www.opensource.org/licenses/mit-license.php.
+"""
+Compare the P2PConnection receive path with the previous implementation,
+which appended to and re-sliced a bytes object for every read and message.
+
+A burst of 1000 back-to-back inv messages followed by a full-size block is
+written to one end of a socketpair and read by a P2PConnection, driven by an
+asyncio event loop, on the other end. The default block size is 32MB, use --size to change it (in MB).
+"""
+
+import argparse
+import asyncio
+from io import BytesIO
+import socket
+import struct
+import threading
+import time
+
+from test_framework.messages import (
+    CBlockHeader,
+    CInv,
+    CTransaction,
+    CTxOut,
+    msg_inv,
+    ser_compact_size,
+    sha256,
+)
+from test_framework.mininode import (
+    MAGIC_BYTES,
+    MESSAGEMAP,
+    P2PConnection,
+)
+
+
+class Receiver(P2PConnection):
+    def __init__(self, loop, expected):
+        super().__init__()
+        self.peer_connect("socketpair", 0)
+        self._loop = loop
+        self.expected = expected
+        self.received = []
+        self.done = loop.create_future()
+
+    def on_message(self, message):
+        self.received.append(message.command)
+        if len(self.received) == len(self.expected):
+            self.done.set_result(None)
+
+    def on_open(self):
+        pass
+
+    def on_close(self):
+        pass
+
+    def _log_message(self, direction, msg):
+        pass
+
+
+class LegacyReceiver(Receiver):
+    """The receive path as it was before ByteBuffer."""
+
+    def __init__(self, loop, expected):
+        super().__init__(loop, expected)
+        self.legacy_recvbuf = b""
+
+    def data_received(self, t):
+        self.legacy_recvbuf += t
+        while True:
+            msg = self._on_data()
+            if msg is None:
+                break
+            self.on_message(msg)
+
+    def _on_data(self):
+        if len(self.legacy_recvbuf) < 4 + 12 + 4 + 4:
+            return None
+        command = self.legacy_recvbuf[4:4+12].split(b"\x00", 1)[0]
+        msglen = struct.unpack("<i", self.legacy_recvbuf[4+12:4+12+4])[0]
+        checksum = self.legacy_recvbuf[4+12+4:4+12+4+4]
+        if len(self.legacy_recvbuf) < 4 + 12 + 4 + 4 + msglen:
+            return None
+        msg = self.legacy_recvbuf[4+12+4+4:4+12+4+4+msglen]
+        assert checksum == sha256(sha256(msg))[:4]
+        self.legacy_recvbuf = self.legacy_recvbuf[4+12+4+4+msglen:]
+        m = MESSAGEMAP[command]()
+        if hasattr(m, "deserialize_from"):
+            m.deserialize_from(memoryview(msg))
+        else:
+            m.deserialize(BytesIO(msg))
+        return m
+
+
+def make_block(size):
+    tx = CTransaction()
+    tx.vout.append(CTxOut(0, b"\x6a" * 100000))
+    raw_tx = tx.serialize()
+    count = max(1, size // len(raw_tx))
+    return CBlockHeader().serialize() + ser_compact_size(count) + raw_tx * count
+
+
+def frame(command, data):
+    return (MAGIC_BYTES["regtest"] + command + b"\x00" * (12 - len(command)) +
+            struct.pack("<I", len(data)) + sha256(sha256(data))[:4] + data)
+
+
+def run(cls, stream, expected):
+    reader, writer = socket.socketpair()
+    loop = asyncio.new_event_loop()
+    conn = cls(loop, expected)
+    sender = threading.Thread(target=writer.sendall, args=(stream,),
+                              daemon=True)
+    time0 = time.perf_counter()
+    sender.start()
+    loop.run_until_complete(loop.create_connection(lambda: conn, sock=reader))
+    loop.run_until_complete(conn.done)
+    elapsed = time.perf_counter() - time0
+    sender.join()
+    conn.disconnect_node()
+    writer.close()
+    loop.run_until_complete(asyncio.sleep(0))
+    loop.close()
+    assert conn.received == expected
+    return elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--size', type=int, default=32,
+                        help='block size in MB (default: 32)')
+    parser.add_argument('--count', type=int, default=1000,
+                        help='number of inv messages (default: 1000)')
+    args = parser.parse_args()
+
+    stream = b"".join(frame(b"inv", msg_inv([CInv(1, i)]).serialize())
+                      for i in range(args.count))
+    stream += frame(b"block", make_block(args.size * 1000000))
+    expected = [b"inv"] * args.count + [b"block"]
+
+    legacy = run(LegacyReceiver, stream, expected)
+    current = run(Receiver, stream, expected)
+    print("{} invs + {}MB block  bytes {:8.3f}s  ByteBuffer {:8.3f}s  speedup {:.2f}x".format(
+        args.count, args.size, legacy, current, legacy / current))
+
+
+if __name__ == '__main__':
+    main()
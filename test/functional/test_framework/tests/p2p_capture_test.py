@@ -0,0 +1,148 @@
+#!/usr/bin/env python3
+# Copyright (c) 2019 The Bitcoin developers
+# Distributed under the MIT software license, see the accompanying
+# file COPYING or http://www.opensource.org/licenses/mit-license.php.
+"""
+Round trip a P2P capture: record the traffic of a P2PInterface in two
+capture sessions, read it back with read_capture() and replay it with a
+CaptureReplayer against a stub connection.
+
+Checks that timestamps are ordered across sessions, that a truncated last
+record is ignored, and that a paced replay keeps the spacing of the messages
+within a session without waiting for the gap between sessions.
+"""
+
+import os
+import tempfile
+import time
+
+from test_framework.loadgen import CaptureReplayer
+from test_framework.messages import (
+    CInv,
+    msg_getaddr,
+    msg_headers,
+    msg_inv,
+    msg_mempool,
+    msg_ping,
+    MSG_TX,
+)
+from test_framework.mininode import (
+    mininode_socket_map,
+    P2PInterface,
+)
+from test_framework.p2pcapture import (
+    CAPTURE_RECORD,
+    CAPTURE_RECV,
+    CAPTURE_SEND,
+    CAPTURE_SESSION,
+    P2PCapture,
+    read_capture,
+)
+
+# Spacing of the messages of a session, in seconds
+SPACING = 0.05
+# Time between the two sessions
+SESSION_GAP = 1.0
+
+
+class StubPeer():
+    """Stands in for the LoadPeer of a CaptureReplayer and records the
+    messages it is asked to send, with the time they are sent at."""
+    network = "regtest"
+
+    def __init__(self):
+        self.sent = []
+
+    def wait_for_verack(self, timeout=60):
+        pass
+
+    def send_raw_message(self, message):
+        self.sent.append((time.monotonic(), message))
+
+    def sync_with_ping(self, timeout=60):
+        pass
+
+
+class StubNode():
+    def __init__(self):
+        self.peer = StubPeer()
+
+    def add_p2p_connection(self, p2p_conn):
+        return self.peer
+
+
+def capture_session(path, messages):
+    """Send messages from a P2PInterface capturing to path, SPACING seconds
+    apart, and make it receive an empty headers message. Returns the framed
+    messages that were sent, starting with the version message pushed by
+    peer_connect()."""
+    conn = P2PInterface()
+    with P2PCapture(path) as capture:
+        conn.peer_connect("127.0.0.1", 0, capture=capture)
+        # The connection is never opened
+        del mininode_socket_map[id(conn)]
+        for i, message in enumerate(messages):
+            if i:
+                time.sleep(SPACING)
+            conn.send_message(message, pushbuf=True)
+        conn.data_received(conn.format_message(msg_headers()))
+        return list(conn.sendbuf)
+
+
+def main():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        path = os.path.join(tmpdir, "capture.bin")
+        first = capture_session(path, [msg_ping(1), msg_getaddr(),
+                                       msg_inv([CInv(MSG_TX, 1)])])
+        time.sleep(SESSION_GAP)
+        second = capture_session(path, [msg_mempool(), msg_ping(2)])
+
+        records = list(read_capture(path))
+        directions = [direction for _, direction, _ in records]
+        assert directions == [CAPTURE_SESSION] + [CAPTURE_SEND] * 4 + \
+            [CAPTURE_RECV, CAPTURE_SESSION] + [CAPTURE_SEND] * 3 + \
+            [CAPTURE_RECV], directions
+        timestamps = [timestamp for timestamp, _, _ in records]
+        assert timestamps == sorted(timestamps)
+        # Wall clock timestamps
+        assert abs(timestamps[-1] - int(time.time() * 1e9)) < 60 * 10**9
+        assert timestamps[6] - timestamps[5] >= SESSION_GAP * 1e9
+        sent = [data for _, _, data in read_capture(path, CAPTURE_SEND)]
+        assert sent == first + second
+        sent_timestamps = [timestamp for timestamp, _, _ in
+                           read_capture(path, CAPTURE_SEND)]
+        received = [data for _, _, data in read_capture(path, CAPTURE_RECV)]
+        assert [data[4:11] for data in received] == [b"headers"] * 2
+
+        # A record cut short by a killed process is ignored
+        with open(path, "ab") as f:
+            f.write(CAPTURE_RECORD.pack(0, CAPTURE_SEND, 100) + b"\x00" * 50)
+        assert len(list(read_capture(path))) == len(records)
+
+        # Replay as fast as possible: version and ping are left out
+        replayer = CaptureReplayer(StubNode(), path)
+        report = replayer.run()
+        replayed = [message for _, message in replayer.peer.sent]
+        assert replayed == [first[2], first[3], second[1]]
+        assert report["messages"] == 3
+        assert report["bytes"] == sum(len(message) for message in replayed)
+
+        # Paced replay
+        replayer = CaptureReplayer(StubNode(), path, paced=True, skip=())
+        start = time.monotonic()
+        replayer.run()
+        duration = time.monotonic() - start
+        times = [sent_time for sent_time, _ in replayer.peer.sent]
+        assert [message for _, message in replayer.peer.sent] == \
+            first + second
+        # Messages are paced from the first message of their session
+        for start, end in ((0, len(first)), (len(first), len(sent))):
+            for i in range(start + 1, end):
+                captured = (sent_timestamps[i] - sent_timestamps[start]) / 1e9
+                assert times[i] - times[start] >= captured - 0.005, times
+        assert duration < SESSION_GAP, duration
+    print("P2P capture self-test passed")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,191 @@
+#!/usr/bin/env python3
+# Copyright (c) 2019 The Bitcoin developers
+# Distributed under the MIT software license, see the accompanying
+# file COPYING or http://www.opensource.org/licenses/mit-license.php.
+"""
+Feed messages through P2PMetrics, directly and from a P2PInterface, and check
+the counters, response times and send queue reported by snapshot(), and the
+file written by P2PMetricsDump.
+"""
+
+import json
+import os
+import tempfile
+
+from test_framework.messages import (
+    CInv,
+    CTransaction,
+    msg_getdata,
+    msg_inv,
+    msg_ping,
+    msg_pong,
+    msg_tx,
+    MSG_BLOCK,
+    MSG_TX,
+)
+from test_framework.mininode import (
+    mininode_socket_map,
+    P2PInterface,
+)
+from test_framework.p2pmetrics import (
+    MAX_PENDING_RESPONSES,
+    P2PMetrics,
+    P2PMetricsDump,
+)
+
+
+def check_counters():
+    metrics = P2PMetrics()
+    metrics.sent("ping", 32)
+    metrics.sent("ping", 32)
+    metrics.sent("tx", 100)
+    metrics.received("inv", 61, 0.002, msg_inv([CInv(MSG_TX, 1)]))
+    metrics.received("inv", 61, 0.004, msg_inv([CInv(MSG_TX, 2)]))
+    metrics.received("pong", 32, 0.001, msg_pong(1))
+
+    snapshot = metrics.snapshot()
+    assert snapshot["bytes_out"] == 164
+    assert snapshot["bytes_in"] == 154
+    assert abs(snapshot["decode_time"] - 0.007) < 1e-9
+    commands = snapshot["commands"]
+    assert sorted(commands) == ["inv", "ping", "pong", "tx"]
+    assert commands["ping"]["msgs_out"] == 2
+    assert commands["ping"]["bytes_out"] == 64
+    assert commands["ping"]["msgs_in"] == 0
+    assert commands["ping"]["decode_time_avg"] is None
+    assert commands["inv"]["msgs_in"] == 2
+    assert commands["inv"]["bytes_in"] == 122
+    assert abs(commands["inv"]["decode_time_avg"] - 0.003) < 1e-9
+    # No ping was expected to be answered
+    assert snapshot["responses"] == {}
+    json.dumps(snapshot)
+
+
+def check_responses():
+    metrics = P2PMetrics()
+    metrics.expect_response(msg_ping(7))
+    metrics.expect_response(msg_inv([CInv(MSG_TX, 1), CInv(MSG_BLOCK, 2)]))
+    # The node never announces a tx or a block back to its sender, nothing
+    # is expected for them
+    tx = CTransaction()
+    tx.rehash()
+    metrics.expect_response(msg_tx(tx))
+    metrics.expect_response(msg_getdata([CInv(MSG_TX, 3)]))
+    assert metrics.snapshot()["pending_responses"] == 3
+
+    metrics.received("pong", 32, 0, msg_pong(8))
+    metrics.received("inv", 61, 0, msg_inv([CInv(MSG_TX, tx.sha256)]))
+    assert metrics.snapshot()["pending_responses"] == 3
+    metrics.received("pong", 32, 0, msg_pong(7))
+    metrics.received("getdata", 61, 0, msg_getdata(
+        [CInv(MSG_TX, 1), CInv(MSG_BLOCK, 2)]))
+
+    snapshot = metrics.snapshot()
+    assert snapshot["pending_responses"] == 0
+    responses = snapshot["responses"]
+    assert sorted(responses) == ["inv->getdata", "ping->pong"]
+    assert responses["ping->pong"]["count"] == 1
+    assert responses["inv->getdata"]["count"] == 2
+    for summary in responses.values():
+        assert 0 <= summary["p50_ms"] <= summary["p99_ms"] <= \
+            summary["max_ms"]
+
+    # Unanswered requests are forgotten, oldest first
+    for nonce in range(MAX_PENDING_RESPONSES + 10):
+        metrics.expect_response(msg_ping(nonce))
+    assert metrics.snapshot()["pending_responses"] == MAX_PENDING_RESPONSES
+    metrics.received("pong", 32, 0, msg_pong(9))
+    metrics.received("pong", 32, 0, msg_pong(10))
+    assert metrics.snapshot()["responses"]["ping->pong"]["count"] == 2
+
+
+def check_send_queue():
+    metrics = P2PMetrics()
+    metrics.sent("block", 1000)
+    metrics.sent("tx", 200)
+    metrics.written(1000, 600)
+    queue = metrics.snapshot()["send_queue"]
+    assert queue == {"queued_bytes": 200, "transport_bytes": 600,
+                     "max_bytes": 1200}, queue
+    metrics.written(200, 0)
+    queue = metrics.snapshot()["send_queue"]
+    assert queue["queued_bytes"] == 0 and queue["transport_bytes"] == 0
+
+    # Messages still queued when the connection closes are dropped
+    metrics.sent("tx", 300)
+    metrics.close()
+    metrics.sent("tx", 300)
+    snapshot = metrics.snapshot()
+    assert snapshot["send_queue"] == {"queued_bytes": 0,
+                                      "transport_bytes": 0,
+                                      "max_bytes": 1200}
+    assert snapshot["commands"]["tx"]["bytes_out"] == 800
+
+
+def check_connection():
+    """Metrics recorded by a P2PInterface for the messages it sends and
+    receives."""
+    conn = P2PInterface()
+    conn.peer_connect("127.0.0.1", 0)
+    # The connection is never opened
+    del mininode_socket_map[id(conn)]
+    conn.send_message(msg_ping(1), pushbuf=True)
+    conn.data_received(conn.format_message(msg_pong(1)))
+
+    snapshot = conn.metrics.snapshot()
+    commands = snapshot["commands"]
+    # peer_connect() pushes a version message
+    assert commands["version"]["msgs_out"] == 1
+    assert commands["ping"]["bytes_out"] == \
+        len(conn.format_message(msg_ping(1)))
+    assert commands["pong"]["msgs_in"] == 1
+    assert snapshot["responses"]["ping->pong"]["count"] == 1
+    # Nothing was written to a socket
+    assert snapshot["send_queue"]["queued_bytes"] == snapshot["bytes_out"]
+    return conn
+
+
+class StubConnection():
+    def __init__(self, port):
+        self.dstaddr = "127.0.0.1"
+        self.dstport = port
+        self.metrics = P2PMetrics()
+
+
+def check_dump(conn):
+    with tempfile.TemporaryDirectory() as tmpdir:
+        path = os.path.join(tmpdir, "metrics.json")
+        connections = [conn, StubConnection(1)]
+        dump = P2PMetricsDump(path, lambda: list(connections), interval=60)
+        dump.dump()
+        with open(path, encoding="utf8") as f:
+            first = json.load(f)
+        assert [c["peer"] for c in first["connections"]] == \
+            ["127.0.0.1:0", "127.0.0.1:1"]
+        assert first["connections"][0]["commands"]["pong"]["msgs_in"] == 1
+
+        # A disconnected connection stays in the file with its last metrics
+        connections.pop(0)
+        connections.append(StubConnection(2))
+        dump.start()
+        dump.stop()
+        with open(path, encoding="utf8") as f:
+            last = json.load(f)
+        assert [c["peer"] for c in last["connections"]] == \
+            ["127.0.0.1:0", "127.0.0.1:1", "127.0.0.1:2"]
+        assert last["connections"][0]["bytes_in"] == \
+            first["connections"][0]["bytes_in"]
+        assert last["time"] >= first["time"]
+        assert os.listdir(tmpdir) == ["metrics.json"]
+
+
+def main():
+    check_counters()
+    check_responses()
+    check_send_queue()
+    check_dump(check_connection())
+    print("P2P metrics self-test passed")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,158 @@
+#!/usr/bin/env python3
+# Copyright (c) 2019 The Bitcoin developers
+# Distributed under the MIT software license, see the accompanying
+# file COPYING or http://www.opensource.org/licenses/mit-license.php.
+"""
+Stream a chain of blocks with P2PDataStore.stream_blocks() to a stub node
+that requests the announced blocks and answers pings late, and check that
+no more than the window of blocks is ever in flight, including for blocks
+the node requests beyond the window, that every block is sent once and in
+order, and that the stream state is reset afterwards.
+"""
+
+from queue import Empty, Queue
+import threading
+
+from test_framework.blocktools import create_block, create_coinbase
+from test_framework.messages import (
+    CInv,
+    msg_getdata,
+    msg_pong,
+    MSG_BLOCK,
+)
+from test_framework.mininode import (
+    FramedMessage,
+    MAX_HEADERS_RESULTS,
+    mininode_socket_map,
+    P2PDataStore,
+)
+
+WINDOW = 4
+# Two batches of headers
+CHAIN_LENGTH = MAX_HEADERS_RESULTS + 50
+# How long the stub node waits for more messages before answering pings
+IDLE_TIME = 0.003
+
+
+class StreamingPeer(P2PDataStore):
+    """A P2PDataStore that hands the messages it sends to a StubNode instead
+    of a socket."""
+
+    def __init__(self):
+        super().__init__()
+        self.node = None
+
+    def send_message(self, message, pushbuf=False):
+        self.node.messages.put(message)
+
+
+class StubNode():
+    """Processes the messages of a StreamingPeer: requests the announced
+    blocks it hasn't received yet if request is set, and answers pings only
+    when no other message comes in, so that the window fills up."""
+
+    def __init__(self, conn, request):
+        self.conn = conn
+        self.request = request
+        self.messages = Queue()
+        self.received = []
+        self.tip = None
+        self.pings = []
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.thread = threading.Thread(target=self.run)
+        conn.node = self
+        self.thread.start()
+
+    def getbestblockhash(self):
+        return self.tip
+
+    def stop(self):
+        self.messages.put(None)
+        self.thread.join()
+
+    def run(self):
+        while True:
+            try:
+                message = self.messages.get(timeout=IDLE_TIME)
+            except Empty:
+                self.answer_pings()
+                continue
+            if message is None:
+                return
+            if isinstance(message, FramedMessage):
+                message = message.message
+            if message.command == b"headers" and self.request:
+                self.conn.on_message(msg_getdata(
+                    [CInv(MSG_BLOCK, header.sha256)
+                     for header in message.headers
+                     if header.sha256 not in self.received]))
+            elif message.command == b"block":
+                self.received.append(message.block.sha256)
+                self.tip = message.block.hash
+                self.in_flight += 1
+                self.max_in_flight = max(self.max_in_flight, self.in_flight)
+            elif message.command == b"ping":
+                self.pings.append(message.nonce)
+
+    def answer_pings(self):
+        pings, self.pings = self.pings, []
+        self.in_flight -= len(pings)
+        for nonce in pings:
+            self.conn.on_message(msg_pong(nonce))
+
+
+def make_chain(count):
+    blocks = []
+    prev_hash = 1
+    for height in range(1, count + 1):
+        block = create_block(prev_hash, create_coinbase(height),
+                             1500000000 + height)
+        block.rehash()
+        blocks.append(block)
+        prev_hash = block.sha256
+    return blocks
+
+
+def check_stream(conn, blocks, push, request):
+    node = StubNode(conn, request)
+    try:
+        result = conn.stream_blocks(iter(blocks), node, window=WINDOW,
+                                    push=push, timeout=30)
+    finally:
+        node.stop()
+    assert result["blocks"] == len(blocks)
+    assert node.received == [block.sha256 for block in blocks]
+    assert node.max_in_flight == WINDOW, node.max_in_flight
+    assert conn.stream_window is None
+    assert not conn.stream_served
+    assert not conn.stream_deferred
+
+
+def main():
+    conn = StreamingPeer()
+    conn.peer_connect("127.0.0.1", 0, send_version=False)
+    # The connection is never opened
+    del mininode_socket_map[id(conn)]
+    blocks = make_chain(CHAIN_LENGTH)
+
+    # Pushed blocks only
+    check_stream(conn, blocks, push=True, request=False)
+    # Requested blocks only: the node asks for a whole batch at once, the
+    # requests beyond the window are held back
+    check_stream(conn, blocks, push=False, request=True)
+    # Pushed and requested
+    check_stream(conn, blocks, push=True, request=True)
+
+    # Outside of a stream, requested blocks are sent right away without a
+    # ping
+    node = StubNode(conn, request=False)
+    conn.on_message(msg_getdata([CInv(MSG_BLOCK, blocks[0].sha256)]))
+    node.stop()
+    assert node.received == [blocks[0].sha256]
+    assert node.pings == [] and node.in_flight == 1
+    print("Block streaming self-test passed")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,58 @@
+#!/usr/bin/env python3
+# Copyright (c) 2019 The Bitcoin developers
+# Distributed under the MIT software license, see the accompanying
+# file COPYING or http://www.opensource.org/licenses/mit-license.php.
+"""
+Compare verifying Schnorr signatures one by one with schnorr.verify_batch().
+
+The signatures are made by --keys different keys, as test blocks are usually
+signed by only a few. The default is 2000 signatures, use --count to change
+it.
+"""
+
+import argparse
+import random
+import time
+
+from test_framework import schnorr
+from test_framework.signing import sign_batch
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--count', type=int, default=2000,
+                        help='number of signatures (default: 2000)')
+    parser.add_argument('--keys', type=int, default=10,
+                        help='number of signing keys (default: 10)')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    keys = [bytes(rng.getrandbits(8) for _ in range(32))
+            for _ in range(args.keys)]
+    pubkeys = [schnorr.getpubkey(key) for key in keys]
+    sighashes = [bytes(rng.getrandbits(8) for _ in range(32))
+                 for _ in range(args.count)]
+    signatures = sign_batch([(keys[i % args.keys], sighash)
+                             for i, sighash in enumerate(sighashes)])
+    items = [(pubkeys[i % args.keys], sighash, signature)
+             for i, (sighash, signature) in enumerate(zip(sighashes, signatures))]
+
+    time0 = time.perf_counter()
+    assert all(schnorr.verify(*item) for item in items)
+    single = time.perf_counter() - time0
+
+    time0 = time.perf_counter()
+    assert schnorr.verify_batch(items)
+    batch = time.perf_counter() - time0
+
+    pubkey, sighash, signature = items[-1]
+    assert not schnorr.verify_batch(
+        items[:-1] + [(pubkey, sighash, signature[:32] + bytes(32))])
+
+    print("{} signatures, {} keys  single {:8.3f}s  batch {:8.3f}s  speedup {:.2f}x".format(
+        args.count, args.keys, single, batch, single / batch))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,73 @@
+#!/usr/bin/env python3
+# Copyright (c) 2019 The Bitcoin developers
+# Distributed under the MIT software license, see the accompanying
+# file COPYING or http://www.opensource.org/licenses/mit-license.php.
+"""
+Compare computing the SignatureHashForkId of every input of a large
+transaction with and without a PrecomputedTransactionData.
+
+Without it, every input rehashes all the prevouts, sequences and outputs, so
+only --sample inputs are timed and the total is extrapolated from them. The
+default transaction has 5000 inputs, use --inputs to change it.
+"""
+
+import argparse
+import random
+import time
+
+from test_framework.messages import (
+    COutPoint,
+    CTransaction,
+    CTxIn,
+    CTxOut,
+)
+from test_framework.script import (
+    CScript,
+    OP_CHECKSIG,
+    OP_DUP,
+    OP_EQUALVERIFY,
+    OP_HASH160,
+    PrecomputedTransactionData,
+    SIGHASH_ALL,
+    SIGHASH_FORKID,
+    SignatureHashForkId,
+)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--inputs', type=int, default=5000,
+                        help='number of inputs (default: 5000)')
+    parser.add_argument('--sample', type=int, default=50,
+                        help='number of inputs timed without precomputed data')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    script = CScript([OP_DUP, OP_HASH160, bytes(20), OP_EQUALVERIFY,
+                      OP_CHECKSIG])
+    tx = CTransaction()
+    for _ in range(args.inputs):
+        tx.vin.append(CTxIn(COutPoint(rng.getrandbits(256), 0), b""))
+        tx.vout.append(CTxOut(rng.getrandbits(32), script))
+    hashtype = SIGHASH_ALL | SIGHASH_FORKID
+    sample = min(args.sample, args.inputs)
+
+    time0 = time.perf_counter()
+    reference = [SignatureHashForkId(script, tx, i, hashtype, 1000)
+                 for i in range(sample)]
+    uncached = (time.perf_counter() - time0) / sample * args.inputs
+
+    time0 = time.perf_counter()
+    txdata = PrecomputedTransactionData(tx)
+    hashes = [SignatureHashForkId(script, tx, i, hashtype, 1000, txdata)
+              for i in range(args.inputs)]
+    cached = time.perf_counter() - time0
+
+    assert hashes[:sample] == reference, "sighash mismatch"
+    print("{} inputs  without txdata {:8.3f}s (extrapolated)  with txdata {:8.3f}s  speedup {:.1f}x".format(
+        args.inputs, uncached, cached, uncached / cached))
+
+
+if __name__ == '__main__':
+    main()
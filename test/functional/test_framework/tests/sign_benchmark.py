@@ -0,0 +1,70 @@
+#!/usr/bin/env python3
+# Copyright (c) 2019 The Bitcoin developers
+# Distributed under the MIT software license, see the accompanying
+# file COPYING or http://www.opensource.org/licenses/mit-license.php.
+"""
+Compare signing hashes one by one with sign_batch() on a thread pool, for
+both ECDSA and Schnorr.
+
+The ECDSA signatures are checked with CECKey.verify(), the deterministic
+Schnorr signatures must be identical to the serial ones. The default is
+2000 signatures on one thread per CPU, and at least 2 threads so that the
+thread pool is used, use --count and --threads to change it. The speedup is
+bounded by the number of CPUs.
+"""
+
+import argparse
+import os
+import random
+import time
+
+from test_framework import schnorr
+from test_framework.key import CECKey
+from test_framework.signing import default_threads, sign_batch
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--count', type=int, default=2000,
+                        help='number of signatures (default: 2000)')
+    parser.add_argument('--threads', type=int,
+                        default=max(2, default_threads()),
+                        help='signing threads, at least 2 (default: one per '
+                        'CPU)')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    if args.threads < 2:
+        parser.error("--threads must be at least 2")
+    print("CPUs: {}".format(os.cpu_count()))
+
+    rng = random.Random(args.seed)
+    secret = bytes(rng.getrandbits(8) for _ in range(32))
+    ecdsa_key = CECKey()
+    ecdsa_key.set_secretbytes(secret)
+    sighashes = [bytes(rng.getrandbits(8) for _ in range(32))
+                 for _ in range(args.count)]
+
+    for name, key in (("ecdsa", ecdsa_key), ("schnorr", secret)):
+        pairs = [(key, sighash) for sighash in sighashes]
+
+        time0 = time.perf_counter()
+        serial = sign_batch(pairs, threads=1)
+        serial_time = time.perf_counter() - time0
+
+        time0 = time.perf_counter()
+        batch = sign_batch(pairs, threads=args.threads)
+        batch_time = time.perf_counter() - time0
+
+        if key is ecdsa_key:
+            assert all(ecdsa_key.verify(sighash, signature)
+                       for sighash, signature in zip(sighashes, batch))
+        else:
+            assert batch == serial
+            assert serial[0] == schnorr.sign(secret, sighashes[0])
+        print("{:<8} {} signatures  serial {:8.3f}s  {} threads {:8.3f}s  speedup {:.2f}x".format(
+            name, args.count, serial_time, args.threads, batch_time,
+            serial_time / batch_time))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,180 @@
+#!/usr/bin/env python3
+# Copyright (c) 2019 The Bitcoin developers
+# Distributed under the MIT software license, see the accompanying
+# file COPYING or http://www.opensource.org/licenses/mit-license.php.
+"""
+Check the streaming SignatureHash() against the reference implementation
+that serializes a modified copy of the transaction.
+
+Randomized transactions are hashed for every input, every combination of
+SIGHASH_ALL/NONE/SINGLE and ANYONECANPAY, unusual hash types, out of range
+inputs and scripts containing OP_CODESEPARATOR. The two implementations
+are also timed on a large transaction.
+"""
+
+import argparse
+import random
+import struct
+import time
+
+from test_framework.messages import (
+    COutPoint,
+    CTransaction,
+    CTxIn,
+    CTxOut,
+    hash256,
+)
+from test_framework.script import (
+    CScript,
+    FindAndDelete,
+    OP_CHECKSIG,
+    OP_CODESEPARATOR,
+    OP_DUP,
+    OP_EQUALVERIFY,
+    OP_HASH160,
+    SIGHASH_ALL,
+    SIGHASH_ANYONECANPAY,
+    SIGHASH_NONE,
+    SIGHASH_SINGLE,
+    SignatureHash,
+)
+
+
+def reference_signature_hash(script, txTo, inIdx, hashtype):
+    """The copying SignatureHash implementation."""
+    HASH_ONE = b'\x01' + b'\x00' * 31
+
+    if inIdx >= len(txTo.vin):
+        return (HASH_ONE, "inIdx {} out of range ({})".format(inIdx, len(txTo.vin)))
+    txtmp = CTransaction(txTo)
+
+    for txin in txtmp.vin:
+        txin.scriptSig = b''
+    txtmp.vin[inIdx].scriptSig = FindAndDelete(
+        script, CScript([OP_CODESEPARATOR]))
+
+    if (hashtype & 0x1f) == SIGHASH_NONE:
+        txtmp.vout = []
+
+        for i in range(len(txtmp.vin)):
+            if i != inIdx:
+                txtmp.vin[i].nSequence = 0
+
+    elif (hashtype & 0x1f) == SIGHASH_SINGLE:
+        outIdx = inIdx
+        if outIdx >= len(txtmp.vout):
+            return (HASH_ONE, "outIdx {} out of range ({})".format(outIdx, len(txtmp.vout)))
+
+        tmp = txtmp.vout[outIdx]
+        txtmp.vout = []
+        for i in range(outIdx):
+            txtmp.vout.append(CTxOut(-1))
+        txtmp.vout.append(tmp)
+
+        for i in range(len(txtmp.vin)):
+            if i != inIdx:
+                txtmp.vin[i].nSequence = 0
+
+    if hashtype & SIGHASH_ANYONECANPAY:
+        tmp = txtmp.vin[inIdx]
+        txtmp.vin = []
+        txtmp.vin.append(tmp)
+
+    s = txtmp.serialize()
+    s += struct.pack(b"<I", hashtype)
+
+    return (hash256(s), None)
+
+
+def random_bytes(rng, n):
+    return bytes(rng.getrandbits(8) for _ in range(n))
+
+
+def random_script(rng):
+    """A script of random pushes and opcodes, with some OP_CODESEPARATORs."""
+    items = []
+    for _ in range(rng.randint(0, 8)):
+        choice = rng.randrange(4)
+        if choice == 0:
+            items.append(OP_CODESEPARATOR)
+        elif choice == 1:
+            items.append(random_bytes(rng, rng.choice([0, 1, 20, 33, 80])))
+        else:
+            items.append(rng.choice(
+                [OP_DUP, OP_HASH160, OP_EQUALVERIFY, OP_CHECKSIG]))
+    return CScript(items)
+
+
+def random_tx(rng):
+    tx = CTransaction()
+    tx.nVersion = rng.choice([1, 2, rng.getrandbits(31)])
+    for _ in range(rng.randint(1, 6)):
+        tx.vin.append(CTxIn(COutPoint(rng.getrandbits(256), rng.getrandbits(32)),
+                            random_bytes(rng, rng.choice([0, 72, 300])),
+                            rng.getrandbits(32)))
+    for _ in range(rng.randint(0, 6)):
+        tx.vout.append(CTxOut(rng.getrandbits(50),
+                              random_bytes(rng, rng.choice([0, 25, 260]))))
+    tx.nLockTime = rng.getrandbits(32)
+    return tx
+
+
+def check_random(rng, count):
+    hashtypes = [base | flags
+                 for base in (0, SIGHASH_ALL, SIGHASH_NONE, SIGHASH_SINGLE, 4)
+                 for flags in (0, SIGHASH_ANYONECANPAY, 0x40)]
+    checked = 0
+    for _ in range(count):
+        tx = random_tx(rng)
+        serialized = tx.serialize()
+        for inIdx in range(len(tx.vin) + 1):
+            script = random_script(rng)
+            for hashtype in hashtypes + [rng.getrandbits(32)]:
+                expected = reference_signature_hash(
+                    script, tx, inIdx, hashtype)
+                assert SignatureHash(script, tx, inIdx, hashtype) == expected, \
+                    "mismatch for input {} hashtype {:#x} of {}".format(
+                        inIdx, hashtype, serialized.hex())
+                checked += 1
+        assert tx.serialize() == serialized, "transaction was modified"
+    print("{} signature hashes of {} random transactions match".format(
+        checked, count))
+
+
+def time_large(rng, inputs):
+    script = CScript([OP_DUP, OP_HASH160, bytes(20), OP_EQUALVERIFY,
+                      OP_CHECKSIG])
+    tx = CTransaction()
+    for _ in range(inputs):
+        tx.vin.append(CTxIn(COutPoint(rng.getrandbits(256), 0),
+                            random_bytes(rng, 107)))
+        tx.vout.append(CTxOut(rng.getrandbits(32), script))
+    sample = range(0, inputs, max(1, inputs // 20))
+
+    results = []
+    for signature_hash in (reference_signature_hash, SignatureHash):
+        time0 = time.perf_counter()
+        hashes = [signature_hash(script, tx, i, SIGHASH_ALL) for i in sample]
+        results.append((time.perf_counter() - time0, hashes))
+    assert results[0][1] == results[1][1]
+    print("{} inputs, {} hashes  copy {:8.3f}s  streaming {:8.3f}s  speedup {:.1f}x".format(
+        inputs, len(sample), results[0][0], results[1][0],
+        results[0][0] / results[1][0]))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--count', type=int, default=300,
+                        help='number of random transactions (default: 300)')
+    parser.add_argument('--inputs', type=int, default=2000,
+                        help='inputs of the timed transaction (default: 2000)')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    check_random(rng, args.count)
+    time_large(rng, args.inputs)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,182 @@
+#!/usr/bin/env python3
+# Copyright (c) 2019 The Bitcoin developers
+# Distributed under the MIT software license, see the accompanying
+# file COPYING or http://www.opensource.org/licenses/mit-license.php.
+"""
+Check that CTransaction.enable_cache() never returns a stale serialization or
+txid.
+
+Every modification is applied both to a cached transaction and to an
+uncached copy of it, and the cached sha256 is compared with the one of a
+freshly deserialized transaction after each step. Also check that deepcopy
+and the copy constructor return plain, untracked objects.
+"""
+
+import argparse
+import copy
+import random
+
+from test_framework.messages import (
+    COutPoint,
+    CTransaction,
+    CTxIn,
+    CTxOut,
+    FromHex,
+    ToHex,
+)
+from test_framework.txtools import pad_tx
+
+
+def random_txin(rng):
+    return CTxIn(COutPoint(rng.getrandbits(256), rng.getrandbits(32)),
+                 bytes(rng.getrandbits(8) for _ in range(rng.randint(0, 80))),
+                 rng.getrandbits(32))
+
+
+def random_txout(rng):
+    return CTxOut(rng.getrandbits(40),
+                  bytes(rng.getrandbits(8) for _ in range(rng.randint(0, 40))))
+
+
+def random_tx(rng):
+    tx = CTransaction()
+    tx.nVersion = rng.randint(1, 2)
+    tx.vin = [random_txin(rng) for _ in range(rng.randint(1, 4))]
+    tx.vout = [random_txout(rng) for _ in range(rng.randint(1, 4))]
+    tx.nLockTime = rng.getrandbits(32)
+    return tx
+
+
+def fresh_sha256(tx):
+    """txid of an uncached transaction with the same contents as tx."""
+    fresh = CTransaction()
+    FromHex(fresh, CTransaction.serialize(tx).hex())
+    fresh.rehash()
+    return fresh.sha256
+
+
+def mutations(rng):
+    """Modifications of a transaction, as (description, function) pairs.
+    Each function is called with the transaction and a random generator
+    seeded identically for the cached and the uncached transaction."""
+    return [
+        ("nVersion", lambda tx, r: setattr(tx, "nVersion", tx.nVersion + 1)),
+        ("nLockTime", lambda tx, r: setattr(tx, "nLockTime", r.getrandbits(32))),
+        ("vin assignment", lambda tx, r: setattr(
+            tx, "vin", [random_txin(r), random_txin(r)])),
+        ("vout assignment", lambda tx, r: setattr(
+            tx, "vout", [random_txout(r)])),
+        ("vin.append", lambda tx, r: tx.vin.append(random_txin(r))),
+        ("vout.append", lambda tx, r: tx.vout.append(random_txout(r))),
+        ("vout.extend", lambda tx, r: tx.vout.extend(
+            [random_txout(r), random_txout(r)])),
+        ("vout +=", lambda tx, r: tx.vout.__iadd__([random_txout(r)])),
+        ("vin.insert", lambda tx, r: tx.vin.insert(0, random_txin(r))),
+        ("vout[0] =", lambda tx, r: tx.vout.__setitem__(0, random_txout(r))),
+        ("vout[:1] =", lambda tx, r: tx.vout.__setitem__(
+            slice(0, 1), [random_txout(r), random_txout(r)])),
+        ("vout.pop", lambda tx, r: tx.vout.pop()
+         if len(tx.vout) > 1 else tx.vout.append(random_txout(r))),
+        ("del vin[0]", lambda tx, r: tx.vin.__delitem__(0)
+         if len(tx.vin) > 1 else tx.vin.append(random_txin(r))),
+        ("vout.reverse", lambda tx, r: tx.vout.reverse()),
+        ("vout.sort", lambda tx, r: tx.vout.sort(key=lambda o: o.nValue)),
+        ("CTxIn.nSequence", lambda tx, r: setattr(
+            tx.vin[0], "nSequence", r.getrandbits(32))),
+        ("CTxIn.scriptSig", lambda tx, r: setattr(
+            tx.vin[-1], "scriptSig", b"\x51" * r.randint(1, 10))),
+        ("CTxIn.prevout", lambda tx, r: setattr(
+            tx.vin[0], "prevout", COutPoint(r.getrandbits(256), 0))),
+        ("COutPoint.hash", lambda tx, r: setattr(
+            tx.vin[0].prevout, "hash", r.getrandbits(256))),
+        ("COutPoint.n", lambda tx, r: setattr(
+            tx.vin[-1].prevout, "n", r.getrandbits(32))),
+        ("CTxOut.nValue", lambda tx, r: setattr(
+            tx.vout[0], "nValue", r.getrandbits(40))),
+        ("CTxOut.scriptPubKey", lambda tx, r: setattr(
+            tx.vout[-1], "scriptPubKey", b"\x6a" * r.randint(1, 10))),
+        ("pad_tx", lambda tx, r: pad_tx_seeded(tx, r)),
+    ]
+
+
+def pad_tx_seeded(tx, rng):
+    # pad_tx draws the padding from the global random module
+    random.seed(rng.getrandbits(64))
+    pad_tx(tx, len(tx.serialize()) + rng.randint(10, 300))
+
+
+def check_mutations(rng, rounds):
+    for i in range(rounds):
+        tx = random_tx(rng)
+        cached = CTransaction(tx).enable_cache()
+        cached.rehash()
+        steps = mutations(rng)
+        rng.shuffle(steps)
+        for name, mutate in steps:
+            seed = rng.getrandbits(64)
+            # Keep the serialization and txid cached before each change
+            cached.serialize()
+            cached.calc_sha256()
+            mutate(cached, random.Random(seed))
+            mutate(tx, random.Random(seed))
+            tx.rehash()
+            cached.rehash()
+            assert cached.serialize() == tx.serialize(), name
+            assert cached.sha256 == tx.sha256 == fresh_sha256(tx), name
+            assert cached.hash == tx.hash, name
+
+
+def check_shared_children(rng):
+    """A child shared by two cached transactions invalidates both."""
+    txin = random_txin(rng)
+    tx1 = CTransaction()
+    tx1.vin = [txin]
+    tx1.vout = [random_txout(rng)]
+    tx2 = CTransaction(tx1)
+    tx2.vin = [txin]
+    for tx in (tx1, tx2):
+        tx.enable_cache()
+        tx.rehash()
+    txin.prevout.n += 1
+    for tx in (tx1, tx2):
+        tx.rehash()
+        assert tx.sha256 == fresh_sha256(tx)
+
+
+def check_copies(rng):
+    tx = random_tx(rng).enable_cache()
+    tx.rehash()
+    for tx_copy in (copy.deepcopy(tx), CTransaction(tx)):
+        assert type(tx_copy) is CTransaction
+        assert type(tx_copy.vin) is list and type(tx_copy.vout) is list
+        assert all(type(txin) is CTxIn for txin in tx_copy.vin)
+        assert all(type(txin.prevout) is COutPoint for txin in tx_copy.vin)
+        assert all(type(txout) is CTxOut for txout in tx_copy.vout)
+        assert ToHex(tx_copy) == ToHex(tx)
+        assert tx_copy.sha256 == tx.sha256
+
+        # Changing the copy leaves the original and its cache alone
+        tx_copy.vin[0].prevout.n ^= 1
+        tx_copy.vout[0].nValue += 1
+        tx_copy.rehash()
+        tx.rehash()
+        assert tx_copy.sha256 != tx.sha256
+        assert tx.sha256 == fresh_sha256(tx)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--rounds', type=int, default=50,
+                        help='number of random transactions (default: 50)')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    check_mutations(rng, args.rounds)
+    check_shared_children(rng)
+    check_copies(rng)
+    print("Transaction cache self-test passed")
+
+
+if __name__ == '__main__':
+    main()
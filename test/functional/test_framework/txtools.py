@@ -2,7 +2,7 @@
 import random
 
 from .cdefs import MAX_TXOUT_PUBKEY_SCRIPT, MIN_TX_SIZE
-from .messages import CTransaction, CTxOut, FromHex, ToHex
+from .messages import CTransaction, CTxOut, FromHex, ser_compact_size, ToHex
 from .script import CScript, OP_RETURN
 
 
@@ -46,16 +46,20 @@ def pad_tx(tx, pad_to_size=MIN_TX_SIZE):
 
         # If we're at exactly, or below, extra_bytes we don't want a 1 extra byte padding
         if padding_len <= extra_bytes:
-            tx.vout.append(CTxOut(0, CScript([OP_RETURN])))
+            txout = CTxOut(0, CScript([OP_RETURN]))
         else:
             # Subtract the overhead for the TxOut
             padding_len -= extra_bytes
             padding = random.randrange(
                 1 << 8 * padding_len - 2, 1 << 8 * padding_len - 1)
-            tx.vout.append(
-                CTxOut(0, CScript([OP_RETURN, padding])))
+            txout = CTxOut(0, CScript([OP_RETURN, padding]))
+        tx.vout.append(txout)
 
-        curr_size = len(tx.serialize())
+        # Update the size without re-serializing the whole transaction. The
+        # vout count prefix may grow by a few bytes.
+        curr_size += len(txout.serialize()) + \
+            len(ser_compact_size(len(tx.vout))) - \
+            len(ser_compact_size(len(tx.vout) - 1))
         required_padding = pad_to_size - curr_size
     assert curr_size >= pad_to_size, "{} !>= {}".format(curr_size, pad_to_size)
     tx.rehash()
@@ -15,6 +15,7 @@ import os
 import random
 import re
 from subprocess import CalledProcessError
+import threading
 import time
 
 from . import coverage
@@ -246,7 +247,16 @@ def wait_until(predicate, *, attempts=float('inf'), timeout=float('inf'), lock=N
     time_end = time.time() + timeout
 
     while attempt < attempts and time.time() < time_end:
-        if lock:
+        if isinstance(lock, threading.Condition):
+            with lock:
+                if predicate():
+                    return
+                # Check again as soon as the lock is notified. Only count an
+                # attempt when waiting as long as the sleep below would.
+                if not lock.wait(0.05):
+                    attempt += 1
+            continue
+        elif lock:
             with lock:
                 if predicate():
                     return
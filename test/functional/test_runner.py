@@ -31,7 +31,10 @@ import xml.etree.ElementTree as ET
 import json
 import threading
 import multiprocessing
+import multiprocessing.connection
 from queue import Queue, Empty
+import runpy
+import traceback
 
 # Formatting. Default colors to empty strings.
 BOLD, BLUE, RED, GREY = ("", ""), ("", ""), ("", ""), ("", "")
@@ -85,20 +88,66 @@ TEST_PARAMS = {
 DEFAULT_EXTENDED_CUTOFF = 40
 DEFAULT_JOBS = (multiprocessing.cpu_count() // 3) + 1
 
+# Resources a test is expected to use when there is no record of it in the
+# timings: CPUs, and memory in MB
+DEFAULT_TEST_CPUS = 1.0
+DEFAULT_TEST_MEMORY = 256
+# Tests are expected to use at least this many CPUs, even when their
+# recorded CPU time is lower
+MIN_TEST_CPUS = 0.25
+# Seconds between two samples of the processes of the running tests
+RESOURCE_SAMPLE_INTERVAL = 0.5
+
+# Number of runs of each test kept in the timing history
+HISTORY_RUNS = 20
+# Runs of a test needed in the history before its new runs are compared
+# with them
+MIN_HISTORY_RUNS = 5
+# A run is flagged when a measurement exceeds the median of the history by
+# more than this fraction, and by more than the minimum below
+DEFAULT_REGRESSION_THRESHOLD = 0.5
+MIN_REGRESSION = {"time": 2.0, "cpu": 2.0, "rss_mb": 50.0}
+
+# A line of the python -X importtime report on stderr:
+#   import time: <self us> | <cumulative us> | <indentation><module>
+IMPORT_TIME_LINE = re.compile(
+    r"^import time:\s+(\d+) \|\s+(\d+) \| ( *)(\S+)$")
+
+# Modules imported once by the forkserver, so that the tests forked from it
+# start with them already loaded
+FORKSERVER_PRELOAD = [
+    "test_framework.test_framework",
+    "test_framework.blocktools",
+    "test_framework.comptool",
+    "test_framework.key",
+    "test_framework.messages",
+    "test_framework.mininode",
+    "test_framework.schnorr",
+    "test_framework.script",
+    "test_framework.util",
+]
+
+# multiprocessing.Process.start() polls the other running processes, which
+# must not happen while a worker thread is collecting the exit code of its
+# own process
+forkserver_lock = threading.Lock()
+
 
 class TestCase():
     """
     Data structure to hold and run information necessary to launch a test case.
     """
 
-    def __init__(self, test_num, test_case, tests_dir, tmpdir, flags=None):
+    def __init__(self, test_num, test_case, tests_dir, tmpdir, flags=None, importtime=False, forkserver=None):
         self.tests_dir = tests_dir
         self.tmpdir = tmpdir
         self.test_case = test_case
         self.test_num = test_num
         self.flags = flags
+        self.importtime = importtime
+        self.forkserver = forkserver
 
-    def run(self, portseed_offset):
+    def run(self, portseed_offset, monitor=None):
         t = self.test_case
         portseed = self.test_num + portseed_offset
         portseed_arg = ["--portseed={}".format(portseed)]
@@ -109,25 +158,158 @@ class TestCase():
             self.tmpdir, re.sub(".py$", "", test_argv[0]), portseed)
         tmpdir_arg = ["--tmpdir={}".format(testdir)]
         name = t
+        interpreter = [sys.executable]
+        if self.importtime:
+            interpreter += ["-X", "importtime"]
+        script = os.path.join(self.tests_dir, test_argv[0])
+        script_args = test_argv[1:] + self.flags + portseed_arg + tmpdir_arg
         time0 = time.time()
-        process = subprocess.Popen([sys.executable, os.path.join(self.tests_dir, test_argv[0])] + test_argv[1:] + self.flags + portseed_arg + tmpdir_arg,
-                                   universal_newlines=True,
-                                   stdout=log_stdout,
-                                   stderr=log_stderr)
-
-        process.wait()
-        log_stdout.seek(0), log_stderr.seek(0)
-        [stdout, stderr] = [l.read().decode('utf-8')
-                            for l in (log_stdout, log_stderr)]
-        log_stdout.close(), log_stderr.close()
-        if process.returncode == TEST_EXIT_PASSED and stderr == "":
+        if self.forkserver is not None:
+            log_stdout.close(), log_stderr.close()
+            returncode, stdout, stderr, resources = run_in_forkserver(
+                self.forkserver, script, script_args, monitor)
+        else:
+            process = subprocess.Popen(interpreter + [script] + script_args,
+                                       universal_newlines=True,
+                                       stdout=log_stdout,
+                                       stderr=log_stderr)
+            if monitor is None:
+                returncode = process.wait()
+                resources = None
+            else:
+                monitor.add(process.pid)
+                # Unlike sampling, the rusage of the test process has its
+                # exact CPU time, including the bitcoinds it waited for
+                _, status, rusage = os.wait4(process.pid, 0)
+                if os.WIFSIGNALED(status):
+                    returncode = -os.WTERMSIG(status)
+                else:
+                    returncode = os.WEXITSTATUS(status)
+                process.returncode = returncode
+                resources = monitor.remove(process.pid, rusage)
+            log_stdout.seek(0), log_stderr.seek(0)
+            [stdout, stderr] = [l.read().decode('utf-8')
+                                for l in (log_stdout, log_stderr)]
+            log_stdout.close(), log_stderr.close()
+        import_times = None
+        if self.importtime:
+            stderr, import_times = parse_import_times(stderr)
+        if returncode == TEST_EXIT_PASSED and stderr == "":
             status = "Passed"
-        elif process.returncode == TEST_EXIT_SKIPPED:
+        elif returncode == TEST_EXIT_SKIPPED:
             status = "Skipped"
         else:
             status = "Failed"
 
-        return TestResult(self.test_num, name, testdir, status, int(time.time() - time0), stdout, stderr)
+        duration = time.time() - time0
+        return TestResult(self.test_num, name, testdir, status, int(duration), stdout, stderr, import_times, resources, duration)
+
+
+def start_forkserver(src_dir):
+    """
+    Start the forkserver process, which imports FORKSERVER_PRELOAD once and
+    forks a child for every test run by run_in_forkserver().
+    """
+    if "forkserver" not in multiprocessing.get_all_start_methods():
+        raise RuntimeError("forkserver is not supported on this platform")
+    tests_dir = os.path.join(src_dir, "test", "functional")
+    if tests_dir not in sys.path:
+        sys.path.insert(0, tests_dir)
+    # The forkserver has no main script from which cdefs.get_srcdir() could
+    # find the source directory
+    os.environ.setdefault("SRCDIR", src_dir)
+    context = multiprocessing.get_context("forkserver")
+    context.set_forkserver_preload(FORKSERVER_PRELOAD)
+    # Start the server now, rather than when the first test is run
+    run_in_forkserver(context, None, [])
+    return context
+
+
+def run_in_forkserver(context, script, args, monitor=None):
+    """
+    Run a test script in a process forked from the forkserver, and return
+    its exit code, stdout, stderr and the resources used according to
+    monitor.
+    """
+    outputs = [tempfile.mkstemp(prefix="test_runner_") for _ in range(2)]
+    try:
+        process = context.Process(target=run_forked_test, args=(
+            script, args, outputs[0][1], outputs[1][1]))
+        with forkserver_lock:
+            process.start()
+        if monitor is not None:
+            monitor.add(process.pid)
+        multiprocessing.connection.wait([process.sentinel])
+        with forkserver_lock:
+            process.join()
+        resources = monitor.remove(
+            process.pid) if monitor is not None else None
+        [stdout, stderr] = [open(path, 'rb').read().decode('utf-8')
+                            for _, path in outputs]
+    finally:
+        for fd, path in outputs:
+            os.close(fd)
+            os.remove(path)
+    return process.exitcode, stdout, stderr, resources
+
+
+def run_forked_test(script, args, stdout_path, stderr_path):
+    """
+    Run a test script as __main__ in the forked process, with the same exit
+    code and output as running it with its own interpreter.
+    """
+    if script is None:
+        return
+    for fd, path in ((1, stdout_path), (2, stderr_path)):
+        output = os.open(path, os.O_WRONLY)
+        os.dup2(output, fd)
+        os.close(output)
+    sys.argv = [script] + args
+    try:
+        runpy.run_path(script, run_name="__main__")
+        code = 0
+    except SystemExit as e:
+        code = e.code
+        if code is None:
+            code = 0
+        elif not isinstance(code, int):
+            print(code, file=sys.stderr)
+            code = 1
+    except BaseException as e:
+        # Leave out the frames of the runner, as the interpreter would
+        tb = e.__traceback__
+        while tb is not None and tb.tb_frame.f_code.co_filename != script:
+            tb = tb.tb_next
+        traceback.print_exception(type(e), e, tb)
+        code = 1
+    sys.stdout.flush()
+    sys.stderr.flush()
+    os._exit(code)
+
+
+def parse_import_times(stderr):
+    """
+    Remove the python -X importtime report from the stderr of a test.
+
+    Returns the remaining stderr, and the time spent importing all modules
+    and importing the test_framework package, in milliseconds.
+    """
+    lines = []
+    import_times = {"total": 0.0, "test_framework": 0.0}
+    for line in stderr.splitlines(keepends=True):
+        if not line.startswith("import time:"):
+            lines.append(line)
+            continue
+        match = IMPORT_TIME_LINE.match(line.rstrip("\n"))
+        # Nested imports are included in the cumulative time of the
+        # top-level import that caused them
+        if match is None or match.group(3):
+            continue
+        cumulative = int(match.group(2)) / 1000
+        import_times["total"] += cumulative
+        if match.group(4).split(".")[0] == "test_framework":
+            import_times["test_framework"] += cumulative
+    return "".join(lines), import_times
 
 
 def on_ci():
@@ -156,6 +338,8 @@ def main():
                         help='print a combined log (of length n lines) from all test nodes and test framework to the console on failure.')
     parser.add_argument('--coverage', action='store_true',
                         help='generate a basic coverage report for the RPC interface')
+    parser.add_argument('--cpus', type=float, default=multiprocessing.cpu_count(),
+                        help='number of CPUs the tests running in parallel may use, according to their recorded CPU time. Default: all of them.')
     parser.add_argument(
         '--exclude', '-x', help='specify a comma-separated-list of scripts to exclude.')
     parser.add_argument('--extended', action='store_true',
@@ -164,27 +348,59 @@ def main():
                         help='set the cutoff runtime for what tests get run')
     parser.add_argument('--force', '-f', action='store_true',
                         help='run tests even on platforms where they are disabled by default (e.g. windows).')
+    parser.add_argument('--forkserver', action='store_true',
+                        help='fork the tests from a process which imported the test framework once, instead of starting a new interpreter for each test')
     parser.add_argument('--help', '-h', '-?',
                         action='store_true', help='print help text and exit')
+    parser.add_argument('--importtime', action='store_true',
+                        help='run the tests with python -X importtime and report the time spent importing modules (requires python 3.7)')
     parser.add_argument('--jobs', '-j', type=int, default=DEFAULT_JOBS,
                         help='how many test scripts to run in parallel. Default=4.')
+    parser.add_argument('--memory', type=int, default=get_available_memory(),
+                        help='memory in MB the tests running in parallel may use, according to their recorded peak memory. Default: the available memory, 0 for no limit.')
     parser.add_argument('--keepcache', '-k', action='store_true',
                         help='the default behavior is to flush the cache directory on startup. --keepcache retains the cache from the previous testrun.')
     parser.add_argument('--quiet', '-q', action='store_true',
                         help='only print results summary and failure logs')
     parser.add_argument('--tmpdirprefix', '-t',
                         default=tempfile.gettempdir(), help="Root directory for datadirs")
+    parser.add_argument('--regressionthreshold', type=float, default=DEFAULT_REGRESSION_THRESHOLD,
+                        help='warn about tests whose duration, CPU time or memory exceed the median of their previous runs by this fraction. Default: %(default)s')
+    parser.add_argument('--timinghistory',
+                        default=os.path.join(build_dir, 'timing_history.json'), help="file that keeps the durations and resources of the last runs of each test. It is read and updated on every run, like timing.json, to schedule the tests and report regressions. Default: timing_history.json in the build directory, an empty value to not keep a history.")
     parser.add_argument('--junitoutput', '-J',
-                        default=os.path.join(build_dir, 'junit_results.xml'), help="file that will store JUnit formatted test results.")
+                        help="file that will store JUnit formatted test results. Default: junit_results.xml in the build directory, junit_results_<i>_of_<n>.xml with --shard.")
+    parser.add_argument('--shard', type=parse_shard,
+                        help='run only the i-th of n groups of tests of about the same total duration, given as i/n with i from 1 to n. Every machine running a shard computes the same groups from timing.json. The JUnit results and timings of the shard are written to junit_results_<i>_of_<n>.xml and timing_<i>_of_<n>.json in the build directory.')
+    parser.add_argument('--merge', action='store_true',
+                        help='merge the JUnit results (.xml) and timings (.json) of shards, given instead of the tests, into the JUnit output and the timing.json of the build directory, then exit.')
 
     args, unknown_args = parser.parse_known_args()
 
+    if args.importtime and sys.version_info < (3, 7):
+        print("ERROR: --importtime requires python 3.7 or later")
+        sys.exit(1)
+
+    if args.importtime and args.forkserver:
+        print("ERROR: --importtime cannot be used with --forkserver, the forked tests import nothing")
+        sys.exit(1)
+
     # args to be passed on always start with two dashes; tests are the
     # remaining unknown args
     tests = [arg for arg in unknown_args if arg[:2] != "--"]
     passon_args = [arg for arg in unknown_args if arg[:2] == "--"]
     passon_args.append("--configfile={}".format(configfile))
 
+    shard_suffix = "_{}_of_{}".format(*args.shard) if args.shard else ""
+    if args.junitoutput is None:
+        args.junitoutput = os.path.join(
+            build_dir, 'junit_results{}.xml'.format(shard_suffix))
+
+    if args.merge:
+        merge_shard_results(tests, args.junitoutput,
+                            os.path.join(build_dir, 'timing.json'))
+        sys.exit(0)
+
     # Set up logging
     logging_level = logging.INFO if args.quiet else logging.DEBUG
     logging.basicConfig(format='%(message)s', level=logging_level)
@@ -271,14 +487,35 @@ def main():
     build_timings = None
     if (src_dir != build_dir):
         build_timings = Timings(os.path.join(build_dir, 'timing.json'))
+    # A shard writes the timings of its own tests only, to be merged with
+    # those of the other shards
+    if args.shard:
+        build_timings = Timings(os.path.join(
+            build_dir, 'timing{}.json'.format(shard_suffix)))
+        build_timings.existing_timings = []
 
     # Always use timings from scr_dir if present
     src_timings = Timings(os.path.join(
         src_dir, "test", "functional", 'timing.json'))
 
+    # The runs recorded in the history take precedence over the timings,
+    # except for sharding as they differ from one machine to the other
+    history = TimingHistory(
+        args.timinghistory) if args.timinghistory else None
+
     # Add test parameters and remove long running tests if needed
     test_list = get_tests_to_run(
-        test_list, TEST_PARAMS, cutoff, src_timings)
+        test_list, TEST_PARAMS, cutoff, src_timings, None if args.shard else history)
+
+    if args.shard and test_list:
+        test_list = get_shard(test_list, args.shard, src_timings)
+        if not test_list:
+            # There are more shards than tests. Write empty results so that
+            # --merge gets files from every shard.
+            print("Shard {} of {} has no tests to run".format(*args.shard))
+            save_results_as_junit([], args.junitoutput, 0)
+            build_timings.save_timings([])
+            sys.exit(0)
 
     if not test_list:
         print("No valid test scripts specified. Check that your test is in one "
@@ -298,10 +535,11 @@ def main():
                                    "cache"), ignore_errors=True)
 
     run_tests(test_list, build_dir, tests_dir, args.junitoutput,
-              tmpdir, args.jobs, args.coverage, passon_args, args.combinedlogslen, build_timings)
+              tmpdir, args.jobs, args.coverage, passon_args, args.combinedlogslen, build_timings, args.importtime, args.forkserver,
+              args.cpus, args.memory, history, args.regressionthreshold)
 
 
-def run_tests(test_list, build_dir, tests_dir, junitoutput, tmpdir, num_jobs, enable_coverage=False, args=[], combined_logs_len=0, build_timings=None):
+def run_tests(test_list, build_dir, tests_dir, junitoutput, tmpdir, num_jobs, enable_coverage=False, args=[], combined_logs_len=0, build_timings=None, importtime=False, use_forkserver=False, cpu_budget=None, memory_budget=0, history=None, regression_threshold=DEFAULT_REGRESSION_THRESHOLD):
     # Warn if bitcoind is already running (unix only)
     try:
         pidofOutput = subprocess.check_output(["pidof", "bitcoind"])
@@ -336,20 +574,31 @@ def run_tests(test_list, build_dir, tests_dir, junitoutput, tmpdir, num_jobs, en
             sys.stdout.buffer.write(e.output)
             raise
 
+    forkserver = start_forkserver(
+        os.path.join(tests_dir, "..", "..")) if use_forkserver else None
+
     # Run Tests
     time0 = time.time()
     test_results = execute_test_processes(
-        num_jobs, test_list, tests_dir, tmpdir, flags)
+        num_jobs, test_list, tests_dir, tmpdir, flags, importtime, forkserver, cpu_budget, memory_budget, history)
     runtime = int(time.time() - time0)
 
     max_len_name = len(max(test_list, key=len))
     print_results(test_results, tests_dir, max_len_name,
                   runtime, combined_logs_len)
+    if importtime:
+        print_import_times(test_results, max_len_name)
     save_results_as_junit(test_results, junitoutput, runtime)
 
     if (build_timings is not None):
         build_timings.save_timings(test_results)
 
+    if history is not None:
+        print_regressions(history.find_regressions(
+            test_results, regression_threshold))
+        history.add_results(test_results)
+        history.save()
+
     if coverage:
         coverage.report_rpc_coverage()
 
@@ -366,9 +615,8 @@ def run_tests(test_list, build_dir, tests_dir, junitoutput, tmpdir, num_jobs, en
     sys.exit(not all_passed)
 
 
-def execute_test_processes(num_jobs, test_list, tests_dir, tmpdir, flags):
+def execute_test_processes(num_jobs, test_list, tests_dir, tmpdir, flags, importtime=False, forkserver=None, cpu_budget=None, memory_budget=0, history=None):
     update_queue = Queue()
-    job_queue = Queue()
     test_results = []
     poll_timeout = 10  # seconds
     # In case there is a graveyard of zombie bitcoinds, we can apply a
@@ -444,53 +692,288 @@ def execute_test_processes(num_jobs, test_list, tests_dir, tmpdir, flags):
     def handle_test_cases():
         """
         job_runner represents a single thread that is part of a worker pool.  
-        It waits for a test, then executes that test. 
+        It waits for the scheduler to hand it a test, then executes that test. 
         It also reports start and result messages to handle_update_messages
         """
         while True:
-            test = job_queue.get()
+            test = scheduler.get()
             if test is None:
                 break
             # Signal that the test is starting to inform the poor waiting
             # programmer
             update_queue.put(test)
-            result = test.run(portseed_offset)
+            result = test.run(portseed_offset, monitor)
+            scheduler.done(test)
             update_queue.put(result)
-            job_queue.task_done()
 
     ##
     # Setup our threads, and start sending tasks
     ##
 
+    # The test cases, in the order of the test list, which puts the longest
+    # tests first
+    scheduler = TestScheduler(
+        [TestCase(i, t, tests_dir, tmpdir, flags, importtime, forkserver)
+         for i, t in enumerate(test_list)],
+        history, cpu_budget, memory_budget)
+    monitor = ResourceMonitor() if ResourceMonitor.available() else None
+
     # Start our result collection thread.
     t = threading.Thread(target=handle_update_messages)
     t.setDaemon(True)
     t.start()
 
     # Start some worker threads
+    workers = []
     for j in range(num_jobs):
         t = threading.Thread(target=handle_test_cases)
         t.setDaemon(True)
         t.start()
-
-    # Push all our test cases into the job queue.
-    for i, t in enumerate(test_list):
-        job_queue.put(TestCase(i, t, tests_dir, tmpdir, flags))
+        workers.append(t)
 
     # Wait for all the jobs to be completed
-    job_queue.join()
+    for t in workers:
+        t.join()
 
     # Wait for all the results to be compiled
     update_queue.join()
 
-    # Flush our queues so the threads exit
+    # Flush our queue so the thread exits
     update_queue.put(None)
-    for j in range(num_jobs):
-        job_queue.put(None)
+
+    if monitor is not None:
+        monitor.stop()
 
     return test_results
 
 
+class TestScheduler():
+    """
+    Hands the test cases to the worker threads in the order they are given,
+    longest first, as long as the CPUs and memory the running tests are
+    expected to use fit in the budget. A test which doesn't fit is skipped
+    over until enough running tests have finished, and a test larger than
+    the whole budget runs on its own.
+
+    What a test is expected to use comes from the CPU time, duration and
+    peak memory of its runs in the timing history.
+    """
+
+    def __init__(self, test_cases, history=None, cpu_budget=None, memory_budget=0):
+        self.pending = list(test_cases)
+        # None and 0 for no limit
+        self.cpu_budget = cpu_budget
+        self.memory_budget = memory_budget
+        self.expected = {}
+        for test in self.pending:
+            self.expected[test.test_case] = get_expected_resources(
+                history.get_stats(test.test_case) if history is not None else None)
+        self.running = 0
+        self.cpus = 0.0
+        self.memory = 0.0
+        self.cond = threading.Condition()
+
+    def fits(self, test):
+        if self.running == 0:
+            return True
+        cpus, memory = self.expected[test.test_case]
+        if self.cpu_budget is not None and self.cpus + cpus > self.cpu_budget:
+            return False
+        return not self.memory_budget or self.memory + memory <= self.memory_budget
+
+    def get(self):
+        """
+        Wait until the next test fits in the budget and return it, or
+        return None when there are no more tests to run.
+        """
+        with self.cond:
+            while self.pending:
+                for i, test in enumerate(self.pending):
+                    if self.fits(test):
+                        del self.pending[i]
+                        cpus, memory = self.expected[test.test_case]
+                        self.running += 1
+                        self.cpus += cpus
+                        self.memory += memory
+                        return test
+                self.cond.wait()
+            return None
+
+    def done(self, test):
+        with self.cond:
+            cpus, memory = self.expected[test.test_case]
+            self.running -= 1
+            self.cpus -= cpus
+            self.memory -= memory
+            self.cond.notify_all()
+
+
+def get_expected_resources(stats):
+    """
+    Return the CPUs and memory in MB a test is expected to use, according to
+    the statistics of its previous runs: its median CPU usage and 90th
+    percentile memory.
+    """
+    if stats is None or 'cpu' not in stats:
+        return DEFAULT_TEST_CPUS, DEFAULT_TEST_MEMORY
+    cpus = max(stats['cpu']['median'] /
+               max(stats['time']['median'], 1), MIN_TEST_CPUS)
+    return cpus, stats['rss_mb']['p90']
+
+
+def get_available_memory():
+    """
+    Return the available memory in MB, or 0 if it is unknown.
+    """
+    try:
+        with open('/proc/meminfo', encoding="utf8") as f:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) // 1024
+    except OSError:
+        pass
+    return 0
+
+
+class ResourceMonitor():
+    """
+    Samples /proc to follow the resources used by each running test,
+    including the bitcoind nodes and other processes it started.
+
+    For each test it records:
+    - nodes: the peak number of bitcoind processes
+    - rss_mb: the peak memory, as the sum of the RSS of its processes, in MB
+    - node_rss_mb: the same for the bitcoind processes only
+    - user, sys: the user and system CPU time in seconds used by the test
+      and its children. Samples miss the time used since the last one, so
+      the exact times are taken from the rusage of the test process when it
+      is available.
+    - disk_mb: the MB written to disk by the bitcoind processes, which is
+      mostly their datadir
+    """
+
+    def __init__(self, interval=RESOURCE_SAMPLE_INTERVAL):
+        self.interval = interval
+        self.page_size = os.sysconf('SC_PAGE_SIZE')
+        self.clock_ticks = os.sysconf('SC_CLK_TCK')
+        self.lock = threading.Lock()
+        self.resources = {}
+        # bytes written to disk by each bitcoind process of each test
+        self.written = {}
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.sample_loop)
+        self.thread.setDaemon(True)
+        self.thread.start()
+
+    @staticmethod
+    def available():
+        return os.path.exists('/proc/self/stat')
+
+    def add(self, pid):
+        with self.lock:
+            self.resources[pid] = {'nodes': 0, 'rss_mb': 0.0, 'node_rss_mb': 0.0,
+                                   'user': 0.0, 'sys': 0.0, 'disk_mb': 0.0}
+            self.written[pid] = {}
+
+    def remove(self, pid, rusage=None):
+        """
+        Stop following the test process pid and return its resources.
+
+        rusage is the resource usage of the exited test process and its
+        waited for children, as returned by os.wait4().
+        """
+        with self.lock:
+            self.written.pop(pid, None)
+            resources = self.resources.pop(pid, None)
+        if resources is not None and rusage is not None:
+            resources['user'] = round(rusage.ru_utime, 2)
+            resources['sys'] = round(rusage.ru_stime, 2)
+        return resources
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+
+    def sample_loop(self):
+        while not self.stopped.wait(self.interval):
+            with self.lock:
+                idle = not self.resources
+            if not idle:
+                self.sample()
+
+    def read_processes(self):
+        """
+        Return the parent pid, name, user and system CPU time and RSS of
+        every process.
+        """
+        processes = {}
+        for entry in os.listdir('/proc'):
+            if not entry.isdigit():
+                continue
+            try:
+                with open('/proc/{}/stat'.format(entry), encoding="utf8") as f:
+                    stat = f.read()
+            except OSError:
+                # The process has exited
+                continue
+            # The name is in parentheses and may contain spaces
+            name = stat[stat.find('(') + 1:stat.rfind(')')]
+            fields = stat[stat.rfind(')') + 2:].split()
+            # utime, stime, cutime and cstime: the CPU time of the process and
+            # of its children which have exited
+            user = (int(fields[11]) + int(fields[13])) / self.clock_ticks
+            system = (int(fields[12]) + int(fields[14])) / self.clock_ticks
+            rss = int(fields[21]) * self.page_size / 1000000
+            processes[int(entry)] = (int(fields[1]), name, user, system, rss)
+        return processes
+
+    @staticmethod
+    def read_write_bytes(pid):
+        try:
+            with open('/proc/{}/io'.format(pid), encoding="utf8") as f:
+                for line in f:
+                    if line.startswith('write_bytes:'):
+                        return int(line.split()[1])
+        except OSError:
+            pass
+        return 0
+
+    def sample(self):
+        processes = self.read_processes()
+        children = {}
+        for pid, (ppid, _, _, _, _) in processes.items():
+            children.setdefault(ppid, []).append(pid)
+
+        with self.lock:
+            self.update(processes, children)
+
+    def update(self, processes, children):
+        for root, resources in self.resources.items():
+            written = self.written[root]
+            nodes, user, system, rss, node_rss = 0, 0.0, 0.0, 0.0, 0.0
+            stack = [root] if root in processes else []
+            while stack:
+                pid = stack.pop()
+                _, name, process_user, process_system, process_rss = processes[pid]
+                if name == 'bitcoind':
+                    nodes += 1
+                    node_rss += process_rss
+                    written[pid] = max(written.get(pid, 0),
+                                       self.read_write_bytes(pid))
+                user += process_user
+                system += process_system
+                rss += process_rss
+                stack.extend(children.get(pid, []))
+            resources['nodes'] = max(resources['nodes'], nodes)
+            resources['user'] = max(resources['user'], round(user, 2))
+            resources['sys'] = max(resources['sys'], round(system, 2))
+            resources['rss_mb'] = max(resources['rss_mb'], round(rss, 1))
+            resources['node_rss_mb'] = max(
+                resources['node_rss_mb'], round(node_rss, 1))
+            resources['disk_mb'] = round(
+                sum(written.values()) / 1000000, 1)
+
+
 def print_results(test_results, tests_dir, max_len_name, runtime, combined_logs_len):
     results = "\n" + BOLD[1] + "{} | {} | {}\n\n".format(
         "TEST".ljust(max_len_name), "STATUS   ", "DURATION") + BOLD[0]
@@ -528,12 +1011,34 @@ def print_results(test_results, tests_dir, max_len_name, runtime, combined_logs_
     print(results)
 
 
+def print_import_times(test_results, max_len_name):
+    """
+    Print the time each test spent importing modules, slowest first.
+    """
+    timed = [t for t in test_results if t.import_times is not None]
+    if not timed:
+        return
+    timed.sort(key=lambda t: -t.import_times["test_framework"])
+    results = BOLD[1] + "{} | {} | {}\n\n".format(
+        "IMPORT TIME".ljust(max_len_name), "TEST_FRAMEWORK", "TOTAL") + BOLD[0]
+    for test_result in timed:
+        results += "{} | {:>11.1f} ms | {:.1f} ms\n".format(
+            test_result.name.ljust(max_len_name),
+            test_result.import_times["test_framework"],
+            test_result.import_times["total"])
+    results += BOLD[1] + "\n{} | {:>11.1f} ms | {:.1f} ms (mean)\n".format(
+        "ALL".ljust(max_len_name),
+        sum(t.import_times["test_framework"] for t in timed) / len(timed),
+        sum(t.import_times["total"] for t in timed) / len(timed)) + BOLD[0]
+    print(results)
+
+
 class TestResult():
     """
     Simple data structure to store test result values and print them properly
     """
 
-    def __init__(self, num, name, testdir, status, time, stdout, stderr):
+    def __init__(self, num, name, testdir, status, time, stdout, stderr, import_times=None, resources=None, duration=None):
         self.num = num
         self.name = name
         self.testdir = testdir
@@ -542,6 +1047,9 @@ class TestResult():
         self.padding = 0
         self.stdout = stdout
         self.stderr = stderr
+        self.import_times = import_times
+        self.resources = resources
+        self.duration = time if duration is None else duration
 
     def sort_key(self):
         if self.status == "Passed":
@@ -578,17 +1086,15 @@ def get_all_scripts_from_disk(test_dir, non_scripts):
     return list(python_files - set(non_scripts))
 
 
-def get_tests_to_run(test_list, test_params, cutoff, src_timings):
+def get_tests_to_run(test_list, test_params, cutoff, src_timings, history=None):
     """
     Returns only test that will not run longer that cutoff.
     Long running tests are returned first to favor running tests in parallel
-    Timings from build directory override those from src directory
+    The median duration in the timing history overrides the src timings
     """
 
     def get_test_time(test):
-        # Return 0 if test is unknown to always run it
-        return next(
-            (x['time'] for x in src_timings.existing_timings if x['name'] == test), 0)
+        return get_expected_time(test, src_timings, history)
 
     # Some tests must also be run with additional parameters. Add them to the list.
     tests_with_params = []
@@ -605,6 +1111,52 @@ def get_tests_to_run(test_list, test_params, cutoff, src_timings):
     return result
 
 
+def get_expected_time(test, src_timings, history=None):
+    """
+    Return the median duration of the test in the timing history, or its
+    duration in the src timings if there is no history.
+    """
+    stats = history.get_stats(test) if history is not None else None
+    if stats is not None:
+        return stats['time']['median']
+    # Return 0 if test is unknown to always run it
+    return next(
+        (x['time'] for x in src_timings.existing_timings if x['name'] == test), 0)
+
+
+def parse_shard(value):
+    """
+    Parse the i/n argument of --shard.
+    """
+    match = re.match(r"^(\d+)/(\d+)$", value)
+    if match is None or not 1 <= int(match.group(1)) <= int(match.group(2)):
+        raise argparse.ArgumentTypeError(
+            "expected i/n with 1 <= i <= n, got '{}'".format(value))
+    return int(match.group(1)), int(match.group(2))
+
+
+def get_shard(test_list, shard, src_timings):
+    """
+    Split the tests into n groups of about the same total duration, and
+    return the tests of group i, where shard is (i, n), in their order in
+    test_list.
+
+    Longest first, each test goes to the group with the lowest total
+    duration, then the fewest tests. Only the src timings are used, so that
+    the groups are the same on every machine.
+    """
+    index, num_shards = shard
+    shards = [(0, 0, i) for i in range(num_shards)]
+    selected = set()
+    for test in sorted(test_list, key=lambda t: (-get_expected_time(t, src_timings), t)):
+        total, count, i = min(shards)
+        expected_time = get_expected_time(test, src_timings)
+        shards[i] = (total + expected_time, count + 1, i)
+        if i == index - 1:
+            selected.add(test)
+    return [t for t in test_list if t in selected]
+
+
 class RPCCoverage():
     """
     Coverage reporting utilities for test_runner.
@@ -673,6 +1225,49 @@ class RPCCoverage():
         return all_cmds - covered_cmds
 
 
+def merge_shard_results(files, junitoutput, timing_file):
+    """
+    Merge the JUnit results (.xml files) and timings (.json files) written
+    by the shards of a test run into junitoutput and timing_file.
+    """
+    junit_files = [f for f in files if f.endswith('.xml')]
+    timing_files = [f for f in files if f.endswith('.json')]
+    if junit_files:
+        merge_junit_results(junit_files, junitoutput)
+    if timing_files:
+        timings = Timings(timing_file)
+        new_timings = []
+        for f in timing_files:
+            new_timings.extend(Timings(f).existing_timings)
+        timings.write_timings(timings.get_merged_timings(new_timings))
+
+
+def merge_junit_results(file_names, file_name):
+    """
+    Merge the test suites of JUnit results files into a single one. The
+    shards ran in parallel, so the time of the suite is the longest one.
+    """
+    e_test_suite = ET.Element("testsuite",
+                              {"name": "bitcoin_abc_tests",
+                               "id": "0",
+                               "timestamp": datetime.datetime.now().isoformat('T')
+                               })
+    counts = {"tests": 0, "failures": 0, "skipped": 0}
+    time = 0
+    for shard_file in file_names:
+        e_shard = ET.parse(shard_file).getroot()
+        for key in counts:
+            counts[key] += int(e_shard.get(key, 0))
+        time = max(time, int(e_shard.get("time", 0)))
+        e_test_suite.extend(e_shard.findall("testcase"))
+    for key, value in counts.items():
+        e_test_suite.set(key, str(value))
+    e_test_suite.set("time", str(time))
+
+    ET.ElementTree(e_test_suite).write(
+        file_name, "UTF-8", xml_declaration=True)
+
+
 def save_results_as_junit(test_results, file_name, time):
     """
     Save tests results to file in JUnit format
@@ -697,6 +1292,19 @@ def save_results_as_junit(test_results, file_name, time):
                                      "time": str(test_result.time)
                                      }
                                     )
+        properties = {}
+        if test_result.import_times is not None:
+            for key, value in test_result.import_times.items():
+                properties["import_time_ms." + key] = "{:.1f}".format(value)
+        if test_result.resources is not None:
+            for key, value in test_result.resources.items():
+                properties[key] = str(value)
+        if properties:
+            e_properties = ET.SubElement(e_test_case, "properties")
+            for key, value in sorted(properties.items()):
+                ET.SubElement(e_properties, "property",
+                              {"name": key, "value": value})
+
         if test_result.status == "Skipped":
             ET.SubElement(e_test_case, "skipped")
         elif test_result.status == "Failed":
@@ -751,10 +1359,115 @@ class Timings():
         passed_results = [t for t in test_results if t.status == 'Passed']
         new_timings = list(map(lambda t: {'name':  t.name, 'time': t.time},
                                passed_results))
+        for timing, test_result in zip(new_timings, passed_results):
+            if test_result.import_times is not None:
+                timing['import_time'] = round(
+                    test_result.import_times["test_framework"], 1)
         merged_timings = self.get_merged_timings(new_timings)
+        self.write_timings(merged_timings)
 
+    def write_timings(self, timings):
         with open(self.timing_file, 'w', encoding="utf8") as f:
-            json.dump(merged_timings, f, indent=True)
+            json.dump(timings, f, indent=True)
+
+
+class TimingHistory():
+    """
+    Keeps the duration and resources of the last HISTORY_RUNS passed runs of
+    each test, and computes their median and 90th percentile.
+
+    The file maps each test name to the list of its runs, oldest first.
+    """
+
+    def __init__(self, history_file):
+        self.history_file = history_file
+        self.runs = self.load_history()
+
+    def load_history(self):
+        if os.path.isfile(self.history_file):
+            with open(self.history_file, encoding="utf8") as f:
+                return json.load(f)
+        else:
+            return {}
+
+    @staticmethod
+    def make_run(test_result):
+        run = {'time': round(test_result.duration, 2)}
+        if test_result.resources is not None:
+            run.update(test_result.resources)
+        return run
+
+    def get_stats(self, name):
+        """
+        Return the median and 90th percentile of each measurement of the
+        runs of a test, or None if there are none.
+        """
+        runs = self.runs.get(name)
+        if not runs:
+            return None
+        stats = {}
+        for key in runs[-1]:
+            values = [run[key] for run in runs if key in run]
+            stats[key] = {'median': percentile(values, 50),
+                          'p90': percentile(values, 90)}
+        if 'user' in stats:
+            values = [run['user'] + run['sys']
+                      for run in runs if 'user' in run]
+            stats['cpu'] = {'median': percentile(values, 50),
+                            'p90': percentile(values, 90)}
+        return stats
+
+    def find_regressions(self, test_results, threshold):
+        """
+        Return a (name, measurement, value, median) tuple for each
+        measurement of the passed tests which is higher than the median of
+        their previous runs by more than threshold.
+        """
+        regressions = []
+        for test_result in test_results:
+            if test_result.status != 'Passed':
+                continue
+            if len(self.runs.get(test_result.name, [])) < MIN_HISTORY_RUNS:
+                continue
+            stats = self.get_stats(test_result.name)
+            run = self.make_run(test_result)
+            if 'user' in run:
+                run['cpu'] = run['user'] + run['sys']
+            for key, minimum in sorted(MIN_REGRESSION.items()):
+                if key not in run or key not in stats:
+                    continue
+                median = stats[key]['median']
+                if run[key] > median * (1 + threshold) and run[key] - median > minimum:
+                    regressions.append(
+                        (test_result.name, key, run[key], median))
+        return regressions
+
+    def add_results(self, test_results):
+        # As for the timings, only passed tests are recorded
+        for test_result in test_results:
+            if test_result.status == 'Passed':
+                runs = self.runs.setdefault(test_result.name, [])
+                runs.append(self.make_run(test_result))
+                del runs[:-HISTORY_RUNS]
+
+    def save(self):
+        with open(self.history_file, 'w', encoding="utf8") as f:
+            json.dump(self.runs, f, indent=True, sort_keys=True)
+
+
+def percentile(values, p):
+    """
+    Return the p-th percentile of values, by the nearest rank method.
+    """
+    values = sorted(values)
+    rank = max(-(-len(values) * p // 100), 1)
+    return values[int(rank) - 1]
+
+
+def print_regressions(regressions):
+    for name, key, value, median in regressions:
+        print("{}WARNING!{} {} {} is {:.1f}, the median of its previous runs is {:.1f}".format(
+            BOLD[1], BOLD[0], name, key, value, median))
 
 
 if __name__ == '__main__':